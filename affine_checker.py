@@ -1,24 +1,33 @@
 import language as lang
 
 import dsl_types as dslT
+import threading
+import time
 from typing import Tuple, Union
 from copy import deepcopy
 
-from env import TypeCheckEnv, deepcopy_env
+import metrics
+
+from env import TypeCheckEnv
+from dsl_parser import Literal, atom
 import typecheck_errors as tc_err
 
+# Whether this thread is already inside a call to type_check, so that only the outermost call is timed
+_checking = threading.local()
+
 
 class AffineTypeChecker:
 
     @classmethod
     def check_atomic(cls, env: TypeCheckEnv, prog: str) -> dslT.Type:
-        # Try to interpret it as an integer or boolean first
-        try:
-            int(prog)
-            return deepcopy(lang.T_INT)
-        except ValueError:
-            if prog in lang.bool_map:
+        # Integer and boolean constants were already recognized by the parser (unless the program was built by hand)
+        if prog.__class__ is not Literal:
+            prog = atom(prog)
+        if prog.__class__ is Literal:
+            if isinstance(prog.value, bool):
                 return deepcopy(lang.T_BOOL)
+            elif isinstance(prog.value, int):
+                return deepcopy(lang.T_INT)
 
         if env.contains_fun(prog):
             return env.get_fun_def(prog)
@@ -154,7 +163,7 @@ class AffineTypeChecker:
     def check_apply(cls, env: TypeCheckEnv, fname, *fargs):
         ftype = cls.type_check(env, fname)
         assert isinstance(ftype, dslT.FunType)
-        fsig_arg_t_ls = ftype.argTs
+        fsig_arg_t_ls = ftype.expected_argTs(len(fargs))
 
         actual_arg_t_ls = ()
         for arg_name in fargs:
@@ -163,7 +172,7 @@ class AffineTypeChecker:
         if len(actual_arg_t_ls) != len(fsig_arg_t_ls):
             raise RuntimeError("Didn't pass in right number of arguments!")
 
-        for i, (actual_argT, sigT) in enumerate(zip(actual_arg_t_ls, ftype.argTs)):
+        for i, (actual_argT, sigT) in enumerate(zip(actual_arg_t_ls, fsig_arg_t_ls)):
 
             if isinstance(fsig_arg_t_ls[i], dslT.RefType):
                 assert env.contains_bind(fargs[i])
@@ -194,14 +203,23 @@ class AffineTypeChecker:
         if not dslT.Type.is_subtype(test_type, lang.T_LIN_BOOL):
             raise tc_err.TypeMismatchError(f"If statement conditional is not bool, but {str(test_type)}")
 
-        new_env_then = TypeCheckEnv(outer=deepcopy_env(env))
-        new_env_else = TypeCheckEnv(outer=env)
-        then_type = cls.type_check(new_env_then, then_body, descope=True)
-        else_type = cls.type_check(new_env_else, else_body, descope=True)
-
-        # TODO Confirm that this works
-        if new_env_then.outer != env:
-            raise tc_err.EnvironmentMismatchError("Branches of if statement produce different environments")
+        # Check each branch against env as it is now, undoing whatever the then branch did before checking the else
+        # branch, and compare what they did to whichever bindings either of them touched
+        journal = env.begin_journal()
+        try:
+            then_type = deepcopy(cls.type_check(TypeCheckEnv(outer=env), then_body, descope=True))
+            then_states = journal.states()
+            journal.rollback()
+            else_type = cls.type_check(TypeCheckEnv(outer=env), else_body, descope=True)
+            else_states = journal.states()
+        finally:
+            env.end_journal(journal)
+
+        for key in then_states.keys() | else_states.keys():
+            then_state = then_states[key][1] if key in then_states else else_states[key][0]
+            else_state = else_states[key][1] if key in else_states else then_states[key][0]
+            if then_state != else_state:
+                raise tc_err.EnvironmentMismatchError("Branches of if statement produce different environments")
 
         if then_type != else_type:
             raise tc_err.TypeMismatchError(f"Then body type {str(then_type)} does not equal else body type {str(else_type)}")
@@ -213,16 +231,22 @@ class AffineTypeChecker:
         test_type = cls.type_check(env, test)
         if not dslT.Type.is_subtype(test_type, lang.T_LIN_BOOL):
             raise tc_err.TypeMismatchError(f"While statement conditional was not bool, but {str(test_type)}")
-        old_env = deepcopy_env(env)
-
-        new_env_def = TypeCheckEnv(outer=deepcopy_env(env))
-        new_env_bod = TypeCheckEnv(outer=env)
-        def_type = cls.type_check(new_env_def, default, descope=True)
-        bod_type = cls.type_check(new_env_bod, body, descope=True)
 
-        if new_env_def.outer != old_env:
+        # Neither clause may change anything that was there before the loop, so the body can be checked against what
+        # the default clause leaves behind once that's undone
+        journal = env.begin_journal()
+        try:
+            def_type = deepcopy(cls.type_check(TypeCheckEnv(outer=env), default, descope=True))
+            def_changed = journal.changed()
+            journal.rollback()
+            bod_type = cls.type_check(TypeCheckEnv(outer=env), body, descope=True)
+            bod_changed = journal.changed()
+        finally:
+            env.end_journal(journal)
+
+        if def_changed:
             raise tc_err.EnvironmentMismatchError("Default clause illegally modifies environment")
-        elif new_env_bod.outer != old_env:
+        elif bod_changed:
             raise tc_err.EnvironmentMismatchError("Body clause illegally modifies environment")
 
         if not def_type == bod_type:
@@ -235,6 +259,26 @@ class AffineTypeChecker:
         new_frame = TypeCheckEnv(outer=env)
         return cls.type_check(new_frame, body, descope=True)
 
+    @classmethod
+    def macro_tcheck_fns(cls) -> dict:
+        """
+        The table of macro name -> checking function, built once per class instead of on every call to type_check
+        """
+        if '_macro_tcheck_fns' not in cls.__dict__:
+            cls._macro_tcheck_fns = {
+                "defvar": cls.check_defvar,
+                "defun": cls.check_defun,
+                "setrefval": cls.check_setrefval,
+                "mkref": cls.check_mkref,
+                "deref": cls.check_deref,
+                "set": cls.check_set,
+                "apply": cls.check_apply,
+                "if": cls.check_if,
+                "while": cls.check_while,
+                "scope": cls.check_scope,
+            }
+        return cls._macro_tcheck_fns
+
     @classmethod
     def type_check(cls, env: TypeCheckEnv, prog: Union[Tuple, str],
                    descope: bool = False, being_bound: bool = False) -> dslT.Type:
@@ -246,22 +290,19 @@ class AffineTypeChecker:
         :param prog:
         :return:
         """
-        #################################################################################
-        # If the program isn't a tree, then it should be an integer, string, or boolean #
-        #################################################################################
-        macro_tcheck_fns = {
-            "defvar": cls.check_defvar,
-            "defun": cls.check_defun,
-            "setrefval": cls.check_setrefval,
-            "mkref": cls.check_mkref,
-            "deref": cls.check_deref,
-            "set": cls.check_set,
-            "apply": cls.check_apply,
-            "if": cls.check_if,
-            "while": cls.check_while,
-            "scope": cls.check_scope,
-        }
+        if getattr(_checking, "active", False):
+            return cls._type_check(env, prog, descope, being_bound)
+        _checking.active = True
+        start = time.perf_counter()
+        try:
+            return cls._type_check(env, prog, descope, being_bound)
+        finally:
+            _checking.active = False
+            metrics.observe("check", time.perf_counter() - start)
 
+    @classmethod
+    def _type_check(cls, env: TypeCheckEnv, prog, descope: bool, being_bound: bool) -> dslT.Type:
+        macro_tcheck_fns = cls.macro_tcheck_fns()
         if not (isinstance(prog, tuple)):
             ret = cls.check_atomic(env, prog)
         elif len(prog) == 0:
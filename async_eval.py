@@ -0,0 +1,89 @@
+"""
+Evaluates programs as asyncio coroutines, so that many I/O-heavy programs can be kept in flight on one event loop.
+
+Each program runs on a stack_eval.Machine. Whenever it calls one of the I/O builtins the machine is suspended, the
+call is made on a thread pool, and the machine picks up where it left off once the result is in. Between I/O calls,
+programs are run a bounded number of steps at a time so that long computations don't starve the others.
+
+Only calls the machine makes itself are offloaded: procedures compiled by the other engines (and memoized ones), which
+the machine just calls, still do their I/O inline.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import Executor
+from typing import Any, Iterable, List, Tuple
+
+import language as lang
+from env import Env
+from stack_eval import Machine, Suspend
+
+# How many steps a program is run for before letting the others have a turn
+SLICE_STEPS = 2000
+
+io_fns = frozenset(lang.builtin_fn_vals[name] for name in lang.io_builtins)
+
+
+class AsyncMachine(Machine):
+    def __init__(self, env: Env, prog):
+        super().__init__(env, prog)
+        # The (function, arguments) of the I/O call which the machine is waiting on
+        self.blocked_on = None
+
+    def push_call(self, fn, args) -> None:
+        if fn in io_fns:
+            self.blocked_on = fn, args
+            raise Suspend
+        super().push_call(fn, args)
+
+    def resume_with(self, value) -> None:
+        """
+        Hand back the result of the call the machine was waiting on
+        """
+        self.blocked_on = None
+        self.values.append(value)
+
+
+async def evaluate_async(env: Env, prog, executor: Executor = None, slice_steps: int = SLICE_STEPS) -> Any:
+    """
+    :param executor: Where to make I/O calls (by default, the event loop's default thread pool)
+    :param slice_steps: How many steps to run at a time before yielding to the event loop
+    """
+    loop = asyncio.get_running_loop()
+    machine = AsyncMachine(env, prog)
+    while not machine.run(max_steps=slice_steps):
+        if machine.blocked_on is not None:
+            fn, args = machine.blocked_on
+            machine.resume_with(await loop.run_in_executor(executor, functools.partial(fn, *args)))
+        else:
+            await asyncio.sleep(0)
+    return machine.result
+
+
+async def evaluate_all_async(jobs: Iterable[Tuple[Env, Any]], executor: Executor = None,
+                             max_in_flight: int = None) -> List[Any]:
+    """
+    Evaluate every (env, prog) of jobs concurrently, returning their values in order. If any of them raises, the
+    first error is raised once they have all finished
+    :param max_in_flight: How many programs to run at once (by default, all of them)
+    """
+    limit = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+    async def run_one(env, prog):
+        if limit is None:
+            return await evaluate_async(env, prog, executor)
+        async with limit:
+            return await evaluate_async(env, prog, executor)
+
+    results = await asyncio.gather(*(run_one(env, prog) for env, prog in jobs), return_exceptions=True)
+    for ret in results:
+        if isinstance(ret, BaseException):
+            raise ret
+    return results
+
+
+def evaluate_all(jobs: Iterable[Tuple[Env, Any]], executor: Executor = None, max_in_flight: int = None) -> List[Any]:
+    """
+    Synchronous entry point to evaluate_all_async, running its own event loop
+    """
+    return asyncio.run(evaluate_all_async(jobs, executor, max_in_flight))
@@ -0,0 +1,204 @@
+"""
+Runs one program over many input records at once.
+
+evaluate_batch binds each input variable to a NumPy array holding its value in every record, and evaluates the
+program once: the arithmetic, comparison and logical builtins run element-wise, and an if whose test differs between
+records evaluates each branch only for the records which take it (under a mask) and then selects between the results.
+Programs which can't be evaluated that way (ones with loops, function definitions, references, or calls to anything
+other than those builtins, such as file I/O) are evaluated one record at a time instead, exactly as evaluate_records
+does.
+
+NumPy is only needed for evaluate_batch. Note that integers in arrays are 64 bit, so vectorized results which overflow
+differ from those of the interpreter (which uses Python integers).
+"""
+
+from typing import Any, Dict, List, Sequence
+
+import language as lang
+from dsl_parser import Literal, atom
+from env import Env
+from interpreter import evaluate
+from typecheck_errors import BindingUndefinedError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Builtin name -> (number of arguments, element-wise version)
+vector_ops = {} if np is None else {
+    '+': (2, np.add), '-': (2, np.subtract), '*': (2, np.multiply), '/': (2, np.true_divide),
+    '>': (2, np.greater), '<': (2, np.less), '>=': (2, np.greater_equal), '<=': (2, np.less_equal),
+    '=': (2, np.equal),
+    'or': (2, np.bitwise_or), 'and': (2, np.bitwise_and), 'not': (1, np.logical_not),
+}
+arithmetic_ops = frozenset(['+', '-', '*', '/'])
+
+# Stands in for the value of a branch which no record takes
+_NOT_TAKEN = object()
+
+
+def evaluate_records(prog, inputs: Dict[str, Sequence], size: int = None, engine: str = "tree") -> List[Any]:
+    """
+    Evaluate prog once per record, in a fresh environment with each input variable bound to its value in that record
+    :param inputs: Maps each input variable to its values, one per record
+    :param size: The number of records, if there are no inputs to tell
+    :param engine: See interpreter.evaluate
+    :return: The value of prog for each record
+    """
+    results = []
+    for i in range(_batch_size(inputs, size)):
+        env = Env(defaults=lang.builtin_fn_vals)
+        for name, values in inputs.items():
+            val = values[i]
+            # Use plain Python values, whatever container the inputs came in
+            env.define_bind(name, val.item() if hasattr(val, 'item') else val)
+        results.append(evaluate(env, prog, engine=engine))
+    return results
+
+
+def evaluate_batch(prog, inputs: Dict[str, Sequence], size: int = None) -> 'np.ndarray':
+    """
+    Evaluate prog for every record at once if it can be vectorized, falling back on evaluate_records if not
+    :return: An array of the value of prog for each record
+    """
+    if np is None:
+        raise ImportError("evaluate_batch needs NumPy: use evaluate_records instead")
+    n = _batch_size(inputs, size)
+    if not vectorizable(prog):
+        return np.array(evaluate_records(prog, inputs, size=n))
+
+    env = Env(defaults=lang.builtin_fn_vals)
+    for name, values in inputs.items():
+        env.define_bind(name, np.asarray(values))
+    ret = eval_vector(env, prog, None)
+    if isinstance(ret, np.ndarray):
+        return ret
+    # The value is the same for every record
+    return np.full(n, ret)
+
+
+def vectorizable(prog) -> bool:
+    """
+    Whether prog only uses the macros and builtins which eval_vector can handle (and with the right numbers of
+    arguments, so that any error is the same either way)
+    """
+    if isinstance(prog, str):
+        return True
+    if len(prog) == 0:
+        # nil can't be put in a numeric array
+        return False
+    head = prog[0]
+    if head == "apply":
+        return len(prog) >= 2 and prog[1] in vector_ops and vector_ops[prog[1]][0] == len(prog) - 2 \
+            and all(vectorizable(p) for p in prog[2:])
+    elif head == "defvar":
+        return len(prog) == 4 and vectorizable(prog[3])
+    elif head == "set":
+        return len(prog) == 3 and vectorizable(prog[2])
+    elif head == "if":
+        return len(prog) == 4 and all(vectorizable(p) for p in prog[1:])
+    elif head == "scope":
+        return all(vectorizable(p) for p in prog[1:])
+    elif head in lang.MACRO_NAMES or head in ("deref", "setref", "setrefval"):
+        return False
+    return all(vectorizable(p) for p in prog)
+
+
+def eval_vector(env: Env, prog, mask):
+    """
+    Evaluate prog for every record at once. Values are either arrays (one element per record) or plain Python values
+    (the same for every record)
+    :param mask: A boolean array of the records which this evaluation is really for, or None for all of them. The
+    elements for other records are unspecified, and assignments leave them as they were
+    """
+    if isinstance(prog, str):
+        if prog.__class__ is Literal:
+            return prog.value
+        try:
+            return env.get_bind_val(prog)
+        except BindingUndefinedError:
+            # Programs built by hand rather than parsed may spell constants as plain strs
+            lit = atom(prog)
+            if lit.__class__ is not Literal:
+                raise
+            return lit.value
+
+    head, args = prog[0], prog[1:]
+    if head == "defvar":
+        name, _, init_prog = args
+        env.define_bind(name, eval_vector(env, init_prog, mask))
+        return None
+    elif head == "set":
+        name, val_prog = args
+        val = eval_vector(env, val_prog, mask)
+        if mask is not None:
+            val = np.where(mask, val, env.get_bind_val(name))
+        env.set_bind_val(name, val)
+        return None
+    elif head == "apply":
+        return _apply(args[0], [eval_vector(env, a, mask) for a in args[1:]], mask)
+    elif head == "if":
+        return _eval_if(env, mask, *args)
+    elif head == "scope":
+        return eval_vector(Env(outer=env), args, mask)
+    else:
+        ret = None
+        for subprog in prog:
+            ret = eval_vector(env, subprog, mask)
+        return ret
+
+
+def _apply(fname, vals, mask):
+    if not any(isinstance(v, np.ndarray) for v in vals):
+        return lang.builtin_fn_vals[fname](*vals)
+
+    if fname in arithmetic_ops:
+        # Python adds bools as integers, but NumPy would treat + on boolean arrays as or
+        vals = [v.astype(np.int64) if isinstance(v, np.ndarray) and v.dtype == bool else v for v in vals]
+    if fname == '/':
+        zeros = np.asarray(vals[1]) == 0
+        if np.any(zeros if mask is None else zeros & mask):
+            raise ZeroDivisionError("division by zero")
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return vector_ops[fname][1](*vals)
+    return vector_ops[fname][1](*vals)
+
+
+def _eval_if(env: Env, mask, test, then_c, else_c):
+    test_result = eval_vector(env, test, mask)
+
+    if not isinstance(test_result, np.ndarray):
+        # Every record takes the same branch
+        inner_env = Env(outer=env)
+        ret = eval_vector(inner_env, then_c if test_result else else_c, mask)
+        inner_env.deallocate()
+        return ret
+
+    taken = test_result.astype(bool)
+    branch_vals = []
+    for branch, branch_mask in ((then_c, taken), (else_c, ~taken)):
+        if mask is not None:
+            branch_mask = branch_mask & mask
+        if not branch_mask.any():
+            # No record takes this branch, so it mustn't be evaluated at all
+            branch_vals.append(_NOT_TAKEN)
+            continue
+        inner_env = Env(outer=env)
+        branch_vals.append(eval_vector(inner_env, branch, branch_mask))
+        inner_env.deallocate()
+    then_val, else_val = branch_vals
+    if else_val is _NOT_TAKEN:
+        return then_val
+    elif then_val is _NOT_TAKEN:
+        return else_val
+    return np.where(taken, then_val, else_val)
+
+
+def _batch_size(inputs: Dict[str, Sequence], size: int = None) -> int:
+    sizes = {len(values) for values in inputs.values()}
+    if size is not None:
+        sizes.add(size)
+    if len(sizes) != 1:
+        raise ValueError(f"Inputs should all have the same number of records, but got sizes {sorted(sizes)}")
+    return sizes.pop()
@@ -0,0 +1,114 @@
+"""
+Saves the state of a running program to disk, so that it can be picked up again from there after a restart.
+
+A Checkpoint runs a program one top-level form at a time, and between forms its whole state (the chain of
+environments with their bindings, the functions defined so far including their memos, references, and what is left of
+the program) can be saved. A suspended stack_eval.Machine (say, one which a scheduler.Scheduler has stopped at a
+safepoint, which include while loop back-edges) can be saved and restored in the same way, to resume it mid-form.
+
+Snapshots are pickles. Builtin functions are saved by name rather than by value, and open files by their path and how
+far into them had been written: restoring one opens it again at that point, dropping anything written after the
+snapshot was taken. Procedures are saved without any code the jit module compiled for them. Procedures defined by the
+closure engine can't be saved.
+"""
+
+import io
+import os
+import pickle
+from typing import Any
+
+import language as lang
+from env import Env
+from interpreter import evaluate
+
+_MACRO_HEADS = frozenset(lang.MACRO_NAMES) | {"scope"}
+
+
+class Checkpoint:
+    def __init__(self, env: Env, prog, engine: str = "tree"):
+        """
+        :param prog: A sequence of top-level forms (or a single form) to run in env
+        :param engine: See interpreter.evaluate
+        """
+        self.env = env
+        if isinstance(prog, str) or len(prog) == 0 or prog[0] in _MACRO_HEADS:
+            prog = (prog,)
+        self.forms = tuple(prog)
+        self.engine = engine
+        # Index of the next form to run, and the value of the last one run
+        self.next_form = 0
+        self.value = None
+
+    @property
+    def done(self) -> bool:
+        return self.next_form >= len(self.forms)
+
+    def step(self) -> Any:
+        """
+        Run the next top-level form
+        """
+        if self.done:
+            raise RuntimeError("Every form has already been run")
+        self.value = evaluate(self.env, self.forms[self.next_form], engine=self.engine)
+        self.next_form += 1
+        return self.value
+
+    def run(self, path: str = None, every: int = 1) -> Any:
+        """
+        Run the rest of the program, saving a snapshot to path (if given) after every so many forms
+        :return: The value of the program
+        """
+        while not self.done:
+            self.step()
+            if path is not None and (self.next_form % every == 0 or self.done):
+                save(path, self)
+        return self.value
+
+
+##################################
+# Writing and reading snapshots  #
+##################################
+
+class _Pickler(pickle.Pickler):
+    _builtin_names = {id(fn): name for name, fn in lang.builtin_fn_vals.items()}
+
+    def persistent_id(self, obj):
+        name = self._builtin_names.get(id(obj))
+        if name is not None and lang.builtin_fn_vals[name] is obj:
+            return "builtin", name
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        kind, name = pid
+        if kind != "builtin" or name not in lang.builtin_fn_vals:
+            raise pickle.UnpicklingError(f"Unknown builtin {name} in snapshot")
+        return lang.builtin_fn_vals[name]
+
+
+def dumps(obj) -> bytes:
+    buf = io.BytesIO()
+    _Pickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+    return buf.getvalue()
+
+
+def loads(data: bytes) -> Any:
+    return _Unpickler(io.BytesIO(data)).load()
+
+
+def save(path: str, obj) -> None:
+    """
+    Write a snapshot of obj (usually a Checkpoint or a Machine) to path, replacing it in one go so that a crash never
+    leaves half a snapshot behind
+    """
+    data = dumps(obj)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def restore(path: str) -> Any:
+    with open(path, "rb") as f:
+        return loads(f.read())
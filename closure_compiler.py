@@ -0,0 +1,589 @@
+"""
+An alternative to the tree-walking interpreter: each form is compiled once into a Python closure, so evaluating a
+program is just a matter of calling closures. Semantics (including when and which errors get raised) are the same as
+interpreter.eval_form.
+
+Variables are resolved lexically at compile time. Every scope which the tree-walker would create an Env for (the
+program itself, the body of a function, scope forms, and the bodies of ifs and whiles) gets a Frame at runtime: a
+fixed-size array with one slot per variable which the scope defvars. A reference to a variable is compiled down to the
+(frame depth, slot index) pairs of the scopes which could hold it, so it costs the same however deeply it is nested and
+however many other bindings are in scope. Only variables defvar'd by the program itself at the top level (and any
+already bound in the Env passed to evaluate) still live in an Env.
+"""
+
+from collections import ChainMap
+from typing import Callable, Dict, List, Tuple
+
+import typecheck_errors as tc_err
+from dsl_parser import Literal, atom
+from env import Env
+from interpreter import Procedure, TailCall
+from language import T_NIL
+
+# How many programs' compiled code to keep around between calls to evaluate
+COMPILE_CACHE_SIZE = 256
+_compile_cache = {}
+
+
+class _Undefined:
+    def __repr__(self):
+        return 'UNDEFINED'
+
+
+# The value of a slot whose defvar hasn't run (yet)
+UNDEFINED = _Undefined()
+
+
+class Frame:
+    """
+    The runtime counterpart of a Scope. Frames for the top level of a program have no slots and pass all bindings
+    through to base, an Env. Frames for function calls have no base, and look functions up in the defaults of the
+    function being called.
+    """
+    __slots__ = ('slots', 'names', 'functions', 'parent', 'base', 'defaults', 'allocated')
+
+    def __init__(self, layout, parent=None, base: Env = None, defaults: Dict = None):
+        n_slots, self.names, has_functions = layout
+        self.slots = [UNDEFINED] * n_slots
+        self.functions = {} if has_functions else None
+        self.parent = parent
+        if parent is not None:
+            self.base, self.defaults = parent.base, parent.defaults
+        else:
+            self.base, self.defaults = base, defaults
+        self.allocated = True
+
+    def set_bind_val(self, name: str, val) -> None:
+        # Frames stand in for Envs as the defining environments in references
+        if not self.allocated:
+            raise tc_err.DeallocatedEnvError
+        self.slots[self.names[name]] = val
+
+    def deallocate(self) -> None:
+        self.allocated = False
+
+
+Code = Callable[[Frame], object]
+
+
+class Scope:
+    """
+    Compile-time information about one of the scopes in a program: which variables it holds in which slots, and which
+    functions it defines
+    """
+    def __init__(self, kind: str, parent=None, dead: bool = False):
+        # kind is one of "top", "proc", or "inner"
+        self.kind = kind
+        self.parent = parent
+        self.slots = {}
+        self.fun_names = set()
+        # Code in a dead scope runs in an Env which has already been deallocated
+        self.dead = dead or (parent is not None and parent.dead)
+
+    @property
+    def root(self):
+        s = self
+        while s.parent is not None:
+            s = s.parent
+        return s
+
+    @property
+    def layout(self) -> Tuple[int, Dict[str, int], bool]:
+        return len(self.slots), self.slots, bool(self.fun_names)
+
+    def declare(self, name: str) -> None:
+        self.slots.setdefault(name, len(self.slots))
+
+    def collect(self, prog) -> None:
+        """
+        Find the variables and functions which prog defines directly in this scope (not in any scopes it creates)
+        """
+        if isinstance(prog, str) or len(prog) == 0:
+            return
+        head, args = prog[0], prog[1:]
+        if head not in macro_compilers:
+            for p in prog:
+                self.collect(p)
+        elif head == 'defvar' and len(args) == 3:
+            self.declare(args[0])
+            self.collect(args[2])
+        elif head == 'defun' and len(args) >= 3:
+            self.fun_names.add(args[0])
+        elif head in ('set', 'setref', 'setrefval') and len(args) == 2:
+            self.collect(args[1])
+        elif head == 'apply':
+            for arg in args[1:]:
+                self.collect(arg)
+        elif head == 'if' and len(args) == 3:
+            self.collect(args[0])
+
+    def var_candidates(self, name: str) -> List[Tuple[int, int]]:
+        """
+        The (depth, slot) pairs, innermost first, of every enclosing scope which defvars name
+        """
+        ret, depth, s = [], 0, self
+        while s is not None:
+            if name in s.slots:
+                ret.append((depth, s.slots[name]))
+            depth, s = depth + 1, s.parent
+        return ret
+
+    def fun_candidates(self, name: str) -> List[int]:
+        """
+        The depths, innermost first, of every enclosing frame which might define function name
+        """
+        ret, depth, s = [], 0, self
+        while s is not None:
+            if name in s.fun_names and s.kind != 'top':
+                ret.append(depth)
+            depth, s = depth + 1, s.parent
+        return ret
+
+
+class CompiledProcedure(Procedure):
+    def __init__(self, defaults, argspec_ls, fn_body, code: Code, layout):
+        super().__init__(defaults, argspec_ls, fn_body)
+        self.code = code
+        self.layout = layout
+        self.has_duplicate_args = len({name for name, _ in argspec_ls}) != len(argspec_ls)
+
+    def run(self, argvals):
+        # As in the tree-walker, calls in tail position come back as TailCalls to be made here
+        proc = self
+        while True:
+            ret = proc.code(proc.make_slot_frame(argvals))
+            if ret.__class__ is not TailCall:
+                return ret
+            proc, argvals = ret.proc, ret.argvals
+
+    def make_slot_frame(self, argvals) -> Frame:
+        if len(argvals) != len(self.argspec_ls):
+            raise RuntimeError("Mismatch between number of arguments required and number of arguments given")
+        if self.has_duplicate_args:
+            raise tc_err.BindingRedefinitionError(f"Attempting to redefine an argument of the function")
+        frame = Frame(self.layout, defaults=self.defaults)
+        # Arguments are always declared first, so they occupy the first slots
+        frame.slots[:len(argvals)] = argvals
+        return frame
+
+
+def evaluate(env: Env, prog):
+    return compile_program(prog)(Frame((0, {}, False), base=env))
+
+
+def compile_program(prog) -> Code:
+    """
+    Compile prog, reusing the result of a previous compilation of the same (identical) program object if there is one
+    """
+    entry = _compile_cache.get(id(prog))
+    # Holding on to prog in the cache entry means that its id can't be reused while the entry exists
+    if entry is not None and entry[0] is prog:
+        return entry[1]
+    code = compile_form(Scope('top'), prog)
+    if len(_compile_cache) >= COMPILE_CACHE_SIZE:
+        _compile_cache.clear()
+    _compile_cache[id(prog)] = prog, code
+    return code
+
+
+def compile_form(scope: Scope, prog, tail: bool = False) -> Code:
+    """
+    :param tail: Whether prog is in tail position in the body of a function (see interpreter.eval_form)
+    """
+
+    ############################################
+    # Take care of evaluating "special" values #
+    ############################################
+
+    if isinstance(prog, str):
+        # Programs built by hand rather than parsed may spell constants as plain strs
+        prog = atom(prog)
+        if prog.__class__ is Literal:
+            value = prog.value
+            return lambda f: value
+        return compile_lookup(scope, prog)
+    elif len(prog) == 0:
+        return lambda f: T_NIL
+    elif prog[0] in macro_compilers:
+        try:
+            if tail and prog[0] in tail_macros:
+                return macro_compilers[prog[0]](scope, *prog[1:], tail=True)
+            return macro_compilers[prog[0]](scope, *prog[1:])
+        except TypeError as err:
+            # A malformed form is only an error if it's actually evaluated, so defer raising it
+            return _raiser(err)
+    else:
+        return compile_sequence(scope, prog, tail=tail)
+
+
+def compile_sequence(scope: Scope, prog_ls, tail: bool = False) -> Code:
+    codes = tuple(compile_form(scope, p, tail=tail and i == len(prog_ls) - 1) for i, p in enumerate(prog_ls))
+    if len(codes) == 1:
+        return codes[0]
+
+    def run(f: Frame):
+        ret = None
+        for code in codes:
+            ret = code(f)
+        return ret
+    return run
+
+
+def compile_body(scope: Scope, prog, tail: bool = False) -> Code:
+    """
+    Compile code which is the whole of a new scope
+    """
+    scope.collect(prog)
+    return compile_form(scope, prog, tail=tail)
+
+
+def _raiser(err) -> Code:
+    def run(f: Frame):
+        raise err
+    return run
+
+
+def _deallocated_raiser(*codes: Code) -> Code:
+    """
+    Code which touches the environment, in a dead scope. The tree-walker would have failed as soon as it touched the
+    environment, so evaluate codes (which can only be things like the arguments to an apply) and then raise.
+    """
+    def run(f: Frame):
+        for code in codes:
+            code(f)
+        raise tc_err.DeallocatedEnvError
+    return run
+
+
+#######################################################
+# Resolving variables (and functions) to their frames #
+#######################################################
+
+def _hop(depth: int) -> Callable[[Frame], Frame]:
+    if depth == 0:
+        return lambda f: f
+    elif depth == 1:
+        return lambda f: f.parent
+    elif depth == 2:
+        return lambda f: f.parent.parent
+
+    def hop(f: Frame):
+        for _ in range(depth):
+            f = f.parent
+        return f
+    return hop
+
+
+def _resolver(scope: Scope, name: str) -> Callable[[Frame], Tuple[Frame, int]]:
+    """
+    Find the frame and slot currently holding name, or (None, None) if it's not in any frame
+    """
+    candidates = tuple((_hop(depth), idx) for depth, idx in scope.var_candidates(name))
+
+    def resolve(f: Frame):
+        for hop, idx in candidates:
+            g = hop(f)
+            if g.slots[idx] is not UNDEFINED:
+                return g, idx
+        return None, None
+    return resolve
+
+
+def _base_fallback(scope: Scope, name: str) -> Callable[[Frame], Env]:
+    """
+    Get the Env in which to look up name when no frame holds it, raising the same error as the tree-walker if there
+    isn't one
+    """
+    if scope.root.kind == 'top':
+        return lambda f: f.base
+
+    def no_base(f: Frame):
+        raise tc_err.BindingUndefinedError(f'{name} is undefined')
+    return no_base
+
+
+def compile_lookup(scope: Scope, name: str) -> Code:
+    if scope.dead:
+        return _deallocated_raiser()
+    candidates = scope.var_candidates(name)
+    resolve = _resolver(scope, name)
+    fallback = _base_fallback(scope, name)
+
+    def slow(f: Frame):
+        g, idx = resolve(f)
+        if g is not None:
+            return g.slots[idx]
+        base = fallback(f)
+        binding = base.bindings.get(name)
+        if binding is not None and base.allocated:
+            return binding[0]
+        return base.get_bind_val(name)
+
+    if len(candidates) != 1:
+        return slow
+
+    # By far the most common case: the variable is only defined in one place
+    hop, idx = _hop(candidates[0][0]), candidates[0][1]
+
+    def run(f: Frame):
+        val = hop(f).slots[idx]
+        if val is UNDEFINED:
+            return slow(f)
+        return val
+    return run
+
+
+def compile_define(scope: Scope, name: str) -> Callable[[Frame, object], None]:
+    if scope.kind == 'top':
+        return lambda f, val: f.base.define_bind(name, val)
+
+    # Same as Env.define_bind: it's an error for name to be bound anywhere in scope already
+    resolve = _resolver(scope, name)
+    fallback = _base_fallback(scope, name)
+    top_rooted = scope.root.kind == 'top'
+    idx = scope.slots[name]
+
+    def define(f: Frame, val):
+        if resolve(f)[0] is not None or (top_rooted and fallback(f).contains_bind(name)):
+            raise tc_err.BindingRedefinitionError(f"Attempting to redefine {name}")
+        f.slots[idx] = val
+    return define
+
+
+def compile_assign(scope: Scope, name: str) -> Callable[[Frame, object], None]:
+    resolve = _resolver(scope, name)
+    fallback = _base_fallback(scope, name)
+
+    def assign(f: Frame, val):
+        g, idx = resolve(f)
+        if g is not None:
+            g.slots[idx] = val
+        else:
+            fallback(f).set_bind_val(name, val)
+    return assign
+
+
+def compile_fun_lookup(scope: Scope, fname: str) -> Callable[[Frame], object]:
+    candidates = tuple(_hop(depth) for depth in scope.fun_candidates(fname))
+    top_rooted = scope.root.kind == 'top'
+
+    def lookup(f: Frame):
+        for hop in candidates:
+            fn = hop(f).functions.get(fname)
+            if fn is not None:
+                return fn
+        if top_rooted:
+            return f.base.get_fun_def(fname)
+        elif fname in f.defaults:
+            return f.defaults[fname]
+        raise tc_err.BindingUndefinedError(f'{fname} is undefined')
+    return lookup
+
+
+def _fun_defined(lookup, f: Frame) -> bool:
+    try:
+        lookup(f)
+        return True
+    except tc_err.BindingUndefinedError:
+        return False
+
+
+#####################
+# Compiling macros  #
+#####################
+
+def compile_defvar(scope: Scope, name, declared_tprog, init_prog) -> Code:
+    init = compile_form(scope, init_prog)
+    if scope.dead:
+        return _deallocated_raiser(init)
+    define = compile_define(scope, name)
+
+    def run(f: Frame):
+        define(f, init(f))
+        return None
+    return run
+
+
+def compile_defun(scope: Scope, fname, fun_ret_t, argspec_list, *fn_body) -> Code:
+    if scope.dead:
+        return _deallocated_raiser()
+
+    fn_scope = Scope('proc')
+    for name, _ in argspec_list:
+        fn_scope.declare(name)
+    body = compile_body(fn_scope, fn_body, tail=True)
+    layout = fn_scope.layout
+    lookup = compile_fun_lookup(scope, fname)
+
+    if scope.kind == 'top':
+        def run(f: Frame):
+            f.base.define_fun(fname, CompiledProcedure(f.base.functions, argspec_list, fn_body, body, layout))
+            return None
+        return run
+
+    def run(f: Frame):
+        if _fun_defined(lookup, f):
+            raise tc_err.BindingRedefinitionError(f"Attempting to redefine {fname}")
+        # As in the tree-walker, functions defined directly in a procedure's body can see everything the procedure
+        # can, whereas those defined in a scope within it only see that scope's functions
+        defaults = ChainMap(f.functions, f.defaults) if scope.kind == 'proc' else f.functions
+        f.functions[fname] = CompiledProcedure(defaults, argspec_list, fn_body, body, layout)
+        return None
+    return run
+
+
+def compile_set(scope: Scope, var_name, val_prog) -> Code:
+    val = compile_form(scope, val_prog)
+    if scope.dead:
+        return _deallocated_raiser(val)
+    assign = compile_assign(scope, var_name)
+
+    def run(f: Frame):
+        assign(f, val(f))
+        return None
+    return run
+
+
+def compile_apply(scope: Scope, fun_name, *arg_list, tail: bool = False) -> Code:
+    args = tuple(compile_form(scope, arg) for arg in arg_list)
+    if scope.dead:
+        return _deallocated_raiser(*args)
+    lookup = compile_fun_lookup(scope, fun_name)
+
+    if tail:
+        def run(f: Frame):
+            eval_args = [arg(f) for arg in args]
+            fn = lookup(f)
+            if fn.__class__ is CompiledProcedure and fn.memo is None:
+                return TailCall(fn, eval_args)
+            return fn(*eval_args)
+        return run
+
+    if len(args) == 2:
+        a0, a1 = args
+
+        def run(f: Frame):
+            x, y = a0(f), a1(f)
+            return lookup(f)(x, y)
+        return run
+
+    def run(f: Frame):
+        eval_args = [arg(f) for arg in args]
+        return lookup(f)(*eval_args)
+    return run
+
+
+def compile_scope(scope: Scope, *prog, tail: bool = False) -> Code:
+    inner = Scope('inner', parent=scope)
+    body = compile_body(inner, prog, tail=tail)
+    layout = inner.layout
+    return lambda f: body(Frame(layout, parent=f))
+
+
+def compile_if(scope: Scope, test, then_c, else_c, tail: bool = False) -> Code:
+    test = compile_form(scope, test)
+    inner = Scope('inner', parent=scope)
+    inner.collect(then_c)
+    inner.collect(else_c)
+    then_c, else_c = compile_form(inner, then_c, tail=tail), compile_form(inner, else_c, tail=tail)
+    layout = inner.layout
+
+    def run(f: Frame):
+        test_result = test(f)
+        inner_f = Frame(layout, parent=f)
+        ret = then_c(inner_f) if test_result else else_c(inner_f)
+        inner_f.deallocate()
+        return ret
+    return run
+
+
+def compile_while(scope: Scope, test_c, default_c, body_c) -> Code:
+    inner = Scope('inner', parent=scope)
+    inner.collect(test_c)
+    inner.collect(body_c)
+    test_c, body_c = compile_form(inner, test_c), compile_form(inner, body_c)
+    # Same as the tree-walker: the default clause is evaluated after the loop's environment has been deallocated
+    default_c = compile_form(Scope('inner', parent=inner, dead=True), default_c)
+    layout = inner.layout
+
+    def run(f: Frame):
+        inner_f = Frame(layout, parent=f)
+        return_default = True
+        ret = None
+        while test_c(inner_f):
+            return_default = False
+            ret = body_c(inner_f)
+
+        inner_f.deallocate()
+        if not return_default:
+            return ret
+        else:
+            return default_c(inner_f)
+    return run
+
+
+def compile_mkref(scope: Scope, var) -> Code:
+    if scope.dead:
+        return _deallocated_raiser()
+    resolve = _resolver(scope, var)
+    fallback = _base_fallback(scope, var)
+
+    def run(f: Frame):
+        g, idx = resolve(f)
+        if g is not None:
+            return var, (g.slots[idx], g)
+        return var, fallback(f).get_bind(var)
+    return run
+
+
+def compile_setref(scope: Scope, ref_name, new_def) -> Code:
+    new_def = compile_form(scope, new_def)
+    if scope.dead:
+        return _deallocated_raiser(new_def)
+    assign = compile_assign(scope, ref_name)
+
+    def run(f: Frame):
+        assign(f, new_def(f))
+    return run
+
+
+def compile_deref(scope: Scope, ref) -> Code:
+    lookup = compile_lookup(scope, ref)
+
+    def run(f: Frame):
+        var, referenced_binding = lookup(f)
+        val, defining_env = referenced_binding
+        return val
+    return run
+
+
+def compile_setrefval(scope: Scope, ref, new_val) -> Code:
+    new_val = compile_form(scope, new_val)
+    if scope.dead:
+        return _deallocated_raiser(new_val)
+    lookup = compile_lookup(scope, ref)
+
+    def run(f: Frame):
+        eval_new_val = new_val(f)
+        var, referenced_binding = lookup(f)
+        val, defining_env = referenced_binding
+        defining_env.set_bind_val(var, eval_new_val)
+    return run
+
+
+# The macros which pass tail position on to (some of) their subforms
+tail_macros = {"apply", "if", "scope"}
+
+macro_compilers = {
+    "defun": compile_defun,
+    "defvar": compile_defvar,
+    "scope": compile_scope,
+    "set": compile_set,
+    "apply": compile_apply,
+    "if": compile_if,
+    "while": compile_while,
+    "mkref": compile_mkref,
+    "setref": compile_setref,
+    "deref": compile_deref,
+    "setrefval": compile_setrefval
+}
@@ -0,0 +1,109 @@
+"""
+Recognizes while loops which count a variable up to a bound, such as
+
+    (while (apply < i n) d ((set i (apply + i 1)) ...))
+
+so that the interpreter can run them as a Python range loop instead of evaluating the test (and the increment) through
+eval_form on every iteration.
+
+A counting loop's test compares a variable with < or <= against an integer literal or another variable, and its body
+is a sequence which starts or ends by adding a positive integer literal to the variable. Whether the loop really does
+count is only known at run time: the variable and bound have to start out as integers, < and + have to be the
+builtins, and nothing in the rest of the body may change the variable, the bound, or what any function name refers
+to. interpreter.run_counting_loop checks all of that, and hands the loop back to the ordinary evaluator as soon as
+anything changes.
+"""
+
+from typing import Optional
+
+from dsl_parser import Literal
+from language import MACRO_NAMES
+
+# Forms headed by these are single forms, rather than sequences of forms
+_macro_heads = frozenset(MACRO_NAMES) | {"scope"}
+
+
+class CountingLoop:
+    __slots__ = ('var', 'test_op', 'bound', 'step', 'incr', 'incr_first', 'rest')
+
+    def __init__(self, var: str, test_op: str, bound, step: int, incr, incr_first: bool, rest: tuple):
+        """
+        :param test_op: "<" or "<="
+        :param bound: The bound's variable name, or its value if it's a literal
+        :param incr: The form which increments var
+        :param incr_first: Whether incr is the first form of the body (if not, it's the last)
+        :param rest: The other forms of the body
+        """
+        self.var = var
+        self.test_op = test_op
+        self.bound = bound
+        self.step = step
+        self.incr = incr
+        self.incr_first = incr_first
+        self.rest = rest
+
+
+def match_counting_loop(prog) -> Optional[CountingLoop]:
+    """
+    :param prog: A while form
+    :return: How prog counts, or None if it isn't a counting loop
+    """
+    if len(prog) != 4:
+        return None
+    _, test, _, body = prog
+
+    if not (isinstance(test, tuple) and len(test) == 4 and test[0] == "apply" and test[1] in ("<", "<=")):
+        return None
+    _, test_op, var, bound = test
+    if not _is_symbol(var):
+        return None
+    if _is_symbol(bound):
+        if bound == var:
+            return None
+    elif bound.__class__ is Literal and type(bound.value) is int:
+        bound = bound.value
+    else:
+        return None
+
+    if not isinstance(body, tuple) or len(body) == 0:
+        return None
+    forms = (body,) if body[0] in _macro_heads else body
+    step = _increment_step(forms[0], var)
+    if step is not None:
+        incr_first, incr, rest = True, forms[0], forms[1:]
+    else:
+        step = _increment_step(forms[-1], var)
+        if step is None:
+            return None
+        incr_first, incr, rest = False, forms[-1], forms[:-1]
+
+    # Defining the variable or bound directly in the body would shadow it from the next iteration's test on
+    names = {var, bound}
+    if any(isinstance(form, tuple) and len(form) > 1 and form[0] == "defvar" and form[1] in names for form in rest):
+        return None
+    return CountingLoop(var, test_op, bound, step, incr, incr_first, tuple(rest))
+
+
+def _is_symbol(prog) -> bool:
+    return isinstance(prog, str) and prog.__class__ is not Literal
+
+
+def _increment_step(form, var: str) -> Optional[int]:
+    """
+    If form is (set var (apply + var step)) (or with the arguments of + the other way around) for a positive integer
+    literal step, then step
+    """
+    if not (isinstance(form, tuple) and len(form) == 3 and form[0] == "set" and form[1] == var):
+        return None
+    val = form[2]
+    if not (isinstance(val, tuple) and len(val) == 4 and val[0] == "apply" and val[1] == "+"):
+        return None
+    if val[2] == var and _is_symbol(val[2]):
+        step = val[3]
+    elif val[3] == var and _is_symbol(val[3]):
+        step = val[2]
+    else:
+        return None
+    if step.__class__ is Literal and type(step.value) is int and step.value > 0:
+        return step.value
+    return None
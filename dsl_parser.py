@@ -4,12 +4,47 @@
 ##################################################################
 
 
-from typing import NewType
+import sys
+import time
+from functools import lru_cache
+from typing import Any, Iterable, Iterator, NewType, Union
 
+import metrics
 
-def dsl_parse(src_str: str):
-    "Converts a scheme expression into a string"
-    return read_from_tokens(tokenize(src_str))
+# Default number of characters pulled from a file object at a time by the streaming reader
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+def dsl_parse(src_str: str, cache=None):
+    """
+    Converts a scheme expression into a string
+    :param cache: An optional parse_cache.ParseCache to look the result up in (and store it to)
+    """
+    start = time.perf_counter()
+    try:
+        if cache is not None:
+            return cache.parse(src_str)
+        return read_from_tokens(tokenize(src_str))
+    finally:
+        metrics.observe("parse", time.perf_counter() - start)
+
+
+def dsl_parse_stream(fileobj, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator:
+    """
+    Lazily parse a sequence of top-level forms, yielding each one as soon as its closing paren is read.
+
+    Only the tokens of the form currently being read are held in memory, so the cost of parsing a large program is
+    bounded by its largest top-level form rather than by the size of the whole source.
+    :param fileobj: A file-like object with a read() method, a string, or an iterable of string chunks
+    :param chunk_size: Number of characters to read from fileobj at a time
+    :return:
+    """
+    tokens = tokenize_stream(iter_chunks(fileobj, chunk_size))
+    for token in tokens:
+        start = time.perf_counter()
+        form = _read_form(token, tokens)
+        metrics.observe("parse", time.perf_counter() - start)
+        yield form
 
 
 def tokenize(s):
@@ -17,23 +52,114 @@ def tokenize(s):
     return s.replace('(', ' ( ').replace(')', ' ) ').split()
 
 
-def read_from_tokens(tokens: list):
+def tokenize_stream(chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Tokenize a program which arrives as a sequence of string chunks. A token may be split across two chunks, so the
+    trailing (possibly incomplete) token of each chunk is held back and glued onto the start of the next one.
+    """
+    partial = ''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        tokens = tokenize(partial + chunk)
+        if tokens and not chunk[-1].isspace() and chunk[-1] not in '()':
+            partial = tokens.pop()
+        else:
+            partial = ''
+        yield from tokens
+    if partial:
+        yield partial
+
+
+def read_from_tokens(tokens: Iterable[str]):
     "Read an expression from a sequence of tokens."
-    if len(tokens) == 0:
-        raise SyntaxError('unexpected EOF')
-    token = tokens.pop(0)
-    if token == '(':
-        L = []
-        while tokens[0] != ')':
-            L.append(read_from_tokens(tokens))
-        tokens.pop(0)  # pop off ')'
-        return tuple(L)
-    elif token == ')':
+    tokens = iter(tokens)
+    for token in tokens:
+        return _read_form(token, tokens)
+    raise SyntaxError('unexpected EOF')
+
+
+def _read_form(token: str, tokens: Iterator[str]):
+    """
+    Read the form starting with token, pulling any further tokens it needs off of the (shared) iterator. Each token
+    is consumed exactly once, so reading is linear in the number of tokens. The forms still being read are kept on a
+    stack of their own rather than on Python's, so forms can be nested arbitrarily deeply.
+    """
+    if token == ')':
         raise SyntaxError('unexpected )')
-    else:
+    elif token != '(':
         return atom(token)
 
+    # The items read so far of each form which has been opened but not yet closed, innermost last
+    stack = [[]]
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            form = tuple(stack.pop())
+            if not stack:
+                return form
+            stack[-1].append(form)
+        else:
+            stack[-1].append(atom(token))
+    raise SyntaxError('unexpected EOF')
+
+
+def iter_chunks(src: Union[str, Iterable[str]], chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[str]:
+    "Normalize a string, file-like object, or iterable of strings into an iterator of string chunks."
+    if isinstance(src, str):
+        for start in range(0, len(src), chunk_size):
+            yield src[start:start + chunk_size]
+    elif hasattr(src, 'read'):
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        yield from src
+
+
+class Literal(str):
+    """
+    A constant token. It still compares and hashes equal to the text it was read from (so type specifiers and the
+    like keep working), but also carries the value it denotes, so it never has to be re-parsed at evaluation time.
+    """
+    def __new__(cls, token: str, value: Any):
+        self = super().__new__(cls, token)
+        self.value = value
+        return self
+
+    def __getnewargs__(self):
+        return str(self), self.value
+
+
+literal_keywords = {"true": True, "false": False, "nil": None}
+_number_starts = frozenset('+-.iInN')
+
+# How many distinct tokens atom remembers the reading of
+ATOM_MEMO_SIZE = 1 << 16
+
 
 def atom(token: str):
-    "Numbers become numbers; every other token is a symbol."
-    return str(token)
+    "Numbers, booleans and nil become Literals; every other token is an (interned) symbol."
+    return _classify_atom(token)
+
+
+# Programs tend to use the same few tokens over and over, so remember how (a bounded number of) them were read
+@lru_cache(maxsize=ATOM_MEMO_SIZE)
+def _classify_atom(token: str):
+    if token in literal_keywords:
+        return Literal(token, literal_keywords[token])
+    # Only bother probing int() and float() for tokens which could possibly be numbers (including inf and nan)
+    if not (token[0].isdigit() or (token[0] in _number_starts and token not in ('+', '-'))):
+        return sys.intern(str(token))
+    try:
+        return Literal(token, int(token))
+    except ValueError:
+        pass
+    try:
+        return Literal(token, float(token))
+    except ValueError:
+        pass
+    return sys.intern(str(token))
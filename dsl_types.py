@@ -1,6 +1,9 @@
+from copy import deepcopy
 from enum import Enum
 from typing import List, Union, Tuple
 
+import metrics
+
 
 class Tmod(Enum):
     un = "un"
@@ -94,8 +97,18 @@ class Type:
     def is_un(self, ) -> bool:
         return self.tmod == Tmod.un
 
+    def __deepcopy__(self, memo):
+        metrics.count("deepcopy_type")
+        # The same as what deepcopy does by default
+        copied = self.__class__.__new__(self.__class__)
+        memo[id(self)] = copied
+        for name, val in self.__dict__.items():
+            setattr(copied, name, deepcopy(val, memo))
+        return copied
+
     @classmethod
     def is_subtype(cls, t1, t2):
+        metrics.count("is_subtype")
 
         if isinstance(t1, str) or isinstance(t2, str):
             return t1 == t2
@@ -116,6 +129,8 @@ class Type:
             if not cls.is_subtype(self_ret_t, other_ret_t):
                 return False
 
+            if t1.variadic != t2.variadic:
+                return False
             assert (len(self_args_t) == len(other_args_t))
             for s_arg_t, o_arg_t in zip(self_args_t, other_args_t):
                 if not cls.is_subtype(o_arg_t, s_arg_t):
@@ -132,9 +147,25 @@ class Type:
 
 
 class FunType(Type):
-    def __init__(self, mod: Tmod, retT: Type, argTs, borrow_parent: Type = None):
+    def __init__(self, mod: Tmod, retT: Type, argTs, borrow_parent: Type = None, variadic: bool = False):
+        """
+        :param variadic: The last argument type may be repeated any number of times (including none)
+        """
         super().__init__(category=Tcat.fun, mod=mod, args=(retT, argTs,),
                          borrow_parent=borrow_parent)
+        self.variadic = variadic
+
+    def expected_argTs(self, n_args: int) -> Tuple[Type]:
+        """
+        The types of the arguments for a call with n_args arguments. For variadic functions this can be more or less
+        than argTs; if n_args is too few for the function, the result doesn't have n_args types
+        """
+        if not self.variadic or n_args < len(self.argTs) - 1:
+            return self.argTs
+        return self.argTs[:-1] + (self.argTs[-1],) * (n_args - len(self.argTs) + 1)
+
+    def eq_ignore_oship(self, other) -> bool:
+        return super().eq_ignore_oship(other) and self.variadic == getattr(other, "variadic", False)
 
     @property
     def retT(self,) -> Type:
@@ -153,6 +184,10 @@ class ValType(Type):
         super().__init__(mod=mod, category=Tcat.val, args=tname,
                          borrow_parent=borrow_parent)
 
+    @property
+    def tname(self) -> str:
+        return self._type_args
+
     def __repr__(self):
         return f'({self._mod} {self._type_args})'
 
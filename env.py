@@ -1,6 +1,8 @@
-from typing import Any
+from collections import ChainMap
+from typing import Any, Mapping
 from typing import Tuple
 import dsl_types as dslT
+import metrics
 import typecheck_errors as tc_err
 from copy import deepcopy
 from typing import Union
@@ -22,17 +24,35 @@ class Env:
     the interpreter will map them to actual values.
     """
 
-    def __init__(self, *, defaults=None, outer=None):
+    def __init__(self, *, defaults=None, outer=None, shared_functions: Mapping = None):
+        """
+        :param defaults: Functions to copy into this environment
+        :param shared_functions: Functions to make visible in this environment without copying them. Functions defined
+        here go into a separate table in front of them, so shared_functions is never modified
+        """
 
         if outer is not None:
             assert isinstance(outer, Env)
 
         self.bindings = {}
-        self.functions = {}
+        self.functions = {} if shared_functions is None else ChainMap({}, shared_functions)
         self.outer = outer
         self.allocated = True
-        for k in (defaults or []):
-            self.define_fun(k, defaults[k])
+        # The outermost environment of the chain. Its fun_epoch is bumped by every define_fun anywhere in the tree of
+        # environments below it, so that anything remembering where a function name resolved to within the tree
+        # knows when it might have to look again
+        self.root = self if outer is None else outer.root
+        if outer is None:
+            self.fun_epoch = 0
+        # What fun_scope last found, and the root's fun_epoch at the time
+        self._fun_scope = None
+        self._fun_scope_epoch = -1
+        if defaults and outer is None and shared_functions is None:
+            # Nothing for the defaults to clash with (and they don't define anything new), so skip define_fun
+            self.functions.update(defaults)
+        else:
+            for k in (defaults or []):
+                self.define_fun(k, defaults[k])
 
     def __eq__(self, other):
 
@@ -63,23 +83,31 @@ class Env:
         return id(self)
 
     @_requires_allocated
+    def _defining_env(self, name: str, table: str) -> Union[None, 'Env']:
+        """
+        The innermost environment in the chain with name in the given table, or None if there isn't one. A loop rather
+        than recursion, so that chains of any length can be searched
+        :param table: "bindings" or "functions"
+        """
+        env = self
+        while name not in getattr(env, table):
+            env = env.outer
+            if env is None:
+                return None
+            elif not env.allocated:
+                raise tc_err.DeallocatedEnvError
+        return env
+
     def contains_bind(self, name: str) -> bool:
         """
         Check if the current env or any of its parents have a binding for name
         :param name:
         :return:
         """
-        if name in self.bindings:
-            return True
-        else:
-            return (self.outer is not None) and self.outer.contains_bind(name)
+        return self._defining_env(name, "bindings") is not None
 
-    @_requires_allocated
     def contains_fun(self, name: str) -> bool:
-        if name in self.functions.keys():
-            return True
-        else:
-            return (self.outer is not None) and self.outer.contains_fun(name)
+        return self._defining_env(name, "functions") is not None
 
     @_requires_allocated
     def define_bind(self, name: str, val: Any) -> None:
@@ -99,12 +127,25 @@ class Env:
         if self.contains_fun(name):
             raise tc_err.BindingRedefinitionError(f"Attempting to redefine {name}")
         self.functions[name] = val
+        self.root.fun_epoch += 1
+
+    def fun_scope(self) -> 'Env':
+        """
+        The innermost environment in the chain (this one included) which has functions of its own, or else the
+        outermost. Every function name resolves the same here as it does there
+        """
+        root = self.root
+        if self._fun_scope_epoch != root.fun_epoch:
+            env = self
+            while env.outer is not None and not env.functions:
+                env = env.outer
+            self._fun_scope, self._fun_scope_epoch = env, root.fun_epoch
+        return self._fun_scope
 
     @_requires_allocated
     def get_toplevel_binds(self, ) -> Tuple:
         return tuple([name for name in self.bindings])
 
-    @_requires_allocated
     def get_bind(self, name: str) -> Tuple[Any, Any]:
         """
         Get a tuple (val, defining_env) given the name of a binding. defining_env is either the current Env or one
@@ -112,23 +153,16 @@ class Env:
         :param name:
         :return:
         """
-        if not self.contains_bind(name):
+        env = self._defining_env(name, "bindings")
+        if env is None:
             raise tc_err.BindingUndefinedError(f'{name} is undefined')
-        else:
-            if name in self.bindings:
-                return self.bindings[name]
-            else:
-                return self.outer.get_bind(name)
+        return env.bindings[name]
 
-    @_requires_allocated
     def get_fun_def(self, name: str) -> Any:
-        if not self.contains_fun(name):
+        env = self._defining_env(name, "functions")
+        if env is None:
             raise tc_err.BindingUndefinedError(f'{name} is undefined')
-        else:
-            if name in self.functions:
-                return self.functions[name]
-            else:
-                return self.outer.get_fun_def(name)
+        return env.functions[name]
 
     @_requires_allocated
     def get_bind_val(self, name: str) -> Any:
@@ -147,14 +181,40 @@ class Env:
 
 class TypeCheckEnv(Env):
     """
-    Just a regular old environment, but with Type annotations everywhere so that Pycharm can correctly hint it
+    Just a regular old environment, but with Type annotations everywhere so that Pycharm can correctly hint it.
+
+    Instead of being copied to check alternatives (such as the branches of an if) against, a chain of TypeCheckEnvs
+    can keep a Journal of what each binding (and the Types in it) looked like before it was first touched, so that the
+    changes can be compared and undone afterwards. That costs in proportion to what the alternative touches, rather
+    than to the size of the whole chain.
     """
     def __init__(self, defaults=None, outer=None):
         if outer is not None:
             assert isinstance(outer, TypeCheckEnv)
+        # The journals recording changes to this chain, innermost last
+        self._journals = [] if outer is None else outer._journals
         super().__init__(defaults=defaults, outer=outer)
 
+    def begin_journal(self) -> 'Journal':
+        """
+        Start recording changes to this chain. Journals nest, and each must be ended (by end_journal) in turn. Only the
+        innermost journal records anything, and hands what it recorded on to the next one out when it ends
+        """
+        metrics.count("env_journal")
+        journal = Journal()
+        self._journals.append(journal)
+        return journal
+
+    def end_journal(self, journal: 'Journal') -> None:
+        if not self._journals or self._journals[-1] is not journal:
+            raise RuntimeError("Journals must be ended innermost first")
+        self._journals.pop()
+        if self._journals:
+            self._journals[-1].absorb(journal)
+
     def deallocate(self,):
+        if self._journals:
+            self._journals[-1].note_deallocate(self)
 
         ######################################
         # Check for unused linear judgements #
@@ -180,10 +240,23 @@ class TypeCheckEnv(Env):
         super().deallocate()
 
     def define_bind(self, name: str, val: dslT.Type) -> None:
+        if self._journals and not self.contains_bind(name):
+            self._journals[-1].note_define(self.bindings, name)
         return super().define_bind(name=name, val=val)
 
+    def define_fun(self, name: str, val: Any) -> None:
+        if self._journals and not self.contains_fun(name):
+            self._journals[-1].note_define(self.functions, name)
+        return super().define_fun(name, val)
+
     def get_bind(self, name: str) -> Tuple[dslT.Type, Env]:
-        return super().get_bind(name=name)
+        env = self._defining_env(name, "bindings")
+        if env is None:
+            raise tc_err.BindingUndefinedError(f'{name} is undefined')
+        if self._journals:
+            # Whoever asked for the binding may be about to change it
+            self._journals[-1].note_bind(env, name)
+        return env.bindings[name]
 
     def get_bind_val(self, name: str) -> dslT.Type:
         return super().get_bind_val(name=name)
@@ -192,7 +265,118 @@ class TypeCheckEnv(Env):
         return super().set_bind_val(name=name, val=val)
 
 
+class Journal:
+    """
+    What the bindings touched in a TypeCheckEnv chain (and the Types reachable from them) looked like before they were
+    first touched since the journal was started, or last rolled back. Bindings defined since then are only recorded so
+    that they can be removed again.
+    """
+    def __init__(self):
+        # (key, undo function, *its args), where key is what was changed (or None if it can't be told apart)
+        self._undo = []
+        self._seen = set()
+        # (id(env.bindings), name) -> (env, name, type_state of the value before it was touched)
+        self.before = {}
+
+    def note_bind(self, env: Env, name: str) -> None:
+        key = (id(env.bindings), name)
+        if key in self._seen:
+            return
+        self._seen.add(key)
+        entry = env.bindings[name]
+        self._undo.append((key, _restore_binding, env, name, entry))
+        self.before[key] = env, name, type_state(entry[0])
+        self._note_types(entry[0])
+
+    def note_define(self, table: dict, name: str) -> None:
+        # Nothing about a binding defined while journaling needs comparing, only removing
+        key = (id(table), name)
+        self._seen.add(key)
+        self._undo.append((key, _forget, table, name))
+
+    def note_deallocate(self, env: Env) -> None:
+        self._undo.append((None, _restore_allocated, env, env.allocated))
+
+    def _note_types(self, val) -> None:
+        pending = [val]
+        while pending:
+            val = pending.pop()
+            if isinstance(val, (tuple, list)):
+                pending.extend(val)
+            elif isinstance(val, dslT.Type) and id(val) not in self._seen:
+                self._seen.add(id(val))
+                self._undo.append((id(val), _restore_type, val, dict(val.__dict__)))
+                pending.append(val._type_args)
+                pending.append(val.borrow_parent)
+
+    def absorb(self, inner: 'Journal') -> None:
+        """
+        Take over what inner (which was started after this journal, and has now ended) recorded, apart from whatever
+        this journal had already recorded an earlier state of
+        """
+        seen = self._seen
+        for undo in inner._undo:
+            key = undo[0]
+            if key is None or key not in seen:
+                self._undo.append(undo)
+        for key, before in inner.before.items():
+            if key not in seen:
+                self.before[key] = before
+        seen.update(inner._seen)
+
+    def states(self) -> dict:
+        """
+        (id(env.bindings), name) -> (state before, state now) of each binding touched
+        """
+        return {key: (before, type_state(env.bindings[name][0])) for key, (env, name, before) in self.before.items()}
+
+    def changed(self) -> bool:
+        return any(before != now for before, now in self.states().values())
+
+    def rollback(self) -> None:
+        """
+        Undo every change recorded, and start recording afresh
+        """
+        for undo in reversed(self._undo):
+            undo[1](*undo[2:])
+        self._undo.clear()
+        self._seen.clear()
+        self.before.clear()
+
+
+def _restore_binding(env: Env, name: str, entry) -> None:
+    env.bindings[name] = entry
+
+
+def _forget(table: dict, name: str) -> None:
+    table.pop(name, None)
+
+
+def _restore_allocated(env: Env, allocated: bool) -> None:
+    env.allocated = allocated
+
+
+def _restore_type(t: dslT.Type, attrs: dict) -> None:
+    t.__dict__.clear()
+    t.__dict__.update(attrs)
+
+
+def type_state(val):
+    """
+    Everything which Type.__eq__ compares about val, as plain values
+    """
+    if isinstance(val, dslT.FunType):
+        return val._mod, val._category, type_state(val._type_args), val._ownership, val.variadic
+    elif isinstance(val, dslT.Type):
+        return val._mod, val._category, type_state(val._type_args), val._ownership
+    elif isinstance(val, (tuple, list)):
+        return tuple(type_state(v) for v in val)
+    return val
+
+
 def deepcopy_env(env: Env,) -> Env:
+    metrics.count("deepcopy_env")
+
     def __deepcopy_env(env: Env, *, env2copy: dict = None) -> Union[None, Env]:
 
         if env is None:
@@ -1,25 +1,199 @@
+import importlib
+import time
+from collections import ChainMap, OrderedDict
+
+import metrics
 from env import Env
+from counting_loops import CountingLoop, match_counting_loop
+from dsl_parser import Literal, atom
 from language import *
+from typecheck_errors import BindingUndefinedError
+
+# How many apply sites to remember the resolved function of
+APPLY_CACHE_SIZE = 4096
+# id of apply form -> (apply form, function table, fun_epoch, resolved function). See apply_site_key
+_apply_cache = {}
+
+
+# How many times a Procedure is called before the jit module tries to compile its body to Python. Off (None) unless
+# asked for, since the jit module only compiles a subset of the language
+JIT_THRESHOLD = None
+
+# Whether to run while loops recognized by counting_loops as Python range loops
+COUNTING_LOOPS = True
+LOOP_CACHE_SIZE = 1024
+# id of while form -> (while form, its CountingLoop or None)
+_loop_cache = {}
 
 
 class Procedure:
-    def __init__(self, defaults, argspec_ls, fn_body):
+    def __init__(self, defaults, argspec_ls, fn_body, name: str = None):
         self.argspec_ls = argspec_ls
         self.fn_body = fn_body
         self.defaults = defaults
+        self.name = name
+        # Only set (by enable_memo) for procedures known to be pure. Calls to a memoized procedure always go through
+        # __call__, so they're never made as TailCalls
+        self.memo = None
+        # Set once the body has been compiled by the jit module
+        self.calls = 0
+        self.jit_code = None
 
     def __call__(self, *argvals):
+        if self.memo is not None:
+            return self.memo.call(self.run, argvals)
+        return self.run(argvals)
+
+    def __getstate__(self):
+        # Compiled code can't be pickled, so a procedure loaded from a checkpoint starts counting towards it again
+        state = dict(self.__dict__)
+        state.pop("jit_source", None)
+        state["calls"], state["jit_code"] = 0, None
+        return state
+
+    def enable_memo(self, max_size: int) -> 'Memo':
+        """
+        Remember the results of calls to this procedure. Only valid if it's pure!
+        """
+        self.memo = Memo(max_size)
+        # Compiled code may call itself directly, so it has to be compiled again with the memo in mind
+        self.calls, self.jit_code = 0, None
+        return self.memo
+
+    def run(self, argvals):
+        # Calls in tail position come back as TailCalls rather than being made, so that they can be run here without
+        # growing the Python stack
+        if JIT_THRESHOLD is not None:
+            return self._run_counting(argvals)
+        proc = self
+        while True:
+            code = proc.jit_code
+            if code is not None:
+                if len(argvals) != len(proc.argspec_ls):
+                    raise RuntimeError("Mismatch between number of arguments required and number of arguments given")
+                ret = code(*argvals)
+            else:
+                ret = eval_form(proc.make_frame(argvals), proc.fn_body, tail=True)
+            if ret.__class__ is not TailCall:
+                return ret
+            proc, argvals = ret.proc, ret.argvals
+
+    def _run_counting(self, argvals):
+        # The same as run, but counting calls so that hot procedures can be handed to the jit module
+        proc = self
+        while True:
+            code = proc.jit_code
+            if code is None:
+                proc.calls += 1
+                if proc.calls == JIT_THRESHOLD and proc.__class__ is Procedure:
+                    importlib.import_module("jit").compile_procedure(proc)
+                    code = proc.jit_code
+            if code is not None:
+                if len(argvals) != len(proc.argspec_ls):
+                    raise RuntimeError("Mismatch between number of arguments required and number of arguments given")
+                ret = code(*argvals)
+            else:
+                ret = eval_form(proc.make_frame(argvals), proc.fn_body, tail=True)
+            if ret.__class__ is not TailCall:
+                return ret
+            proc, argvals = ret.proc, ret.argvals
+
+    def make_frame(self, argvals) -> Env:
+        """
+        Create the environment which the body of a call runs in, with all of the arguments bound
+        """
         if len(argvals) != len(self.argspec_ls):
             raise RuntimeError("Mismatch between number of arguments required and number of arguments given")
-        env = Env(defaults=self.defaults)
+        env = Env(shared_functions=self.defaults)
         for argspec, val in zip(self.argspec_ls, argvals):
             name, arg_type = argspec
             env.define_bind(name, arg_type)
             env.set_bind_val(name, val)
-        return eval_form(env, self.fn_body)
+        return env
+
+
+class Memo:
+    """
+    The results of previous calls to a procedure, keyed by the arguments and their classes (since 1, 1.0 and True are
+    equal, but shouldn't give equal results). Holds at most max_size results, evicting the least recently used one when
+    full.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def call(self, run, argvals):
+        key = tuple((a.__class__, a) for a in argvals)
+        try:
+            ret = self.entries[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable arguments can't be remembered
+            return run(argvals)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return ret
+
+        self.misses += 1
+        ret = run(argvals)
+        self.entries[key] = ret
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return ret
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits = self.misses = 0
 
 
-def eval_form(base_env: Env, prog):
+class TailCall:
+    """
+    A call to a Procedure which was in tail position, and so is left for the caller's Procedure.run to make
+    """
+    __slots__ = ('proc', 'argvals')
+
+    def __init__(self, proc: Procedure, argvals):
+        self.proc = proc
+        self.argvals = argvals
+
+
+def resolve_fun(env: Env, name: str):
+    """
+    Look up what name refers to from env, for an apply site whose cache entry can't be used
+    """
+    return env.get_fun_def(name)
+
+
+def apply_site_key(env: Env):
+    """
+    Where function names resolve from env, as a function table and a fun_epoch, such that names resolve the same from
+    every environment with the same key. Environments are left out, so that the apply cache doesn't keep them alive.
+    """
+    scope = env.fun_scope()
+    functions = scope.functions
+    if scope.outer is not None:
+        # Names this table doesn't have are looked for further out, where there may be new definitions by now
+        return functions, scope.root.fun_epoch
+    # A table with nothing further out only ever gains names which weren't in it before, so whatever was found in it
+    # stays found. Procedure frames which haven't defined anything of their own are keyed by the table they share, so
+    # that every call to a procedure has the same key
+    if functions.__class__ is ChainMap and len(functions.maps) == 2 and not functions.maps[0]:
+        functions = functions.maps[1]
+    return functions, None
+
+
+def eval_form(base_env: Env, prog, tail: bool = False):
+    """
+    :param tail: Whether prog is in tail position in the body of a Procedure. If so, and it's an apply of another
+    Procedure, then a TailCall is returned instead of the result of the call.
+    """
 
     #################################################################################################
     # Defining the macro functions here is the only nice way to allow them to be mutually recursive #
@@ -31,7 +205,7 @@ def eval_form(base_env: Env, prog):
         return None
 
     def eval_defun(env: Env, fname, fun_ret_t, argspec_list, *fn_body):
-        env.define_fun(fname, Procedure(base_env.functions, argspec_list, fn_body))
+        env.define_fun(fname, Procedure(base_env.functions, argspec_list, fn_body, name=fname))
         return None
 
     def eval_set(env: Env, var_name, val_prog):
@@ -41,10 +215,23 @@ def eval_form(base_env: Env, prog):
 
     def eval_apply(env: Env, fun_name, *arg_list):
         eval_args = [eval_form(env, arg) for arg in arg_list]
-        return env.get_fun_def(fun_name)(*eval_args)
+        # If the name resolves from the same place as when this site was last run, it resolves to the same function
+        functions, epoch = apply_site_key(env)
+        entry = _apply_cache.get(id(prog))
+        if entry is not None and entry[0] is prog and entry[1] is functions and entry[2] == epoch and env.allocated:
+            fn = entry[3]
+        else:
+            fn = resolve_fun(env, fun_name)
+            if entry is None and len(_apply_cache) >= APPLY_CACHE_SIZE:
+                # Make room by forgetting the site which was added first
+                del _apply_cache[next(iter(_apply_cache))]
+            _apply_cache[id(prog)] = prog, functions, epoch, fn
+        if tail and fn.__class__ is Procedure and fn.memo is None:
+            return TailCall(fn, eval_args)
+        return fn(*eval_args)
 
     def eval_scope(env: Env, *prog):
-        return evaluate(Env(outer=env), prog)
+        return eval_form(Env(outer=env), prog, tail=tail)
 
     def eval_if(env: Env, test, then_c, else_c, ):
         """
@@ -54,9 +241,9 @@ def eval_form(base_env: Env, prog):
         inner_env = Env(outer=env)
 
         if test_result:
-            ret = eval_form(inner_env, then_c)
+            ret = eval_form(inner_env, then_c, tail=tail)
         else:
-            ret = eval_form(inner_env, else_c)
+            ret = eval_form(inner_env, else_c, tail=tail)
         inner_env.deallocate()
 
         return ret
@@ -67,7 +254,21 @@ def eval_form(base_env: Env, prog):
         return_default = True
         ret = None
 
-        while True:
+        finished = False
+
+        loop = counting_loop(prog) if COUNTING_LOOPS else None
+        counted = None if loop is None else run_counting_loop(loop, inner_env)
+        if counted is not None:
+            ran, ret, pending = counted
+            return_default = not ran
+            if pending is None:
+                finished = True
+            else:
+                # Finish off the iteration the loop was handed back in the middle of
+                for form in pending:
+                    ret = eval_form(inner_env, form)
+
+        while not finished:
             test_result = eval_form(inner_env, test_c)
             if test_result:
                 return_default = False
@@ -122,22 +323,17 @@ def eval_form(base_env: Env, prog):
     ############################################
 
     if isinstance(prog, str):
-        if prog == "true":
-            return True
-        elif prog == "false":
-            return False
-        elif prog == "nil":
-            return None
+        # The parser has already told constants apart from symbols
+        if prog.__class__ is Literal:
+            return prog.value
         try:
-            return int(prog)
-        except ValueError:
-            pass
-        try:
-            return float(prog)
-        except ValueError:
-            pass
-
-        return base_env.get_bind_val(prog)
+            return base_env.get_bind_val(prog)
+        except BindingUndefinedError:
+            # Programs built by hand rather than parsed may spell constants as plain strs
+            lit = atom(prog)
+            if lit.__class__ is not Literal:
+                raise
+            return lit.value
     else:
         if len(prog) == 0:
             return T_NIL
@@ -147,11 +343,93 @@ def eval_form(base_env: Env, prog):
             if first_element in macro_evaluators:
                 return macro_evaluators[first_element](base_env, *prog[1:])
             else:
-                ret = None
-                for subprog in prog:
-                    ret = eval_form(base_env, subprog)
-                return ret
+                for subprog in prog[:-1]:
+                    eval_form(base_env, subprog)
+                return eval_form(base_env, prog[-1], tail=tail)
+
+
+def counting_loop(prog):
+    """
+    The CountingLoop of a while form, or None if it isn't one
+    """
+    entry = _loop_cache.get(id(prog))
+    if entry is not None and entry[0] is prog:
+        return entry[1]
+    loop = match_counting_loop(prog)
+    if len(_loop_cache) >= LOOP_CACHE_SIZE:
+        _loop_cache.clear()
+    _loop_cache[id(prog)] = prog, loop
+    return loop
+
+
+def run_counting_loop(loop: CountingLoop, inner_env: Env):
+    """
+    Run a counting loop over a range, for as long as it really is one
+    :param inner_env: The environment the loop's test and body are evaluated in
+    :return: None if the loop can't be run as a range at all. Otherwise whether the body ran, the value it last
+    evaluated to, and either None if the loop has finished, or the forms which are left to run of the current iteration
+    if the body changed something the range depends on (after which the loop has to be run by evaluating its test)
+    """
+    var, bound = loop.var, loop.bound
+    if not inner_env.contains_bind(var) or (loop.bound.__class__ is not int and not inner_env.contains_bind(bound)):
+        return None
+    if not (inner_env.contains_fun(loop.test_op) and inner_env.get_fun_def(loop.test_op) is builtin_fn_vals[loop.test_op]
+            and inner_env.contains_fun("+") and inner_env.get_fun_def("+") is builtin_fn_vals["+"]):
+        return None
+
+    current, var_env = inner_env.get_bind(var)
+    var_bindings = var_env.bindings
+    if bound.__class__ is int:
+        bound_val, bound_bindings = bound, None
+    else:
+        bound_val, bound_env = inner_env.get_bind(bound)
+        bound_bindings = bound_env.bindings
+    if current.__class__ is not int or bound_val.__class__ is not int:
+        return None
+
+    step, rest, incr_first = loop.step, loop.rest, loop.incr_first
+    stop = bound_val + 1 if loop.test_op == "<=" else bound_val
+    root = inner_env.root
+    epoch = root.fun_epoch
+    ran, ret = False, None
+    for k in range(current, stop, step):
+        ran = True
+        if incr_first:
+            current = k + step
+            var_bindings[var] = current, var_env
+        ret = None
+        for form in rest:
+            ret = eval_form(inner_env, form)
+        # Anything which touched the variable, the bound or a function name has to be seen by the test
+        if var_bindings[var][0] is not current or root.fun_epoch != epoch \
+                or (bound_bindings is not None and bound_bindings[bound][0] is not bound_val):
+            return ran, ret, () if incr_first else (loop.incr,)
+        if not incr_first:
+            current = k + step
+            var_bindings[var] = current, var_env
+            ret = None
+    return ran, ret, None
+
+
+# Alternative evaluation engines live in their own modules (which import this one), so load them on first use
+engine_modules = {
+    "closure": "closure_compiler",
+    "vm": "vm",
+    "stack": "stack_eval",
+}
 
 
-def evaluate(env, prog):
-    return eval_form(env, prog)
\ No newline at end of file
+def evaluate(env, prog, engine: str = "tree"):
+    """
+    Evaluate prog in env
+    :param engine: "tree" to walk the AST directly, or the name of one of the engines in engine_modules
+    """
+    if engine != "tree" and engine not in engine_modules:
+        raise ValueError(f"Unknown evaluation engine {engine}: should be one of {['tree'] + list(engine_modules)}")
+    start = time.perf_counter()
+    try:
+        if engine == "tree":
+            return eval_form(env, prog)
+        return importlib.import_module(engine_modules[engine]).evaluate(env, prog)
+    finally:
+        metrics.observe("eval", time.perf_counter() - start)
\ No newline at end of file
@@ -0,0 +1,363 @@
+"""
+Compiles the bodies of hot Procedures to Python functions.
+
+Off unless interpreter.JIT_THRESHOLD is set. Procedure.run then counts the calls to each procedure, and once one has
+been called interpreter.JIT_THRESHOLD times its body is translated into Python source and compiled with compile().
+Arguments and variables become Python locals, calls to the arithmetic / comparison / logical builtins become
+operators, and calls in tail position to the procedure itself become a jump back to the top of the function. Anything
+else in tail position is handed back to Procedure.run as a TailCall, exactly as the tree-walker does.
+
+Only bodies whose behaviour can be reproduced exactly are compiled: ones which don't use references, don't define
+functions, only refer to variables and functions which are certainly defined, and don't defvar anything which could
+be defined already. Everything else stays in the tree-walker. Use source_of (or dump) to see the generated code.
+"""
+
+import keyword
+import re
+from typing import Optional
+
+import language as lang
+from dsl_parser import Literal, atom
+from env import Env
+from interpreter import Procedure, TailCall
+from typecheck_errors import DeallocatedEnvError
+
+# How calls to each builtin are written when the name really does resolve to that builtin
+operators = {
+    '+': '({} + {})', '-': '({} - {})', '*': '({} * {})', '/': '({} / {})',
+    '>': '({} > {})', '<': '({} < {})', '>=': '({} >= {})', '<=': '({} <= {})', '=': '({} == {})',
+    'or': '({} | {})', 'and': '({} & {})', 'not': '(not {})',
+}
+
+unsupported_macros = frozenset(["defun", "mkref", "setref", "deref", "setrefval"])
+# The number of operands each macro takes. Malformed forms are left for the tree-walker to complain about
+arities = {"defvar": 3, "set": 2, "if": 3, "while": 3}
+
+
+class CannotCompile(Exception):
+    pass
+
+
+def compile_procedure(proc: Procedure, name: str = None) -> bool:
+    """
+    Try to compile the body of proc, setting proc.jit_code and proc.jit_source if it can be done
+    :param name: What to call the generated function (only used to make the source more readable)
+    :return: Whether the body was compiled
+    """
+    try:
+        source, namespace = Translator(proc, name).translate()
+    except CannotCompile:
+        return False
+    code = compile(source, f'<jit {namespace["_name"]}>', 'exec')
+    exec(code, namespace)
+    fn = namespace[namespace["_name"]]
+    namespace["_self_call"] = proc if namespace["_needs_trampoline"] or proc.memo is not None else fn
+    proc.jit_source = source
+    proc.jit_code = fn
+    return True
+
+
+def source_of(proc: Procedure) -> Optional[str]:
+    """
+    The Python source which proc's body was compiled to, or None if it hasn't been
+    """
+    return getattr(proc, 'jit_source', None)
+
+
+def dump(env: Env) -> str:
+    """
+    The generated source of every compiled procedure defined directly in env
+    """
+    return '\n'.join(source_of(fn) for fn in env.functions.values()
+                     if isinstance(fn, Procedure) and source_of(fn) is not None)
+
+
+class Translator:
+    def __init__(self, proc: Procedure, name: str = None):
+        self.proc = proc
+        self.name = _identifier(name or proc.name or 'procedure')
+        self.lines = []
+        self.namespace = {"TailCall": TailCall, "DeallocatedEnvError": DeallocatedEnvError, "_name": self.name}
+        self.const_names = {}
+        self.counter = 0
+        # Maps from DSL variable names to Python locals, innermost scope last
+        self.scopes = []
+        self.has_self_jump = False
+        self.needs_trampoline = False
+
+    def translate(self):
+        arg_names = [name for name, _ in self.proc.argspec_ls]
+        if len(set(arg_names)) != len(arg_names):
+            # Binding the arguments raises an error, which the tree-walker should be left to raise
+            raise CannotCompile
+        # Arguments live in the same scope as the body's own variables
+        self.params = [self.fresh('a') for _ in arg_names]
+        self.scopes.append(dict(zip(arg_names, self.params)))
+
+        self.compile_tail(self.proc.fn_body, 2)
+        body = self.lines
+        if self.has_self_jump:
+            header = ['    while True:']
+        else:
+            header = []
+            body = [line[4:] for line in body]
+
+        self.namespace["_needs_trampoline"] = self.needs_trampoline
+        source = '\n'.join([f'def {self.name}({", ".join(self.params)}):'] + header + body) + '\n'
+        return source, self.namespace
+
+    ###########
+    # Helpers #
+    ###########
+
+    def fresh(self, prefix: str) -> str:
+        self.counter += 1
+        return f'{prefix}{self.counter}'
+
+    def emit(self, indent: int, line: str) -> None:
+        self.lines.append('    ' * indent + line)
+
+    def const(self, obj) -> str:
+        if id(obj) not in self.const_names:
+            name = self.fresh('_c')
+            self.const_names[id(obj)] = name
+            self.namespace[name] = obj
+        return self.const_names[id(obj)]
+
+    def literal(self, value) -> str:
+        if value is None or isinstance(value, (bool, int)):
+            return repr(value)
+        return self.const(value)
+
+    def lookup(self, name) -> str:
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        # Not certainly defined at this point, so the tree-walker should be left to raise the error (or not)
+        raise CannotCompile
+
+    def is_visible(self, name) -> bool:
+        return any(name in scope for scope in self.scopes)
+
+    def function(self, fname):
+        fn = self.proc.defaults.get(fname)
+        if fn is None:
+            raise CannotCompile
+        return fn
+
+    def compile_args(self, arg_progs, indent: int):
+        """
+        Compile arguments so that they're still evaluated left to right, even if some of them need statements
+        """
+        compiled = []
+        for arg in arg_progs:
+            start = len(self.lines)
+            expr = self.compile_expr(arg, indent)
+            if len(self.lines) != start:
+                # Evaluate everything before this argument first
+                for i, earlier in enumerate(compiled):
+                    if not _is_constant(earlier):
+                        tmp = self.fresh('t')
+                        self.lines.insert(start, '    ' * indent + f'{tmp} = {earlier}')
+                        start += 1
+                        compiled[i] = tmp
+            compiled.append(expr)
+        return compiled
+
+    ##################################
+    # Forms in tail position: these  #
+    # emit a return (or jump)        #
+    ##################################
+
+    def compile_tail(self, prog, indent: int) -> None:
+        if isinstance(prog, tuple) and len(prog) > 0 and prog[0] not in unsupported_macros:
+            head = prog[0]
+            if head == "if" and len(prog) == 4:
+                test = self.compile_expr(prog[1], indent)
+                self.emit(indent, f'if {test}:')
+                self.compile_branch(prog[2], indent + 1, tail=True)
+                self.emit(indent, 'else:')
+                self.compile_branch(prog[3], indent + 1, tail=True)
+                return
+            elif head == "scope":
+                self.scopes.append({})
+                self.compile_tail(prog[1:], indent)
+                self.scopes.pop()
+                return
+            elif head == "apply" and len(prog) >= 2:
+                fn = self.function(prog[1])
+                if fn.__class__ is Procedure:
+                    self.compile_tail_call(fn, prog[2:], indent)
+                    return
+            elif head not in ("defvar", "set", "apply", "if", "while"):
+                # A sequence: only the last form is in tail position
+                for subprog in prog[:-1]:
+                    self.compile_statement(subprog, indent)
+                self.compile_tail(prog[-1], indent)
+                return
+
+        self.emit(indent, f'return {self.compile_expr(prog, indent)}')
+
+    def compile_tail_call(self, fn: Procedure, arg_progs, indent: int) -> None:
+        args = self.compile_args(arg_progs, indent)
+        if fn is self.proc and self.proc.memo is None and len(args) == len(self.proc.argspec_ls):
+            self.has_self_jump = True
+            if args:
+                self.emit(indent, f'{", ".join(self.params)} = {", ".join(args)}{"," if len(args) == 1 else ""}')
+            self.emit(indent, 'continue')
+        else:
+            self.needs_trampoline = True
+            f = self.const(fn)
+            self.emit(indent, f'if {f}.memo is None:')
+            self.emit(indent + 1, f'return TailCall({f}, [{", ".join(args)}])')
+            self.emit(indent, f'return {f}({", ".join(args)})')
+
+    def compile_branch(self, prog, indent: int, tail: bool, target: str = None) -> None:
+        # Each branch of an if gets its own scope
+        self.scopes.append({})
+        start = len(self.lines)
+        if tail:
+            self.compile_tail(prog, indent)
+        else:
+            self.emit(indent, f'{target} = {self.compile_expr(prog, indent)}')
+        if len(self.lines) == start:
+            self.emit(indent, 'pass')
+        self.scopes.pop()
+
+    ###########################################
+    # Everything else: these return a Python  #
+    # expression for the value of the form    #
+    ###########################################
+
+    def compile_statement(self, prog, indent: int) -> None:
+        expr = self.compile_expr(prog, indent)
+        if not _is_simple(expr):
+            self.emit(indent, expr)
+
+    def compile_expr(self, prog, indent: int) -> str:
+        if isinstance(prog, str):
+            # Programs built by hand rather than parsed may spell constants as plain strs
+            prog = atom(prog)
+            if prog.__class__ is Literal:
+                return self.literal(prog.value)
+            return self.lookup(prog)
+        if len(prog) == 0:
+            return self.const(lang.T_NIL)
+
+        head, args = prog[0], prog[1:]
+        if head in unsupported_macros or len(args) != arities.get(head, len(args)) or (head == "apply" and not args):
+            raise CannotCompile
+        elif head == "defvar":
+            name, _, init_prog = args
+            init = self.compile_expr(init_prog, indent)
+            if self.is_visible(name):
+                raise CannotCompile
+            local = self.fresh('v')
+            self.emit(indent, f'{local} = {init}')
+            self.scopes[-1][name] = local
+            return 'None'
+        elif head == "set":
+            name, val_prog = args
+            val = self.compile_expr(val_prog, indent)
+            self.emit(indent, f'{self.lookup(name)} = {val}')
+            return 'None'
+        elif head == "apply":
+            fname, arg_progs = args[0], args[1:]
+            fn = self.function(fname)
+            compiled = self.compile_args(arg_progs, indent)
+            if fname in operators and fn is lang.builtin_fn_vals.get(fname) \
+                    and operators[fname].count('{}') == len(compiled):
+                return operators[fname].format(*compiled)
+            # A call to itself can skip Procedure.__call__, unless it has to be left to raise the arity error
+            if fn is self.proc and len(compiled) == len(self.proc.argspec_ls):
+                callee = '_self_call'
+            else:
+                callee = self.const(fn)
+            return f'{callee}({", ".join(compiled)})'
+        elif head == "if":
+            test_prog, then_c, else_c = args
+            test = self.compile_expr(test_prog, indent)
+            ret = self.fresh('t')
+            self.emit(indent, f'if {test}:')
+            self.compile_branch(then_c, indent + 1, tail=False, target=ret)
+            self.emit(indent, 'else:')
+            self.compile_branch(else_c, indent + 1, tail=False, target=ret)
+            return ret
+        elif head == "scope":
+            self.scopes.append({})
+            ret = self.compile_expr(args, indent)
+            self.scopes.pop()
+            return ret
+        elif head == "while":
+            return self.compile_while(indent, *args)
+        else:
+            ret = 'None'
+            for subprog in prog:
+                if not _is_simple(ret):
+                    self.emit(indent, ret)
+                ret = self.compile_expr(subprog, indent)
+            return ret
+
+    def compile_while(self, indent: int, test_c, default_c, body_c) -> str:
+        if _contains_macro(test_c, "defvar") or _contains_macro(body_c, "defvar"):
+            # The body's environment lives as long as the loop, so a defvar in it fails on the second time round
+            raise CannotCompile
+        ret, ran = self.fresh('t'), self.fresh('r')
+        self.emit(indent, f'{ran} = False')
+        self.emit(indent, 'while True:')
+        self.scopes.append({})
+        test = self.compile_expr(test_c, indent + 1)
+        self.emit(indent + 1, f'if not {test}:')
+        self.emit(indent + 2, 'break')
+        self.emit(indent + 1, f'{ret} = {self.compile_expr(body_c, indent + 1)}')
+        self.emit(indent + 1, f'{ran} = True')
+        self.scopes.pop()
+
+        # The default is evaluated in the loop's environment after it has been deallocated, so only constants get
+        # anywhere
+        self.emit(indent, f'if not {ran}:')
+        if isinstance(default_c, str) and default_c.__class__ is Literal:
+            self.emit(indent + 1, f'{ret} = {self.literal(default_c.value)}')
+        elif default_c == ():
+            self.emit(indent + 1, f'{ret} = {self.const(lang.T_NIL)}')
+        elif _fails_when_deallocated(default_c):
+            self.emit(indent + 1, 'raise DeallocatedEnvError')
+        else:
+            raise CannotCompile
+        return ret
+
+
+def _is_constant(expr: str) -> bool:
+    return re.fullmatch(r'None|True|False|-?[0-9]+|_c[0-9]+', expr) is not None
+
+
+def _is_simple(expr: str) -> bool:
+    """
+    Whether evaluating a generated expression can't have any effect (or raise)
+    """
+    return expr == 'None' or re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*|-?[0-9]+|True|False', expr) is not None
+
+
+def _identifier(name: str) -> str:
+    ident = re.sub(r'\W', '_', str(name))
+    if not ident or ident[0].isdigit() or keyword.iskeyword(ident):
+        ident = 'f_' + ident
+    return ident
+
+
+def _contains_macro(prog, macro: str) -> bool:
+    if isinstance(prog, str) or len(prog) == 0:
+        return False
+    return prog[0] == macro or any(_contains_macro(p, macro) for p in prog)
+
+
+def _fails_when_deallocated(prog) -> bool:
+    """
+    Whether evaluating prog in a deallocated environment raises before doing anything else
+    """
+    if isinstance(prog, str):
+        return atom(prog).__class__ is not Literal
+    if len(prog) > 0 and prog[0] == "apply":
+        # The arguments are evaluated before the function is looked up
+        return all((isinstance(a, str) or a == () or _fails_when_deallocated(a)) for a in prog[2:])
+    return False
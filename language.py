@@ -1,3 +1,4 @@
+import io
 import operator as op
 import dsl_types as dslT
 from dsl_types import FunType, ValType, Tmod
@@ -5,15 +6,108 @@ from dsl_types import FunType, ValType, Tmod
 MACRO_NAMES = ["defun", "defvar", "apply", "if", "while", "set", "mkref", "setref", "deref", "setrefval"]
 bool_map = {"true": True, "false": False}
 
+# How many characters fwrite holds on to before writing them to the file in one go, unless a program sets a file's own
+# with fsetbuf. 0 writes through on every call
+FILE_BUFFER_SIZE = 64 * 1024
+
+
+class OutFile:
+    """
+    What fopen returns: a file opened for writing, whose output is collected in memory and written out in bulk, once
+    buffer_size characters have built up or when the file is flushed or closed. Since files are linear, every file a
+    type-checked program opens is closed, and so everything written to it reaches the disk
+    """
+    def __init__(self, path: str, buffer_size: int = None):
+        self.path = path
+        self.buffer_size = FILE_BUFFER_SIZE if buffer_size is None else buffer_size
+        self._file = open(path, "w+")
+        self._pending = []
+        self._pending_size = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def write(self, text: str) -> None:
+        if self._file.closed:
+            raise ValueError("I/O operation on closed file.")
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= self.buffer_size:
+            self.flush()
+
+    def set_buffer_size(self, buffer_size: int) -> None:
+        if buffer_size < 0:
+            raise ValueError(f"Buffer size must be at least 0, not {buffer_size}")
+        self.buffer_size = buffer_size
+        if self._pending_size >= buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._pending:
+            self._file.write("".join(self._pending))
+            self._pending.clear()
+            self._pending_size = 0
+        self._file.flush()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __reduce__(self):
+        # Pickled (by checkpoint) as how far into which file it had got, to be opened again there
+        if self.closed:
+            return _closed_file, (self.path, self.buffer_size)
+        self.flush()
+        return _reopen_file, (self.path, self._file.tell(), self.buffer_size)
+
+    def __del__(self):
+        # Like Python's own files, don't lose what was written to a file which was never closed
+        if hasattr(self, "_file"):
+            self.close()
+
+
+def _reopen_file(path: str, offset: int, buffer_size: int) -> OutFile:
+    """
+    Open path to carry on writing at offset, dropping anything which was written after it
+    """
+    f = OutFile.__new__(OutFile)
+    f.path, f.buffer_size = path, buffer_size
+    f._pending, f._pending_size = [], 0
+    f._file = open(path, "r+")
+    f._file.seek(offset)
+    f._file.truncate()
+    return f
+
+
+def _closed_file(path: str, buffer_size: int) -> OutFile:
+    f = OutFile.__new__(OutFile)
+    f.path, f.buffer_size = path, buffer_size
+    f._pending, f._pending_size = [], 0
+    f._file = io.StringIO()
+    f._file.close()
+    return f
+
+
 builtin_fn_vals = {
     '+': op.add, '-': op.sub, '*': op.mul, '/': op.truediv,
     '>': op.gt, '<': op.lt, '>=': op.ge, '<=': op.le, '=': op.eq,
     'not': op.not_, 'or': op.or_, 'and': op.and_,
-    'fopen': lambda id: open(str(id), "w+"),
+    'fopen': lambda id: OutFile(str(id)),
     'fwrite': lambda f, out: f[1][0].write(str(out) + "\n"),
+    # Writes each of its values on a line of its own
+    'fwritev': lambda f, *outs: f[1][0].write("".join(f"{out}\n" for out in outs)),
+    # Sets how many characters the file holds on to before writing them out
+    'fsetbuf': lambda f, size: f[1][0].set_buffer_size(size),
     'fclose': lambda f: f.close(),
 }
 
+# Builtins whose results depend only on their arguments, and which have no side effects
+pure_builtins = frozenset(['+', '-', '*', '/', '>', '<', '>=', '<=', '=', 'not', 'or', 'and'])
+# Builtins which do I/O, and so may block
+io_builtins = frozenset(['fopen', 'fwrite', 'fwritev', 'fsetbuf', 'fclose'])
+
 T_NIL = ValType(mod=Tmod.un, tname='nil')
 T_UNIT = ValType(mod=Tmod.un, tname='unit')
 T_BOOL = ValType(mod=Tmod.un, tname='bool')
@@ -36,5 +130,8 @@ builtin_fn_types = {
     "fopen": FunType(mod=Tmod.un, retT=T_FILE, argTs=(T_LIN_INT,)),
     "fwrite": FunType(mod=Tmod.un, retT=T_UNIT, argTs=(dslT.RefType(mod=Tmod.un, ref_type=T_FILE),
                                                        T_LIN_INT),),
+    "fwritev": FunType(mod=Tmod.un, retT=T_UNIT, argTs=(dslT.RefType(mod=Tmod.un, ref_type=T_FILE), T_LIN_INT),
+                       variadic=True),
+    "fsetbuf": FunType(mod=Tmod.un, retT=T_UNIT, argTs=(dslT.RefType(mod=Tmod.un, ref_type=T_FILE), T_LIN_INT)),
     "fclose": FunType(mod=Tmod.un, retT=T_UNIT, argTs=(T_FILE,))
 }
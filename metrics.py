@@ -0,0 +1,149 @@
+"""
+Timers and counters for keeping an eye on where the time goes in production.
+
+The parse, check and eval phases are timed by dsl_parse / dsl_parse_stream, AffineTypeChecker.type_check and
+interpreter.evaluate themselves, and the type checker counts how many environments and types it copies, how many
+journals of changes to environments it keeps (see env.TypeCheckEnv) and how many subtype checks it makes. Anything
+else can be timed with timed() or counted with count().
+
+Everything goes to the module-level registry, which can be read in-process with snapshot(), or written to a file as
+JSON or in the Prometheus text format (for instance for node_exporter's textfile collector). Recording is a dict update
+or two, so it's meant to be left on; set enabled to False to turn it off. Updates aren't locked, so threads running at
+the same time may occasionally lose one another's counts.
+"""
+
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+# Set to False to stop recording anything
+enabled = True
+
+PHASES = ("parse", "check", "eval")
+
+
+class Timer:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def as_dict(self) -> dict:
+        return {"count": self.count, "total_seconds": self.total, "max_seconds": self.max}
+
+
+class Metrics:
+    def __init__(self):
+        self.counters: Dict[str, int] = {}
+        self.timers: Dict[str, Timer] = {}
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        timer.count += 1
+        timer.total += seconds
+        if seconds > timer.max:
+            timer.max = seconds
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.timers.clear()
+
+    def snapshot(self) -> dict:
+        return {"counters": dict(self.counters),
+                "timers": {name: timer.as_dict() for name, timer in self.timers.items()}}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix: str = "dsl") -> str:
+        """
+        Counters become <prefix>_<name>_total counters, and timers become a <prefix>_seconds summary (plus a
+        <prefix>_seconds_max gauge) labelled by name
+        """
+        lines = []
+        for name in sorted(self.counters):
+            metric = f"{prefix}_{_metric_name(name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {self.counters[name]}"]
+        if self.timers:
+            lines += [f"# TYPE {prefix}_seconds summary"]
+            for name in sorted(self.timers):
+                timer = self.timers[name]
+                lines += [f'{prefix}_seconds_count{{name="{name}"}} {timer.count}',
+                          f'{prefix}_seconds_sum{{name="{name}"}} {timer.total!r}']
+            lines += [f"# TYPE {prefix}_seconds_max gauge"]
+            for name in sorted(self.timers):
+                lines += [f'{prefix}_seconds_max{{name="{name}"}} {self.timers[name].max!r}']
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, fmt: str = "json") -> None:
+        """
+        Write the metrics to path, replacing it in one go so that readers never see half a file
+        :param fmt: "json" or "prometheus"
+        """
+        if fmt == "json":
+            text = self.to_json()
+        elif fmt == "prometheus":
+            text = self.to_prometheus()
+        else:
+            raise ValueError(f"Unknown metrics format {fmt}: should be json or prometheus")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+registry = Metrics()
+
+
+##############################################################
+# Shorthands for recording to the registry, if it's enabled  #
+##############################################################
+
+def count(name: str, n: int = 1) -> None:
+    if enabled:
+        counters = registry.counters
+        counters[name] = counters.get(name, 0) + n
+
+
+def observe(name: str, seconds: float) -> None:
+    if enabled:
+        registry.observe(name, seconds)
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def snapshot() -> dict:
+    return registry.snapshot()
+
+
+def reset() -> None:
+    registry.reset()
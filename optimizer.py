@@ -0,0 +1,122 @@
+"""
+AST-to-AST optimization of programs which have already passed AffineTypeChecker.type_check.
+
+Calls to pure builtins on constant arguments are replaced by their results, and ifs whose test is a constant are
+replaced by the branch which would have been taken. Only evaluated positions are touched: names, type specifiers and
+argument lists are left as they are, and whiles are never removed (even one which never runs evaluates its default
+clause in a deallocated environment, which has to keep happening at runtime).
+"""
+
+from dsl_parser import Literal, atom
+import language as lang
+
+
+def optimize(prog):
+    """
+    :param prog: A program which has been type-checked. Unchecked programs can call builtins where they aren't visible,
+    and folding such a call would hide the error which should happen at runtime
+    :return: An equivalent program, sharing structure with prog wherever nothing could be simplified
+    """
+    return fold_form(prog, lang.pure_builtins - defined_functions(prog))
+
+
+def defined_functions(prog) -> set:
+    """
+    The names of all functions defined anywhere in prog
+    """
+    names = set()
+    if isinstance(prog, tuple):
+        if len(prog) > 1 and prog[0] == "defun":
+            names.add(prog[1])
+        for subprog in prog:
+            names |= defined_functions(subprog)
+    return names
+
+
+def fold_form(prog, foldable):
+    """
+    :param foldable: The names of the builtins which can be evaluated ahead of time, ie those which are pure and which
+    the program can't have shadowed with its own definitions
+    """
+
+    def fold_all(progs):
+        return [fold_form(p, foldable) for p in progs]
+
+    if isinstance(prog, str) or len(prog) == 0:
+        return prog
+
+    head, args = prog[0], prog[1:]
+
+    if head in ("defvar", "set", "setref", "setrefval"):
+        return rebuild(prog, (head, *args[:-1], fold_form(args[-1], foldable)))
+    elif head == "defun":
+        return rebuild(prog, (head, *args[:3], *fold_all(args[3:])))
+    elif head == "apply":
+        fname, fargs = args[0], fold_all(args[1:])
+        if fname in foldable and all(a.__class__ is Literal for a in fargs):
+            folded = fold_call(fname, fargs)
+            if folded is not None:
+                return folded
+        return rebuild(prog, (head, fname, *fargs))
+    elif head == "if":
+        test, then_c, else_c = fold_all(args)
+        if test.__class__ is Literal:
+            taken = then_c if test.value else else_c
+            # A bare atom can't define anything, and wrapping one in a scope would read it as a macro if it happened
+            # to be named like one (a variable called set, say)
+            if isinstance(taken, str):
+                return taken
+            # The branch runs in an environment which is deallocated afterwards. That can only be noticed through a
+            # reference to a variable defined inside it, so keep the if around when there could be one
+            if not contains_macro(taken, "mkref"):
+                return ("scope", taken)
+            return rebuild(prog, (head, test, then_c, ()) if test.value else (head, test, (), else_c))
+        return rebuild(prog, (head, test, then_c, else_c))
+    elif head in ("while", "scope"):
+        return rebuild(prog, (head, *fold_all(args)))
+    elif head in ("mkref", "deref"):
+        return prog
+    else:
+        return rebuild(prog, fold_all(prog))
+
+
+def fold_call(fname, fargs):
+    """
+    Evaluate a call to a builtin ahead of time, returning a Literal for the result or None if it can't be done
+    """
+    try:
+        val = lang.builtin_fn_vals[fname](*(a.value for a in fargs))
+    except Exception:
+        # Division by zero and the like have to keep happening at runtime
+        return None
+
+    if val is None:
+        token = "nil"
+    elif isinstance(val, bool):
+        token = "true" if val else "false"
+    elif isinstance(val, (int, float)):
+        token = repr(val)
+    else:
+        return None
+
+    # Only use the result if reading it back gives exactly the same value (which rules out nan, for instance)
+    lit = atom(token)
+    if lit.__class__ is Literal and type(lit.value) is type(val) and lit.value == val:
+        return lit
+    return None
+
+
+def contains_macro(prog, macro: str) -> bool:
+    if isinstance(prog, str) or len(prog) == 0:
+        return False
+    return prog[0] == macro or any(contains_macro(p, macro) for p in prog)
+
+
+def rebuild(prog, items):
+    """
+    A form with items as its contents, to replace prog with. If nothing has changed then prog itself is returned.
+    """
+    items = tuple(items)
+    if len(items) == len(prog) and all(new is old for new, old in zip(items, prog)):
+        return prog
+    return items
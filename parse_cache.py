@@ -0,0 +1,195 @@
+"""
+An on-disk cache of parsed programs, so that the same large source doesn't have to be re-tokenized on every run.
+
+Each entry is a binary file named after the SHA-256 of the source it was parsed from, laid out as
+
+    header      magic, format version, byte order, number of strings, number of codes
+    strings     every distinct atom in the program, as (u32 length, utf-8 bytes) pairs
+    codes       a flat u32 array: OPEN and CLOSE delimit forms, any other code n is the atom strings[n - ATOM_BASE]
+
+On a hit the file is memory-mapped and the code array is read straight out of the mapping without copying it.
+The cache directory is bounded in size: entries are touched whenever they are used, and the least recently used
+ones are deleted once the total exceeds max_bytes.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from typing import Union, Tuple
+
+from dsl_parser import atom, read_from_tokens, tokenize
+
+MAGIC = b'DSLC'
+FORMAT_VERSION = 1
+ENTRY_SUFFIX = '.dslc'
+
+_header = struct.Struct('=4sBBII')
+_u32 = struct.Struct('=I')
+_byteorder = {'little': 0, 'big': 1}[sys.byteorder]
+
+OPEN, CLOSE, ATOM_BASE = 0, 1, 2
+
+
+class ParseCache:
+
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(src_str: str) -> str:
+        return hashlib.sha256(src_str.encode('utf-8')).hexdigest()
+
+    def entry_path(self, src_str: str) -> str:
+        return os.path.join(self.directory, self.key(src_str) + ENTRY_SUFFIX)
+
+    def parse(self, src_str: str):
+        """
+        Return the parse of src_str, from the cache if possible and otherwise by parsing it and storing the result
+        """
+        prog = self.load(src_str)
+        if prog is None:
+            self.misses += 1
+            prog = read_from_tokens(tokenize(src_str))
+            self.store(src_str, prog)
+        else:
+            self.hits += 1
+        return prog
+
+    def load(self, src_str: str):
+        """
+        Look up the parse of src_str, returning None if there is no usable entry for it. Stale or corrupt entries are
+        deleted.
+        """
+        path = self.entry_path(src_str)
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                prog = _decode(buf)
+        except FileNotFoundError:
+            return None
+        except (ValueError, struct.error, UnicodeDecodeError, IndexError):
+            _remove(path)
+            return None
+
+        try:
+            # Mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return prog
+
+    def store(self, src_str: str, prog) -> None:
+        data = _encode(prog)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.entry_path(src_str))
+        except BaseException:
+            _remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Delete least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self) -> None:
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX):
+                _remove(os.path.join(self.directory, name))
+
+
+def _encode(prog) -> bytes:
+    strings = {}
+    codes = array('I')
+
+    def walk(p):
+        if isinstance(p, tuple):
+            codes.append(OPEN)
+            for sub in p:
+                walk(sub)
+            codes.append(CLOSE)
+        else:
+            codes.append(ATOM_BASE + strings.setdefault(str(p), len(strings)))
+
+    walk(prog)
+
+    parts = [_header.pack(MAGIC, FORMAT_VERSION, _byteorder, len(strings), len(codes))]
+    for s in strings:
+        b = s.encode('utf-8')
+        parts.append(_u32.pack(len(b)))
+        parts.append(b)
+    # Keep the code array aligned so that it can be cast in place when loading
+    offset = sum(len(p) for p in parts)
+    parts.append(b'\0' * (-offset % codes.itemsize))
+    parts.append(codes.tobytes())
+    return b''.join(parts)
+
+
+def _decode(buf) -> Union[Tuple, str]:
+    magic, version, byteorder, n_strings, n_codes = _header.unpack_from(buf, 0)
+    if magic != MAGIC or version != FORMAT_VERSION or byteorder != _byteorder:
+        raise ValueError('Cache entry was written by an incompatible version')
+
+    offset = _header.size
+    atoms = []
+    for _ in range(n_strings):
+        (length,) = _u32.unpack_from(buf, offset)
+        offset += _u32.size
+        atoms.append(atom(bytes(buf[offset:offset + length]).decode('utf-8')))
+        offset += length
+    offset += -offset % 4
+
+    with memoryview(buf) as view, view[offset:offset + 4 * n_codes] as raw:
+        if len(raw) != 4 * n_codes:
+            raise ValueError('Truncated cache entry')
+        with raw.cast('I') as codes:
+            return _build(codes, atoms)
+
+
+def _build(codes, atoms):
+    # Forms are built with an explicit stack, so that arbitrarily deep programs don't hit the recursion limit
+    stack = [[]]
+    for code in codes:
+        if code == OPEN:
+            stack.append([])
+        elif code == CLOSE:
+            form = tuple(stack.pop())
+            stack[-1].append(form)
+        else:
+            stack[-1].append(atoms[code - ATOM_BASE])
+    if len(stack) != 1 or len(stack[0]) != 1:
+        raise ValueError('Malformed cache entry')
+    return stack[0][0]
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
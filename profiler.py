@@ -0,0 +1,235 @@
+"""
+Profiles the tree-walking interpreter, per DSL function and per while loop.
+
+While profiling is on, interpreter.eval_form and Procedure.run are swapped for versions which keep a stack of the
+functions and loops being run, and record for each one how many times it ran, how many loop iterations it did, and how
+much wall time it took, both including (inclusive) and excluding (exclusive) the functions and loops it ran in turn.
+Once profiling is turned off the originals are put back, so there is no overhead at all otherwise.
+
+Results can be written as collapsed stacks (one "outer;inner;innermost microseconds" line per stack, as taken by
+flamegraph.pl, speedscope and friends) or as a table of the functions and loops which took the most time.
+
+A call in tail position replaces its caller's frame, so it shows up as a sibling of the caller rather than as its child.
+Loops are labelled by the order in which they were first run. Procedures compiled by the jit module are run uncompiled
+while profiling (and no new ones are compiled), and counting loops are run by evaluating their tests (see
+counting_loops), so that their bodies and iterations can be seen into.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import interpreter
+from interpreter import Procedure, TailCall
+
+TOPLEVEL = "<toplevel>"
+
+
+class Stats:
+    def __init__(self, kind: str):
+        """
+        :param kind: "function" or "loop"
+        """
+        self.kind = kind
+        self.calls = 0
+        self.iterations = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+
+
+class _Frame:
+    __slots__ = ('label', 'path', 'stats', 'function', 'test', 'start', 'child_time', 'iterations')
+
+    def __init__(self, label: str, path: str, stats: Stats, function: Optional[Stats], test=None):
+        self.label = label
+        self.path = path
+        self.stats = stats
+        # Stats of the innermost function this frame is in, which its loop iterations are counted towards
+        self.function = function
+        # For loops, the test form, which is evaluated once per iteration and then once more
+        self.test = test
+        self.start = time.perf_counter()
+        self.child_time = 0.0
+        self.iterations = 0
+
+
+class Profile:
+    def __init__(self):
+        # Label -> Stats, for every function and loop which ran
+        self.stats: Dict[str, Stats] = {}
+        # Collapsed stack -> exclusive seconds spent in it
+        self.stacks: Dict[str, float] = {}
+
+        self._stack: List[_Frame] = []
+        # Labels -> how many frames with that label are on the stack, so that recursion isn't counted twice
+        self._active: Dict[str, int] = {}
+        # id of while form -> (form, label)
+        self._loop_labels = {}
+        self._saved = None
+
+    @property
+    def functions(self) -> Dict[str, Stats]:
+        return {label: s for label, s in self.stats.items() if s.kind == "function"}
+
+    @property
+    def loops(self) -> Dict[str, Stats]:
+        return {label: s for label, s in self.stats.items() if s.kind == "loop"}
+
+    ######################
+    # Turning it on/off  #
+    ######################
+
+    def enable(self) -> None:
+        if self._saved is not None:
+            raise RuntimeError("Profile is already enabled")
+        if interpreter.eval_form.__name__ == "profiled_eval_form":
+            raise RuntimeError("Another profile is already enabled")
+        self._saved = interpreter.eval_form, Procedure.run, interpreter.JIT_THRESHOLD, interpreter.COUNTING_LOOPS
+        original_eval_form = interpreter.eval_form
+
+        def profiled_eval_form(base_env, prog, tail=False):
+            return self._eval_form(original_eval_form, base_env, prog, tail)
+
+        def profiled_run(proc, argvals):
+            return self._run(proc, argvals)
+
+        interpreter.eval_form = profiled_eval_form
+        Procedure.run = profiled_run
+        interpreter.JIT_THRESHOLD = None
+        interpreter.COUNTING_LOOPS = False
+        self._push(TOPLEVEL, "function")
+
+    def disable(self) -> None:
+        if self._saved is None:
+            raise RuntimeError("Profile isn't enabled")
+        while self._stack:
+            self._pop()
+        interpreter.eval_form, Procedure.run, interpreter.JIT_THRESHOLD, interpreter.COUNTING_LOOPS = self._saved
+        self._saved = None
+
+    ##########
+    # Hooks  #
+    ##########
+
+    def _eval_form(self, original_eval_form, base_env, prog, tail):
+        top = self._stack[-1]
+        if prog is top.test:
+            ret = original_eval_form(base_env, prog, tail)
+            if ret:
+                top.iterations += 1
+            return ret
+        if isinstance(prog, tuple) and len(prog) == 4 and prog[0] == "while":
+            self._push(self._loop_label(prog), "loop", test=prog[1])
+            try:
+                return original_eval_form(base_env, prog, tail)
+            finally:
+                self._pop()
+        return original_eval_form(base_env, prog, tail)
+
+    def _run(self, proc: Procedure, argvals):
+        # Like Procedure.run, but ignoring any compiled code
+        while True:
+            self._push(proc.name or "<anonymous>", "function")
+            try:
+                ret = interpreter.eval_form(proc.make_frame(argvals), proc.fn_body, tail=True)
+            finally:
+                self._pop()
+            if ret.__class__ is not TailCall:
+                return ret
+            proc, argvals = ret.proc, ret.argvals
+
+    def _loop_label(self, prog) -> str:
+        entry = self._loop_labels.get(id(prog))
+        if entry is None or entry[0] is not prog:
+            entry = prog, f"while#{len(self._loop_labels) + 1}"
+            self._loop_labels[id(prog)] = entry
+        return entry[1]
+
+    def _push(self, label: str, kind: str, test=None) -> None:
+        stats = self.stats.get(label)
+        if stats is None:
+            stats = self.stats[label] = Stats(kind)
+        stats.calls += 1
+        if self._stack:
+            parent = self._stack[-1]
+            path = parent.path + ";" + label
+            function = stats if kind == "function" else parent.function
+        else:
+            path, function = label, stats
+        self._active[label] = self._active.get(label, 0) + 1
+        self._stack.append(_Frame(label, path, stats, function, test))
+
+    def _pop(self) -> None:
+        frame = self._stack.pop()
+        elapsed = time.perf_counter() - frame.start
+        exclusive = elapsed - frame.child_time
+        stats = frame.stats
+
+        stats.exclusive += exclusive
+        self._active[frame.label] -= 1
+        if not self._active[frame.label]:
+            # Only the outermost of a recursive function's frames counts towards its inclusive time
+            stats.inclusive += elapsed
+        if frame.test is not None:
+            stats.iterations += frame.iterations
+            if frame.function is not None and frame.function is not stats:
+                frame.function.iterations += frame.iterations
+        if self._stack:
+            self._stack[-1].child_time += elapsed
+        self.stacks[frame.path] = self.stacks.get(frame.path, 0.0) + exclusive
+
+    ###########
+    # Output  #
+    ###########
+
+    def collapsed(self) -> str:
+        """
+        The stacks in collapsed format, weighted by exclusive time in microseconds
+        """
+        lines = []
+        for path, seconds in sorted(self.stacks.items()):
+            micros = int(round(seconds * 1e6))
+            if micros:
+                lines.append(f"{path} {micros}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def write_collapsed(self, path: str) -> None:
+        with open(path, "w") as f:
+            f.write(self.collapsed())
+
+    def top(self, n: int = 20, key: str = "exclusive") -> List[tuple]:
+        """
+        The n functions and loops with the highest key (one of the attributes of Stats) as (label, Stats) pairs
+        """
+        ranked = sorted(self.stats.items(), key=lambda item: getattr(item[1], key), reverse=True)
+        return ranked[:n]
+
+    def table(self, n: int = 20, key: str = "exclusive") -> str:
+        rows = [f"{'name':<30} {'kind':<8} {'calls':>9} {'iterations':>11} {'incl ms':>10} {'excl ms':>10}"]
+        for label, s in self.top(n, key):
+            rows.append(f"{label:<30} {s.kind:<8} {s.calls:>9} {s.iterations:>11} "
+                        f"{s.inclusive * 1e3:>10.3f} {s.exclusive * 1e3:>10.3f}")
+        return "\n".join(rows)
+
+
+@contextmanager
+def profiling() -> Iterator[Profile]:
+    """
+    Profile everything the tree-walker evaluates inside the with block
+    """
+    prof = Profile()
+    prof.enable()
+    try:
+        yield prof
+    finally:
+        prof.disable()
+
+
+def profile(env, prog):
+    """
+    Evaluate prog in env with the tree-walker, profiling it
+    :return: The value of prog, and the Profile
+    """
+    with profiling() as prof:
+        value = interpreter.eval_form(env, prog)
+    return value, prof
@@ -0,0 +1,98 @@
+"""
+Finds the functions in a program which are pure, ie whose results depend only on their arguments and which have no
+side effects, so that calls to them can be memoized.
+
+A function is pure if
+    - its signature (as the affine checker reads it) only takes and returns unrestricted values, so no references and
+      no files can get in or out,
+    - its body doesn't touch references or define functions of its own, and
+    - it only calls pure builtins and other pure functions (which may include itself).
+Functions don't close over enclosing variables, so nothing else can reach a function's body.
+"""
+
+from typing import Dict
+
+import dsl_types as dslT
+import language as lang
+from env import Env
+from interpreter import Memo, Procedure
+
+DEFAULT_MEMO_SIZE = 1024
+
+impure_macros = frozenset(["mkref", "setref", "deref", "setrefval", "defun"])
+
+
+def is_pure_signature(ftype: dslT.FunType) -> bool:
+    def plain_value(t) -> bool:
+        return isinstance(t, dslT.ValType) and t.is_un() and t.is_own() and t.tname != 'file'
+
+    return plain_value(ftype.retT) and all(plain_value(t) for t in ftype.argTs)
+
+
+def pure_functions(prog) -> set:
+    """
+    The names of the pure functions defined in prog. Names which are defined more than once (in different scopes) are
+    never included, since there's no telling which definition a call refers to.
+    """
+    defuns = {}
+    for form in _defuns(prog):
+        defuns.setdefault(form[1], []).append(form)
+
+    builtins = lang.pure_builtins - set(defuns)
+    candidates = {}
+    for fname, forms in defuns.items():
+        if len(forms) != 1:
+            continue
+        _, _, ret_tprog, argspec_list, *body = forms[0]
+        ftype = dslT.FunType(mod=lang.Tmod.un, retT=dslT.tparse(ret_tprog),
+                             argTs=tuple(dslT.tparse(arg_tprog) for _, arg_tprog in argspec_list))
+        callees = set()
+        if is_pure_signature(ftype) and _only_pure_macros(tuple(body), callees):
+            candidates[fname] = callees - builtins
+
+    # Knock out functions which call something impure until nothing changes. Whatever is left only calls functions
+    # which are left
+    changed = True
+    while changed:
+        changed = False
+        for fname, callees in list(candidates.items()):
+            if not callees.issubset(candidates):
+                del candidates[fname]
+                changed = True
+
+    return set(candidates)
+
+
+def memoize_pure(env: Env, prog, max_size: int = DEFAULT_MEMO_SIZE) -> Dict[str, Memo]:
+    """
+    Turn on memoization for each pure function of prog which is defined in env (so prog should already have been
+    evaluated in env)
+    :return: The memo of each function, for keeping an eye on the hit and miss counts
+    """
+    memos = {}
+    for fname in pure_functions(prog):
+        if fname in env.functions and isinstance(env.functions[fname], Procedure):
+            memos[fname] = env.functions[fname].enable_memo(max_size)
+    return memos
+
+
+def _defuns(prog):
+    if isinstance(prog, tuple):
+        if len(prog) > 4 and prog[0] == "defun":
+            yield prog
+        for subprog in prog:
+            yield from _defuns(subprog)
+
+
+def _only_pure_macros(prog, callees: set) -> bool:
+    """
+    Whether prog avoids all of the impure macros, adding the name of every function it applies to callees
+    """
+    if isinstance(prog, str) or len(prog) == 0:
+        return True
+    if prog[0] in impure_macros:
+        return False
+    if prog[0] == "apply":
+        callees.add(prog[1])
+        return all(_only_pure_macros(p, callees) for p in prog[2:])
+    return all(_only_pure_macros(p, callees) for p in prog)
@@ -0,0 +1,162 @@
+"""
+Parses, type-checks and evaluates many independent DSL programs in parallel, across a pool of worker processes.
+
+Programs come either from a directory (one program per file) or from a JSONL stream, where each line is an object with
+a "source" and optionally an "id" (or just a JSON string of source). Results come back as dicts with the program's id,
+and either its "value" or the "error" it failed with.
+
+Command line usage:
+    python runner.py PROGRAMS_DIR_OR_JSONL [--workers N] [--unordered] [--no-typecheck] [--engine ENGINE]
+writes one JSON result per line to stdout. Use - to read JSONL from stdin.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterable, Iterator, Tuple
+
+import language as lang
+from affine_checker import AffineTypeChecker
+from dsl_parser import dsl_parse
+from env import Env, TypeCheckEnv
+from interpreter import evaluate, engine_modules
+
+# How many programs to have queued up per worker: enough to keep them busy, without reading all of the input ahead
+JOBS_PER_WORKER = 4
+
+# Set up once per worker process by _init_worker
+_worker_config = {}
+
+
+def run_batch(jobs: Iterable[Tuple[str, str]], workers: int = None, ordered: bool = True,
+              typecheck: bool = True, engine: str = "tree") -> Iterator[dict]:
+    """
+    :param jobs: (id, source) pairs. They're read lazily, so this can be a stream
+    :param workers: How many processes to use (by default, one per core)
+    :param ordered: Yield results in the same order as jobs. Otherwise they're yielded as soon as they're ready
+    :param typecheck: Type-check each program before evaluating it
+    :param engine: See interpreter.evaluate
+    """
+    if engine != "tree" and engine not in engine_modules:
+        raise ValueError(f"Unknown evaluation engine {engine}: should be one of {['tree'] + list(engine_modules)}")
+    workers = workers or os.cpu_count() or 1
+    max_pending = workers * JOBS_PER_WORKER
+    jobs = iter(jobs)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(typecheck, engine)) as pool:
+        pending = deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                else:
+                    pending.append(pool.submit(run_program, *job))
+            if not pending:
+                return
+
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+
+
+def run_program(program_id: str, src: str) -> dict:
+    """
+    Parse, check and evaluate one program in a fresh environment, reporting the error if any step fails
+    """
+    if not _worker_config:
+        _init_worker(True, "tree")
+    typecheck, engine = _worker_config["typecheck"], _worker_config["engine"]
+    try:
+        prog = dsl_parse(src)
+        if typecheck:
+            AffineTypeChecker.type_check(TypeCheckEnv(defaults=lang.builtin_fn_types), prog)
+        value = evaluate(Env(shared_functions=_worker_config["builtins"]), prog, engine=engine)
+    except Exception as err:
+        return {"id": program_id, "error": f"{type(err).__name__}: {err}"}
+    return {"id": program_id, "value": _jsonable(value)}
+
+
+def _init_worker(typecheck: bool, engine: str) -> None:
+    _worker_config["typecheck"] = typecheck
+    _worker_config["engine"] = engine
+    # Every program's environment shares (but never modifies) the same table of builtins
+    _worker_config["builtins"] = dict(lang.builtin_fn_vals)
+    # Pay for loading the engine once per worker, rather than in the first program each one runs
+    if engine in engine_modules:
+        importlib.import_module(engine_modules[engine])
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+###################
+# Reading input   #
+###################
+
+def jobs_from_directory(path: str, suffix: str = ".dsl") -> Iterator[Tuple[str, str]]:
+    """
+    One job per file in path whose name ends with suffix, in order of file name, with the file name as id
+    """
+    for name in sorted(os.listdir(path)):
+        full_path = os.path.join(path, name)
+        if name.endswith(suffix) and os.path.isfile(full_path):
+            with open(full_path) as f:
+                yield name, f.read()
+
+
+def jobs_from_jsonl(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    One job per non-blank line, with the line number (from 1) as id unless the line gives one
+    """
+    for lineno, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if isinstance(record, str):
+            yield str(lineno), record
+        else:
+            yield str(record.get("id", lineno)), record["source"]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run many DSL programs in parallel")
+    parser.add_argument("programs", help="A directory of programs, a JSONL file of programs, or - for JSONL on stdin")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: one per core)")
+    parser.add_argument("--unordered", action="store_true", help="Print results as soon as they're ready")
+    parser.add_argument("--no-typecheck", action="store_true", help="Skip type-checking")
+    parser.add_argument("--engine", default="tree", help="Evaluation engine to use")
+    parser.add_argument("--suffix", default=".dsl", help="Only run files with this suffix from a directory")
+    args = parser.parse_args(argv)
+
+    failed = False
+    with ExitStack() as stack:
+        if args.programs == "-":
+            jobs = jobs_from_jsonl(sys.stdin)
+        elif os.path.isdir(args.programs):
+            jobs = jobs_from_directory(args.programs, args.suffix)
+        else:
+            jobs = jobs_from_jsonl(stack.enter_context(open(args.programs)))
+
+        for result in run_batch(jobs, workers=args.workers, ordered=not args.unordered,
+                                typecheck=not args.no_typecheck, engine=args.engine):
+            failed = failed or "error" in result
+            print(json.dumps(result), flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+Runs many DSL programs in one process, interleaving them so that no one program can starve the others.
+
+Each program runs on a stack_eval.Machine which is given a fixed amount of fuel per turn. Fuel is burned at the
+safepoints, which are every call made through apply and every iteration of a while loop, so any program which runs for
+a long time does so by passing through them. A program which has burned its turn's fuel is suspended at the next
+safepoint and goes to the back of the queue. A program may also be given a budget of fuel for its whole run, and is
+aborted (and never resumed) once it has burned through it.
+
+Programs take turns round-robin, or in order of priority: a program only gets a turn when no program of higher priority
+is waiting for one, and programs of equal priority take turns round-robin.
+
+As in async_eval, only what runs on the machine burns fuel: procedures compiled by the other engines, and memoized ones,
+run to completion once called.
+"""
+
+import heapq
+import itertools
+from enum import Enum
+from typing import Any, List, Optional
+
+from env import Env
+from stack_eval import Machine, Suspend
+
+# How much fuel each program gets per turn
+DEFAULT_QUANTUM = 1000
+
+
+class FuelExhausted(RuntimeError):
+    pass
+
+
+class Status(Enum):
+    ready = "ready"
+    done = "done"
+    failed = "failed"
+    aborted = "aborted"
+
+
+class FuelMachine(Machine):
+    def __init__(self, env: Env, prog, budget: Optional[int] = None):
+        """
+        :param budget: How much fuel the program may burn in total, or None for no limit
+        """
+        super().__init__(env, prog)
+        self.budget = budget
+        # Fuel left for the current turn
+        self.fuel = 0
+        self.fuel_used = 0
+
+    def _safepoint(self, entry) -> None:
+        """
+        Burn one unit of fuel before running entry, or put it back and suspend if there is none left this turn
+        """
+        if self.budget is not None and self.fuel_used >= self.budget:
+            raise FuelExhausted(f"Program used up its budget of {self.budget} fuel")
+        if self.fuel <= 0:
+            self.todo.append(entry)
+            raise Suspend
+        self.fuel -= 1
+        self.fuel_used += 1
+
+    def _finish_apply(self, entry):
+        self._safepoint(entry)
+        super()._finish_apply(entry)
+
+    def _loop(self, entry):
+        self._safepoint(entry)
+        super()._loop(entry)
+
+
+class Task:
+    """
+    A program being run by a Scheduler
+    """
+    def __init__(self, task_id, machine: FuelMachine, priority: int):
+        self.id = task_id
+        self.machine = machine
+        self.priority = priority
+        self.status = Status.ready
+        self.value = None
+        self.error = None
+        self.turns = 0
+
+    @property
+    def fuel_used(self) -> int:
+        return self.machine.fuel_used
+
+    def __repr__(self):
+        return f"Task({self.id!r}, {self.status.value})"
+
+
+class Scheduler:
+    def __init__(self, quantum: int = DEFAULT_QUANTUM, by_priority: bool = False):
+        """
+        :param quantum: How much fuel each program gets per turn
+        :param by_priority: Give turns in order of priority (highest first) rather than round-robin
+        """
+        if quantum < 1:
+            raise ValueError(f"quantum should be at least 1, but got {quantum}")
+        self.quantum = quantum
+        self.by_priority = by_priority
+        self.tasks = []
+        self._ready = []
+        self._order = itertools.count()
+
+    def spawn(self, env: Env, prog, priority: int = 0, budget: Optional[int] = None, task_id: Any = None) -> Task:
+        """
+        Add a program to be run in env
+        :param priority: Only used when scheduling by priority
+        :param budget: How much fuel the program may burn before it's aborted, or None for no limit
+        :param task_id: Identifies the task (by default, its position in tasks)
+        """
+        task = Task(len(self.tasks) if task_id is None else task_id, FuelMachine(env, prog, budget), priority)
+        self.tasks.append(task)
+        self._enqueue(task)
+        return task
+
+    def step(self) -> Optional[Task]:
+        """
+        Give the next program in line a turn
+        :return: The task which ran, or None if every program has finished
+        """
+        if not self._ready:
+            return None
+        task = heapq.heappop(self._ready)[-1]
+        machine = task.machine
+        machine.fuel = self.quantum
+        task.turns += 1
+        try:
+            finished = machine.run()
+        except FuelExhausted as err:
+            self._finish(task, Status.aborted, error=err)
+        except Exception as err:
+            self._finish(task, Status.failed, error=err)
+        else:
+            if finished:
+                self._finish(task, Status.done, value=machine.result)
+            else:
+                self._enqueue(task)
+        return task
+
+    def run(self) -> List[Task]:
+        """
+        Run until every program has finished, been aborted or failed
+        :return: Every task, in the order they were spawned
+        """
+        while self.step() is not None:
+            pass
+        return self.tasks
+
+    def _enqueue(self, task: Task) -> None:
+        # Later arrivals go behind earlier ones of the same priority, which makes for round-robin among them
+        priority = -task.priority if self.by_priority else 0
+        heapq.heappush(self._ready, (priority, next(self._order), task))
+
+    @staticmethod
+    def _finish(task: Task, status: Status, value=None, error=None) -> None:
+        task.status = status
+        task.value = value
+        task.error = error
+        # Let go of the program's state, but keep what it used
+        task.machine.todo.clear()
+        task.machine.values.clear()
@@ -0,0 +1,65 @@
+from typing import Any
+
+import language as lang
+from affine_checker import AffineTypeChecker
+from dsl_parser import dsl_parse_stream
+from env import Env, TypeCheckEnv
+from interpreter import evaluate
+from optimizer import optimize
+
+
+class Session:
+    """
+    Keeps a live type-checking environment and a live runtime environment side by side, so that a program can be
+    built up incrementally (say, one notebook cell at a time). Each call to feed only parses, checks, and evaluates the
+    forms it is given, against the state left behind by everything fed before.
+    """
+
+    def __init__(self, *, typecheck: bool = True, optimize: bool = False):
+        """
+        :param optimize: Run each form through optimizer.optimize once it has type-checked
+        """
+        if optimize and not typecheck:
+            raise ValueError("Only forms which have been type-checked can be optimized")
+        self.typecheck = typecheck
+        self.optimize = optimize
+        self.tcheck_env = TypeCheckEnv(defaults=lang.builtin_fn_types)
+        self.env = Env(defaults=lang.builtin_fn_vals)
+
+    def feed(self, src) -> Any:
+        """
+        Run every top-level form in src, returning the value of the last one.
+
+        If a form fails to type-check, the type-checking environment is rolled back to how it was before that form, so
+        the session stays usable. Forms before it in the same src have already been run and are kept. Only what the
+        failing form touched is undone, so neither checking nor rolling back a form costs more as the history grows.
+        :param src: A string or file-like object containing zero or more top-level forms
+        :return:
+        """
+        ret = None
+        for form in dsl_parse_stream(src):
+            if self.typecheck:
+                self.check(form)
+            if self.optimize:
+                form = optimize(form)
+            ret = evaluate(self.env, form)
+        return ret
+
+    def check(self, form) -> None:
+        # Undo whatever a form which doesn't check did to the environment, so that the session can carry on
+        journal = self.tcheck_env.begin_journal()
+        try:
+            AffineTypeChecker.type_check(self.tcheck_env, form)
+        except Exception:
+            journal.rollback()
+            raise
+        finally:
+            self.tcheck_env.end_journal(journal)
+
+    def close(self) -> None:
+        """
+        End the session, raising an error if any linear judgements were left unused
+        """
+        if self.typecheck:
+            self.tcheck_env.deallocate()
+        self.env.deallocate()
@@ -0,0 +1,256 @@
+"""
+An evaluation engine which keeps its continuations and intermediate values on explicit stacks (on the heap) instead
+of on the Python call stack. However deeply expressions are nested, and however deep non-tail recursion goes, nothing
+here recurses in Python, so evaluation is limited only by memory rather than by sys.getrecursionlimit().
+
+Semantics are the same as interpreter.eval_form, and procedures defined here are ordinary interpreter.Procedures.
+
+Each continuation is a tuple whose first element is the handler to run it with. A Machine can be run a bounded number
+of steps at a time and then resumed, which is what lets other modules interleave or suspend evaluations.
+"""
+
+from typing import Any, Optional
+
+from dsl_parser import Literal, atom
+from env import Env
+from interpreter import Procedure
+from language import T_NIL
+from typecheck_errors import BindingUndefinedError
+
+
+class Suspend(Exception):
+    """
+    Raised by a continuation to stop the machine, which can then be resumed by calling run again. The continuation
+    must leave the machine in a state to carry on from.
+    """
+
+
+class Machine:
+
+    def __init__(self, env: Env, prog):
+        self.values = []
+        self.todo = [(self._eval, env, prog)]
+        self.steps = 0
+
+        self.macro_evaluators = {
+            "defun": self.eval_defun,
+            "defvar": self.eval_defvar,
+            "scope": self.eval_scope,
+            "set": self.eval_set,
+            "apply": self.eval_apply,
+            "if": self.eval_if,
+            "while": self.eval_while,
+            "mkref": self.eval_mkref,
+            "setref": self.eval_setref,
+            "deref": self.eval_deref,
+            "setrefval": self.eval_setrefval
+        }
+
+    @property
+    def done(self) -> bool:
+        return not self.todo
+
+    @property
+    def result(self) -> Any:
+        if not self.done:
+            raise RuntimeError("Evaluation hasn't finished yet")
+        return self.values[-1]
+
+    def run(self, max_steps: Optional[int] = None) -> bool:
+        """
+        Run until evaluation finishes, until max_steps continuations have been run, or until a continuation raises
+        Suspend. Returns whether evaluation has finished.
+        """
+        todo = self.todo
+        try:
+            if max_steps is None:
+                while todo:
+                    entry = todo.pop()
+                    entry[0](entry)
+                    self.steps += 1
+            else:
+                for _ in range(max_steps):
+                    if not todo:
+                        break
+                    entry = todo.pop()
+                    entry[0](entry)
+                    self.steps += 1
+        except Suspend:
+            self.steps += 1
+            return False
+        return not todo
+
+    def push_call(self, fn, args) -> None:
+        """
+        Call fn on args. Calls to Procedures are run on the machine; anything else (builtins, memoized procedures, or
+        procedures compiled by one of the other engines) is just called.
+        """
+        if fn.__class__ is Procedure and fn.memo is None:
+            todo = self.todo
+            # A call in tail position has nothing but the deallocation of enclosing ifs between it and the return from
+            # the current procedure. Like the tree-walker, deallocate those now and don't push another return, so that
+            # tail calls run in constant space
+            top = len(todo)
+            while top and todo[top - 1][0] == self._deallocate:
+                top -= 1
+            if top and todo[top - 1][0] == self._return:
+                while len(todo) > top:
+                    entry = todo.pop()
+                    entry[0](entry)
+            else:
+                todo.append((self._return,))
+            todo.append((self._eval, fn.make_frame(args), fn.fn_body))
+        else:
+            self.values.append(fn(*args))
+
+    ###############################################################
+    # Continuations: each one is run with its own tuple as input #
+    ###############################################################
+
+    def _eval(self, entry):
+        _, env, prog = entry
+
+        if isinstance(prog, str):
+            if prog.__class__ is Literal:
+                self.values.append(prog.value)
+                return
+            try:
+                self.values.append(env.get_bind_val(prog))
+            except BindingUndefinedError:
+                # Programs built by hand rather than parsed may spell constants as plain strs
+                lit = atom(prog)
+                if lit.__class__ is not Literal:
+                    raise
+                self.values.append(lit.value)
+        elif len(prog) == 0:
+            self.values.append(T_NIL)
+        elif prog[0] in self.macro_evaluators:
+            self.macro_evaluators[prog[0]](env, *prog[1:])
+        else:
+            self._sequence((None, env, prog, 0))
+
+    def _sequence(self, entry):
+        _, env, prog, i = entry
+        if i > 0:
+            # Discard the value of the previous form
+            self.values.pop()
+        if i < len(prog) - 1:
+            self.todo.append((self._sequence, env, prog, i + 1))
+        # The last form leaves nothing behind on the stack, so tail calls don't grow it
+        self.todo.append((self._eval, env, prog[i]))
+
+    def _finish_defvar(self, entry):
+        _, env, name = entry
+        env.define_bind(name, self.values[-1])
+        self.values[-1] = None
+
+    def _finish_set(self, entry):
+        _, env, name = entry
+        env.set_bind_val(name, self.values[-1])
+        self.values[-1] = None
+
+    def _finish_setref(self, entry):
+        _, env, name = entry
+        env.set_bind_val(name, self.values.pop())
+        self.values.append(None)
+
+    def _finish_setrefval(self, entry):
+        _, env, ref = entry
+        var, referenced_binding = env.get_bind_val(ref)
+        val, defining_env = referenced_binding
+        defining_env.set_bind_val(var, self.values.pop())
+        self.values.append(None)
+
+    def _finish_apply(self, entry):
+        _, env, fun_name, argc = entry
+        if argc:
+            args = self.values[-argc:]
+            del self.values[-argc:]
+        else:
+            args = []
+        self.push_call(env.get_fun_def(fun_name), args)
+
+    def _choose_branch(self, entry):
+        _, env, then_c, else_c = entry
+        test_result = self.values.pop()
+        inner_env = Env(outer=env)
+        self.todo.append((self._deallocate, inner_env))
+        self.todo.append((self._eval, inner_env, then_c if test_result else else_c))
+
+    def _return(self, entry):
+        # Only marks where a procedure's body ends
+        pass
+
+    def _deallocate(self, entry):
+        entry[1].deallocate()
+
+    def _loop(self, entry):
+        _, inner_env, test_c, default_c, body_c, ran = entry
+        if self.values.pop():
+            if ran:
+                # Discard the value of the previous iteration
+                self.values.pop()
+            self.todo.append((self._loop, inner_env, test_c, default_c, body_c, True))
+            self.todo.append((self._eval, inner_env, test_c))
+            self.todo.append((self._eval, inner_env, body_c))
+        else:
+            inner_env.deallocate()
+            if not ran:
+                self.todo.append((self._eval, inner_env, default_c))
+
+    ##################################################################################
+    # Macros: same signatures as in interpreter.eval_form, so malformed forms fail   #
+    # in the same way                                                                #
+    ##################################################################################
+
+    def eval_defvar(self, env: Env, name, declared_tprog, init_prog):
+        self.todo.append((self._finish_defvar, env, name))
+        self.todo.append((self._eval, env, init_prog))
+
+    def eval_defun(self, env: Env, fname, fun_ret_t, argspec_list, *fn_body):
+        env.define_fun(fname, Procedure(env.functions, argspec_list, fn_body, name=fname))
+        self.values.append(None)
+
+    def eval_set(self, env: Env, var_name, val_prog):
+        self.todo.append((self._finish_set, env, var_name))
+        self.todo.append((self._eval, env, val_prog))
+
+    def eval_apply(self, env: Env, fun_name, *arg_list):
+        self.todo.append((self._finish_apply, env, fun_name, len(arg_list)))
+        # Pushed in reverse, so that the arguments are evaluated left to right
+        for arg in reversed(arg_list):
+            self.todo.append((self._eval, env, arg))
+
+    def eval_scope(self, env: Env, *prog):
+        self.todo.append((self._eval, Env(outer=env), prog))
+
+    def eval_if(self, env: Env, test, then_c, else_c):
+        self.todo.append((self._choose_branch, env, then_c, else_c))
+        self.todo.append((self._eval, env, test))
+
+    def eval_while(self, env: Env, test_c, default_c, body_c):
+        inner_env = Env(outer=env)
+        self.todo.append((self._loop, inner_env, test_c, default_c, body_c, False))
+        self.todo.append((self._eval, inner_env, test_c))
+
+    def eval_mkref(self, env: Env, var):
+        self.values.append((var, env.get_bind(var)))
+
+    def eval_setref(self, env: Env, ref_name, new_def):
+        self.todo.append((self._finish_setref, env, ref_name))
+        self.todo.append((self._eval, env, new_def))
+
+    def eval_deref(self, env: Env, ref):
+        var, referenced_binding = env.get_bind_val(ref)
+        val, defining_env = referenced_binding
+        self.values.append(val)
+
+    def eval_setrefval(self, env: Env, ref, new_val):
+        self.todo.append((self._finish_setrefval, env, ref))
+        self.todo.append((self._eval, env, new_val))
+
+
+def evaluate(env: Env, prog):
+    machine = Machine(env, prog)
+    machine.run()
+    return machine.result
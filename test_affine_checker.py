@@ -3,7 +3,7 @@ import language as lang
 import typecheck_errors as tc_err
 from affine_checker import AffineTypeChecker as ATC
 import dsl_types as dslT
-from env import TypeCheckEnv, deepcopy_env
+from env import Journal, TypeCheckEnv, deepcopy_env
 from dsl_parser import dsl_parse
 
 
@@ -66,6 +66,10 @@ def test_unrestricted_variables():
     ret_type = ATC.type_check(env, prog)
     assert ret_type == lang.T_INT
 
+    # Including in programs built by hand, which spell their constants as plain strs
+    prog = (('defvar', 'x', ('un', 'val', 'int'), '3'), ('apply', '+', 'x', '1'))
+    assert ATC.type_check(base_tcheck_env(), prog) == lang.T_INT
+
     # Can turn an unrestricted value into an affine one
     prog = dsl_parse("((defvar x (aff val int) 3))")
     env = base_tcheck_env()
@@ -217,11 +221,81 @@ def test_if_lin3():
         ATC.type_check(base_tcheck_env(), prog)
 
 
+def test_if_lin4():
+    # Whichever branch is checked first, a judgement used in only one of them is a mismatch
+    prog = dsl_parse("((defvar x (lin val int) 3) (if true (apply + x 2) (3)))")
+    with pytest.raises(tc_err.EnvironmentMismatchError):
+        ATC.type_check(base_tcheck_env(), prog)
+
+
+def test_if_undoes_then_branch():
+    prog = dsl_parse("((defvar x (lin val int) 3) "
+                     " (if true ((defvar y (un val int) 1) (apply + x y)) ((defvar y (un val int) 2) (apply + x y))))")
+    env = base_tcheck_env()
+    ATC.type_check(env, prog, descope=False)
+    assert env.get_bind_val("x").is_borrow()
+    assert not env.contains_bind("y")
+    assert not env._journals
+
+
+def nested_ifs(depth):
+    prog = "(set x (apply + x 1))"
+    for _ in range(depth):
+        prog = f"(if (apply < c 0) {prog} (set x (apply - x 1)))"
+    return dsl_parse(f"((defvar c (un val int) 0) (defvar x (lin val int) 3) {prog} (apply + x 1))")
+
+
+def test_nested_ifs(monkeypatch):
+    noted = []
+    note_bind = Journal.note_bind
+    monkeypatch.setattr(Journal, "note_bind", lambda self, env, name: noted.append(name) or note_bind(self, env, name))
+
+    def bindings_noted(depth):
+        noted.clear()
+        ATC.type_check(base_tcheck_env(), nested_ifs(depth), descope=True)
+        return len(noted)
+
+    # Each level only journals the few bindings its branches touch, rather than copying (or visiting) every binding
+    # in the chain of environments, so every extra level costs the same
+    per_level = (bindings_noted(40) - bindings_noted(10)) / 30
+    assert 0 < per_level < 10
+    assert bindings_noted(160) - bindings_noted(40) == 120 * per_level
+
+
+def test_ifs_with_references():
+    # Returning fref at the end of each branch gives f back to its binding, so the second if has to see that
+    prog = dsl_parse("("
+                     "(defvar f (lin val file) (apply fopen 123))"
+                     "(scope (defvar fref (un ref (lin val file)) (mkref f))"
+                     "       (if true (apply fwrite fref 1) (apply fwrite fref 2))"
+                     "       (if false (apply fwrite fref 3) (apply fwrite fref 4)))"
+                     "(if true (apply fclose f) (apply fclose f))"
+                     ")")
+    ATC.type_check(base_tcheck_env(), prog, descope=True)
+
+    prog = dsl_parse("("
+                     "(defvar f (lin val file) (apply fopen 123))"
+                     "(if true (apply fclose f) (scope (defvar fref (un ref (lin val file)) (mkref f))))"
+                     ")")
+    with pytest.raises(tc_err.EnvironmentMismatchError):
+        ATC.type_check(base_tcheck_env(), prog, descope=True)
+
+
 def test_while():
     prog = dsl_parse("((defvar x (un val int) 0) (while (apply < x 3) -2 ((set x (apply + x 1)) x)))")
     ATC.type_check(base_tcheck_env(), prog, descope=False)
 
 
+def test_while_modifies_env():
+    prog = dsl_parse("((defvar x (lin val int) 0) (while false (apply + x 1) 2) x)")
+    with pytest.raises(tc_err.EnvironmentMismatchError, match="Default"):
+        ATC.type_check(base_tcheck_env(), prog)
+
+    prog = dsl_parse("((defvar x (lin val int) 0) (while false 2 (apply + x 1)) x)")
+    with pytest.raises(tc_err.EnvironmentMismatchError, match="Body"):
+        ATC.type_check(base_tcheck_env(), prog)
+
+
 def test_fun():
     prog = dsl_parse("((defvar x (un val int) 3)"
                      "(defun foo (un val bool) ((y (un val bool))) y )"
@@ -349,6 +423,32 @@ def test_working_with_files():
     ATC.type_check(base_tcheck_env(), prog, descope=True)
 
 
+def test_bulk_file_writes():
+    def writes(args):
+        return dsl_parse("("
+                         "(defvar f (lin val file) (apply fopen 123))"
+                         f"(scope (defvar fref (un ref (lin val file)) (mkref f)) (apply fwritev fref {args}))"
+                         "(apply fclose f)"
+                         ")")
+
+    for args in ("", "1", "1 2 3"):
+        ATC.type_check(base_tcheck_env(), writes(args), descope=True)
+    with pytest.raises(tc_err.TypeMismatchError):
+        ATC.type_check(base_tcheck_env(), writes("1 true 3"), descope=True)
+
+    with pytest.raises(RuntimeError):
+        ATC.type_check(base_tcheck_env(), dsl_parse("(apply fwritev)"))
+
+    # Only the variadic flag tells these apart
+    assert lang.builtin_fn_types["fwritev"] != lang.builtin_fn_types["fsetbuf"]
+    ATC.type_check(base_tcheck_env(), dsl_parse("("
+                                                "(defvar f (lin val file) (apply fopen 123))"
+                                                "(scope (defvar fref (un ref (lin val file)) (mkref f))"
+                                                "       (apply fsetbuf fref 0))"
+                                                "(apply fclose f)"
+                                                ")"), descope=True)
+
+
 def test_recursive_fun():
     prog = dsl_parse("("
                      "(defun fib (un val int) ((n (un val int))) "
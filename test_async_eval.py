@@ -0,0 +1,72 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import language as lang
+from async_eval import evaluate_all, evaluate_async
+from dsl_parser import dsl_parse
+from env import Env
+
+
+def base_env():
+    return Env(defaults=lang.builtin_fn_vals)
+
+
+def writer(file_id, n_lines):
+    writes = " ".join(f"(apply fwrite fr {i})" for i in range(n_lines))
+    return dsl_parse(f"((defvar f (lin val file) (apply fopen {file_id})) "
+                     f" (defvar fr (un ref (lin val file)) (mkref f)) "
+                     f" {writes} "
+                     f" (apply fclose f) "
+                     f" {file_id})")
+
+
+class SlowExecutor(ThreadPoolExecutor):
+    """
+    Makes every call take a while, and remembers which file each one was for
+    """
+    def __init__(self):
+        super().__init__(max_workers=64)
+        self.calls = []
+
+    def submit(self, fn, *args, **kwargs):
+        def slow():
+            time.sleep(0.05)
+            return fn(*args, **kwargs)
+        self.calls.append(fn)
+        return super().submit(slow)
+
+
+def test_programs_run_concurrently(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    n_programs = 20
+    executor = SlowExecutor()
+    start = time.perf_counter()
+    results = evaluate_all([(base_env(), writer(100 + i, 3)) for i in range(n_programs)], executor=executor)
+    elapsed = time.perf_counter() - start
+
+    assert results == [100 + i for i in range(n_programs)]
+    assert len(executor.calls) == n_programs * 5
+    # Made one after another, the calls would take 5 seconds
+    assert elapsed < 2
+    for i in range(n_programs):
+        assert (tmp_path / str(100 + i)).read_text() == "0\n1\n2\n"
+
+
+def test_agrees_with_tree_walker():
+    prog = dsl_parse("((defun count (un val int) ((n (un val int)) (acc (un val int))) "
+                     "     (if (apply = n 0) acc (apply count (apply - n 1) (apply + acc 1)))) "
+                     " (apply count 5000 0))")
+    # Long enough to need many slices
+    assert asyncio.run(evaluate_async(base_env(), prog, slice_steps=100)) == 5000
+
+
+def test_errors(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    jobs = [(base_env(), writer(1, 1)), (base_env(), dsl_parse("(apply + x 1)"))]
+    with pytest.raises(Exception, match="x is undefined"):
+        evaluate_all(jobs, max_in_flight=1)
+    # The other program still ran to the end
+    assert (tmp_path / "1").read_text() == "0\n"
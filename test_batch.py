@@ -0,0 +1,57 @@
+import pytest
+
+from dsl_parser import dsl_parse
+from batch import evaluate_records, vectorizable
+
+np = pytest.importorskip("numpy")
+from batch import evaluate_batch  # noqa: E402
+
+
+def check_agrees(src, inputs):
+    prog = dsl_parse(src)
+    expected = evaluate_records(prog, inputs)
+    got = evaluate_batch(prog, {name: np.asarray(values) for name, values in inputs.items()})
+    assert got.tolist() == expected
+    return got
+
+
+def test_straight_line():
+    prog = "((defvar y (un val int) (apply * x x)) (apply - (apply + y 1) (apply / x 2)))"
+    assert vectorizable(dsl_parse(prog))
+    check_agrees(prog, {"x": [1, 2, 3, 10, -4]})
+    check_agrees("(apply and (apply < x 3) (apply not (apply = x y)))", {"x": [1, 2, 3, 4], "y": [1, 0, 3, 0]})
+
+
+def test_branches():
+    got = check_agrees("((defvar y (un val int) 0) "
+                       " (if (apply > x 2) (set y (apply * x 10)) (set y (apply - 0 x))) "
+                       " (apply + y (if (apply = x 3) 100 0)))", {"x": [1, 2, 3, 4, 5]})
+    assert got.tolist() == [-1, -2, 130, 40, 50]
+
+    # Only the records which take a branch evaluate it, so these divisions by zero never happen
+    check_agrees("(if (apply = x 0) 0 (apply / 10 x))", {"x": [0, 1, 2, 0]})
+    check_agrees("(if (apply = x x) 1 (apply / 1 0))", {"x": [0, 1]})
+
+    # But one which does still raises
+    with pytest.raises(ZeroDivisionError):
+        evaluate_batch(dsl_parse("(if (apply > x 0) (apply / 1 0) 0)"), {"x": np.array([0, 1])})
+
+
+def test_constant_results():
+    assert evaluate_batch(dsl_parse("(apply + 1 2)"), {}, size=3).tolist() == [3, 3, 3]
+    assert evaluate_batch(dsl_parse("(defvar y (un val int) x)"), {"x": np.arange(2)}).tolist() == [None, None]
+
+
+def test_falls_back_to_records():
+    prog = ("((defvar acc (un val int) 0) "
+            " (while (apply > x 0) 0 ((set acc (apply + acc x)) (set x (apply - x 1)) acc)) "
+            " acc)")
+    assert not vectorizable(dsl_parse(prog))
+    assert check_agrees(prog, {"x": [0, 1, 4]}).tolist() == [0, 1, 10]
+
+    assert not vectorizable(dsl_parse("(apply fopen x)"))
+
+
+def test_mismatched_inputs():
+    with pytest.raises(ValueError):
+        evaluate_batch(dsl_parse("(apply + x y)"), {"x": np.arange(2), "y": np.arange(3)})
@@ -0,0 +1,79 @@
+import pytest
+
+import language as lang
+from checkpoint import Checkpoint, restore, save
+from dsl_parser import dsl_parse
+from env import Env
+from interpreter import evaluate
+from purity import memoize_pure
+from scheduler import Scheduler, Status
+
+PROG = dsl_parse("((defun fib (un val int) ((n (un val int))) "
+                 "     (if (apply < n 2) n (apply + (apply fib (apply - n 1)) (apply fib (apply - n 2))))) "
+                 " (defvar f (lin val file) (apply fopen 5)) "
+                 " (defvar fr (un ref (lin val file)) (mkref f)) "
+                 " (defvar total (un val int) 0) "
+                 " (defvar tr (un ref (un val int)) (mkref total)) "
+                 " (apply fwrite fr (apply fib 10)) "
+                 " (setrefval tr (apply fib 12)) "
+                 " (apply fwrite fr total) "
+                 " (apply fclose f) "
+                 " total)")
+
+
+def base_env():
+    return Env(defaults=lang.builtin_fn_vals)
+
+
+@pytest.mark.parametrize("stop_at", range(11))
+def test_resume_between_forms(tmp_path, monkeypatch, stop_at):
+    monkeypatch.chdir(tmp_path)
+    expected = evaluate(base_env(), PROG)
+    expected_output = (tmp_path / "5").read_text()
+
+    # Run part of the way, save, then carry on past the snapshot before "crashing"
+    run = Checkpoint(base_env(), PROG)
+    for _ in range(stop_at):
+        run.step()
+    save("snapshot", run)
+    while not run.done and run.next_form < stop_at + 2:
+        run.step()
+
+    resumed = restore("snapshot")
+    assert resumed.next_form == stop_at
+    assert resumed.run("snapshot") == expected
+    assert (tmp_path / "5").read_text() == expected_output
+    assert restore("snapshot").done
+
+
+def test_procedures_keep_memos(tmp_path):
+    env = base_env()
+    prog = dsl_parse("((defun sq (un val int) ((n (un val int))) (apply * n n)) (apply sq 4))")
+    run = Checkpoint(env, prog)
+    run.run()
+    memo = memoize_pure(env, prog)["sq"]
+    evaluate(env, dsl_parse("(apply sq 3)"))
+    # Compiled code is dropped
+    for _ in range(200):
+        evaluate(env, dsl_parse("(apply sq 5)"))
+
+    save(str(tmp_path / "snapshot"), run)
+    restored = restore(str(tmp_path / "snapshot")).env
+    sq = restored.get_fun_def("sq")
+    assert sq.memo.entries == memo.entries and sq.jit_code is None
+    assert restored.get_fun_def("*") is lang.builtin_fn_vals["*"]
+    assert evaluate(restored, dsl_parse("(apply sq 6)")) == 36
+
+
+def test_resume_suspended_machine(tmp_path):
+    prog = dsl_parse("((defvar i (un val int) 0) (defvar s (un val int) 0) "
+                     " (while (apply < i 100) 0 ((set i (apply + i 1)) (set s (apply + s i)))) s)")
+    scheduler = Scheduler(quantum=50)
+    task = scheduler.spawn(base_env(), prog)
+    scheduler.step()
+    assert task.status == Status.ready
+    save(str(tmp_path / "snapshot"), task.machine)
+
+    machine = restore(str(tmp_path / "snapshot"))
+    machine.fuel = float("inf")
+    assert machine.run() and machine.result == 5050
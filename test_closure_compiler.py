@@ -0,0 +1,93 @@
+import pytest
+
+import closure_compiler
+import interpreter
+import language as lang
+import typecheck_errors as tc_err
+from dsl_parser import dsl_parse
+from env import Env
+
+
+def base_env():
+    return Env(defaults=lang.builtin_fn_vals)
+
+
+def run_both(src):
+    """
+    Run src with both the tree-walker and the closure compiler, checking that they agree on the result (or error)
+    """
+    results = []
+    for engine in ("tree", "closure"):
+        try:
+            results.append(('ok', interpreter.evaluate(base_env(), dsl_parse(src), engine=engine)))
+        except Exception as err:
+            results.append(('err', type(err)))
+    assert results[0] == results[1]
+    return results[1]
+
+
+def test_variables_resolve_to_slots():
+    scope = closure_compiler.Scope('inner', parent=closure_compiler.Scope('inner'))
+    scope.parent.declare('x')
+    scope.declare('y')
+    scope.declare('x')
+    assert scope.var_candidates('x') == [(0, 1), (1, 0)]
+    assert scope.var_candidates('y') == [(0, 0)]
+    assert scope.var_candidates('z') == []
+
+
+def test_shadowing_is_an_error():
+    assert run_both("((defvar x _ 1) (scope (defvar x _ 2)))") == ('err', tc_err.BindingRedefinitionError)
+    assert run_both("((scope (defvar x _ 1) (scope (defvar x _ 2))))") == ('err', tc_err.BindingRedefinitionError)
+    # ... but the same name can be reused once the first scope has ended
+    assert run_both("((scope (defvar x _ 1)) (scope (defvar x _ 2) x))") == ('ok', 2)
+
+
+def test_use_before_define_falls_back_to_outer_binding():
+    assert run_both("((defvar x _ 1) (scope (defvar y _ x) y))") == ('ok', 1)
+    assert run_both("((scope (defvar y _ x) (defvar x _ 1)))") == ('err', tc_err.BindingUndefinedError)
+
+
+def test_defvar_in_loop_body():
+    src = "((defvar i _ 0) (while (apply < i 2) 0 ((set i (apply + i 1)) (defvar z _ i))))"
+    assert run_both(src) == ('err', tc_err.BindingRedefinitionError)
+
+
+def test_while_default_runs_deallocated():
+    assert run_both("((defvar i _ 0) (while false 5 i))") == ('ok', 5)
+    assert run_both("((defvar i _ 0) (while false i i))") == ('err', tc_err.DeallocatedEnvError)
+
+
+def test_reference_into_dead_scope():
+    src = ("((defvar r _ 0)"
+           " (if true ((defvar z _ 3) (set r (mkref z))) 0)"
+           " (deref r))")
+    assert run_both(src) == ('ok', 3)
+    src = ("((defvar r _ 0)"
+           " (if true ((defvar z _ 3) (set r (mkref z))) 0)"
+           " (setrefval r 4))")
+    assert run_both(src) == ('err', tc_err.DeallocatedEnvError)
+
+
+def test_references_through_frames():
+    src = ("((defun bump _ ((r _)) (setrefval r (apply + (deref r) 1)))"
+           " (scope (defvar x _ 1) (scope (defvar xref _ (mkref x)) (apply bump xref)) x))")
+    assert run_both(src) == ('ok', 2)
+
+
+def test_functions_in_scopes():
+    # Functions defined in a scope don't see the builtins (the tree-walker only passes on the defining Env's functions)
+    assert run_both("(scope (defun f _ ((x _)) (apply + x 1)) (apply f 1))") == ('err', tc_err.BindingUndefinedError)
+    assert run_both("(scope (defun f _ ((x _)) x) (defun g _ ((x _)) (apply f x)) (apply g 1))") == ('ok', 1)
+    assert run_both("((defun f _ () 1) (scope (defun f _ () 2)))") == ('err', tc_err.BindingRedefinitionError)
+    assert run_both("((defun f _ ((x _) (x _)) x) (apply f 1 2))") == ('err', tc_err.BindingRedefinitionError)
+
+
+def test_arguments_are_not_closed_over():
+    assert run_both("((defvar y _ 1) (defun f _ ((x _)) y) (apply f 1))") == ('err', tc_err.BindingUndefinedError)
+
+
+def test_toplevel_bindings_persist_in_env():
+    env = base_env()
+    interpreter.evaluate(env, dsl_parse("((defvar x _ 1) (scope (set x 5)))"), engine="closure")
+    assert env.get_bind_val('x') == 5
@@ -0,0 +1,88 @@
+import pytest
+
+import interpreter
+import language as lang
+from counting_loops import match_counting_loop
+from dsl_parser import dsl_parse
+from env import Env
+
+
+def base_env():
+    return Env(defaults=lang.builtin_fn_vals)
+
+
+def evaluate_both(prog):
+    """
+    Evaluate prog with and without counting loops, checking that the results agree
+    """
+    results = []
+    for counting in (False, True):
+        old, interpreter.COUNTING_LOOPS = interpreter.COUNTING_LOOPS, counting
+        try:
+            env = base_env()
+            results.append((interpreter.evaluate(env, prog), env.bindings))
+        finally:
+            interpreter.COUNTING_LOOPS = old
+    (slow, slow_bindings), (fast, fast_bindings) = results
+    assert fast == slow
+    assert {k: v for k, (v, _) in fast_bindings.items()} == {k: v for k, (v, _) in slow_bindings.items()}
+    return fast
+
+
+def loop(test, body, default="7"):
+    return dsl_parse(f"((defvar i (un val int) 0) (defvar n (un val int) 10) (defvar s (un val int) 0) "
+                     f" (defvar ret (un val int) (while {test} {default} {body})) "
+                     f" ret)")
+
+
+def test_matches():
+    def match(src):
+        return match_counting_loop(dsl_parse(src))
+
+    counting = match("(while (apply < i n) 0 ((set i (apply + i 1)) (apply f i)))")
+    assert (counting.var, counting.bound, counting.step, counting.incr_first) == ("i", "n", 1, True)
+    counting = match("(while (apply <= i 5) 0 (set i (apply + 2 i)))")
+    assert (counting.test_op, counting.bound, counting.step, counting.incr_first, counting.rest) == ("<=", 5, 2, True, ())
+    assert not match("(while (apply < i n) 0 ((apply f i) (set i (apply + i 1))))").incr_first
+
+    for src in ["(while (apply > i n) 0 ((set i (apply + i 1))))",
+                "(while (apply < i i) 0 ((set i (apply + i 1))))",
+                "(while (apply < i 1.5) 0 ((set i (apply + i 1))))",
+                "(while (apply < i n) 0 ((set i (apply + i 0))))",
+                "(while (apply < i n) 0 ((set i (apply - i 1))))",
+                "(while (apply < i n) 0 ((set i (apply + n 1))))",
+                "(while (apply < i n) 0 ((set i (apply + i 1)) (defvar n (un val int) 0)))",
+                "(while (apply < i n) 0 ())"]:
+        assert match(src) is None, src
+
+
+@pytest.mark.parametrize("test, body", [
+    ("(apply < i n)", "((set i (apply + i 1)) (set s (apply + s i)) s)"),
+    ("(apply < i n)", "((set s (apply + s i)) (set i (apply + i 1)))"),
+    ("(apply <= i n)", "((set i (apply + 3 i)) (set s (apply + s i)) s)"),
+    ("(apply < i 0)", "((set i (apply + i 1)) s)"),
+    ("(apply < i n)", "(set i (apply + i 1))"),
+    # Changing the variable or the bound in the body hands the loop back to the evaluator
+    ("(apply < i n)", "((set i (apply + i 1)) (if (apply = i 4) (set i (apply + i 3)) (set s (apply + s 1))) s)"),
+    ("(apply < i n)", "((set i (apply + i 1)) (set s (apply + s i)) (set i (apply + i 1)))"),
+    ("(apply < i n)", "((if (apply = i 4) (set n 6) (set s (apply + s 1))) (set i (apply + i 1)))"),
+    ("(apply < i n)", "((set i (apply + i 1)) (scope (defvar r (un ref (un val int)) (mkref n)) "
+                      "                             (setrefval r 3)) s)"),
+])
+def test_agrees_with_evaluator(test, body):
+    evaluate_both(loop(test, body))
+
+
+def test_start_values_which_arent_ints():
+    prog = dsl_parse("((defvar i (un val int) 0.5) (while (apply < i 3) 0 ((set i (apply + i 1)))) i)")
+    assert evaluate_both(prog) == 3.5
+    prog = dsl_parse("((defvar i (un val int) 0) (while (apply < i 2.5) 0 ((set i (apply + i 1)))) i)")
+    assert evaluate_both(prog) == 3
+
+
+def test_functions_defined_in_body():
+    # Defining a function hands the loop back to the evaluator, since it might change what the test means
+    prog = dsl_parse("((defvar i (un val int) 0) "
+                     " (while (apply < i 10) 0 "
+                     "     ((set i (apply + i 1)) (if (apply = i 3) (defun f (un val int) () 1) 0))) i)")
+    assert evaluate_both(prog) == 10
@@ -0,0 +1,74 @@
+import copy
+import io
+import pickle
+import pytest
+
+from dsl_parser import dsl_parse, dsl_parse_stream, tokenize_stream, read_from_tokens, Literal
+
+
+def test_parse_nested():
+    assert dsl_parse("(defvar x (un val int) 3)") == ('defvar', 'x', ('un', 'val', 'int'), '3')
+    assert dsl_parse("()") == ()
+
+
+def test_parse_errors():
+    with pytest.raises(SyntaxError):
+        dsl_parse("")
+    with pytest.raises(SyntaxError):
+        dsl_parse(")")
+    with pytest.raises(SyntaxError):
+        dsl_parse("((apply + 1 2)")
+
+
+def test_read_from_tokens_accepts_iterators():
+    assert read_from_tokens(iter(['(', 'apply', '+', '1', '2', ')'])) == ('apply', '+', '1', '2')
+
+
+def test_tokenize_stream_across_chunks():
+    # Tokens split across chunk boundaries should be glued back together
+    chunks = ["(app", "ly fo", "o 12", "3) ", "(x", ")", "y"]
+    assert list(tokenize_stream(chunks)) == ['(', 'apply', 'foo', '123', ')', '(', 'x', ')', 'y']
+
+
+def test_parse_stream_yields_toplevel_forms():
+    src = "(defvar x (un val int) 3)\n(apply + x 1)\nx"
+    expected = [('defvar', 'x', ('un', 'val', 'int'), '3'), ('apply', '+', 'x', '1'), 'x']
+
+    for chunk_size in (1, 2, 7, 1000):
+        assert list(dsl_parse_stream(io.StringIO(src), chunk_size=chunk_size)) == expected
+        assert list(dsl_parse_stream(src, chunk_size=chunk_size)) == expected
+
+
+def test_parse_stream_is_lazy():
+    def chunks():
+        yield "(apply + 1 2) "
+        raise AssertionError("Reader pulled more input than it needed")
+
+    forms = dsl_parse_stream(chunks())
+    assert next(forms) == ('apply', '+', '1', '2')
+
+
+def test_parse_stream_unterminated():
+    with pytest.raises(SyntaxError):
+        list(dsl_parse_stream("(apply + 1 2) (apply"))
+
+
+def test_parse_large_program():
+    # Would take quadratic time with list.pop(0)
+    n = 200000
+    prog = dsl_parse("(" + "(apply + 1 2) " * n + ")")
+    assert len(prog) == n
+
+
+def test_literal_classification():
+    prog = dsl_parse("(x 3 -4 2.5 true false nil + -)")
+    assert [type(a) for a in prog] == [str, Literal, Literal, Literal, Literal, Literal, Literal, str, str]
+    assert [a.value for a in prog[1:7]] == [3, -4, 2.5, True, False, None]
+    assert type(prog[1].value) is int
+
+
+def test_literals_survive_pickling():
+    lit = dsl_parse("3")
+    for copied in (pickle.loads(pickle.dumps(lit)), copy.deepcopy(lit)):
+        assert isinstance(copied, Literal)
+        assert copied == "3" and copied.value == 3
@@ -1,11 +1,29 @@
 import pytest
 
-from interpreter import evaluate
+import interpreter
 from dsl_parser import dsl_parse
 import language as lang
-from typecheck_errors import BindingUndefinedError
+from typecheck_errors import BindingUndefinedError, DeallocatedEnvError
 from env import Env
 
+ENGINES = ["tree", "closure", "vm", "stack"]
+_engine = ENGINES[0]
+
+
+@pytest.fixture(autouse=True, params=ENGINES)
+def engine(request):
+    """
+    Run every test in this file against each of the evaluation engines
+    """
+    global _engine
+    _engine = request.param
+    yield request.param
+    _engine = ENGINES[0]
+
+
+def evaluate(env, prog):
+    return interpreter.evaluate(env, prog, engine=_engine)
+
 
 def base_env():
     return Env(defaults=lang.builtin_fn_vals)
@@ -189,7 +207,8 @@ def test_recursive_fun():
     assert evaluate(base_env(), prog) == 3
 
 
-def test_file_stuff():
+def test_file_stuff(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     prog = dsl_parse(
         """
         (
@@ -202,3 +221,159 @@ def test_file_stuff():
         )
         """)
     evaluate(base_env(), prog)
+    assert (tmp_path / "3").read_text() == "33\n"
+
+
+def test_bulk_file_writes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    prog = dsl_parse("((defvar f _ (apply fopen 7))"
+                     " (scope (defvar fref _ (mkref f))"
+                     "        (apply fwritev fref 1 2 3)"
+                     "        (apply fwrite fref 4)"
+                     "        (apply fwritev fref))"
+                     " (apply fclose f))")
+    evaluate(base_env(), prog)
+    assert (tmp_path / "7").read_text() == "1\n2\n3\n4\n"
+
+
+def test_file_buffering(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(lang, "FILE_BUFFER_SIZE", 4)
+    env = base_env()
+    evaluate(env, dsl_parse("((defvar f _ (apply fopen 8)) (defvar fref _ (mkref f)) (apply fwrite fref 1))"))
+    # Still held in memory
+    assert (tmp_path / "8").read_text() == ""
+    evaluate(env, dsl_parse("(apply fwrite fref 234)"))
+    assert (tmp_path / "8").read_text() == "1\n234\n"
+    evaluate(env, dsl_parse("((apply fwrite fref 5) (apply fclose f))"))
+    assert (tmp_path / "8").read_text() == "1\n234\n5\n"
+
+    f = env.get_bind_val("f")
+    assert f.closed and f.path == "8"
+    with pytest.raises(ValueError):
+        f.write("6")
+
+
+def test_file_buffer_per_handle(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    env = base_env()
+    evaluate(env, dsl_parse("((defvar f _ (apply fopen 9)) (defvar g _ (apply fopen 10)) "
+                            " (defvar fref _ (mkref f)) (defvar gref _ (mkref g)) "
+                            " (apply fwrite fref 1) (apply fwrite gref 1))"))
+    assert (tmp_path / "9").read_text() == (tmp_path / "10").read_text() == ""
+    # Shrinking the buffer writes out whatever no longer fits, and only affects that file
+    evaluate(env, dsl_parse("((apply fsetbuf fref 0) (apply fwrite fref 2) (apply fwrite gref 2))"))
+    assert (tmp_path / "9").read_text() == "1\n2\n"
+    assert (tmp_path / "10").read_text() == ""
+    evaluate(env, dsl_parse("((apply fclose f) (apply fclose g))"))
+    assert (tmp_path / "10").read_text() == "1\n2\n"
+
+
+def test_literals():
+    prog = dsl_parse("(apply + 1.5 2)")
+    assert evaluate(base_env(), prog) == 3.5
+
+    prog = dsl_parse("(nil)")
+    assert evaluate(base_env(), prog) is None
+
+    # Programs built by hand spell their constants as plain strs
+    assert evaluate(base_env(), ('apply', '+', '1', '2')) == 3
+    prog = (('defvar', 'x', '_', '1.5'), ('if', 'true', ('set', 'x', ('apply', '*', 'x', '2')), 'nil'), 'x')
+    assert evaluate(base_env(), prog) == 3.0
+    with pytest.raises(BindingUndefinedError):
+        evaluate(base_env(), ('apply', '+', '1', 'y'))
+
+
+def test_tail_calls():
+    # Far deeper than the Python recursion limit would allow if each call took up stack frames
+    prog = dsl_parse("((defun count (un val int) ((n (un val int)) (acc (un val int))) "
+                     "     (if (apply = n 0) acc (apply count (apply - n 1) (apply + acc 1)))) "
+                     " (apply count 3000 0))")
+    assert evaluate(base_env(), prog) == 3000
+
+    # Mutual recursion, with the tail call at the end of a sequence inside a scope
+    prog = dsl_parse("((defun even (un val bool) ((n (un val int))) "
+                     "     (if (apply = n 0) true (scope (defvar m (un val int) (apply - n 1)) (apply odd m)))) "
+                     " (defun odd (un val bool) ((n (un val int))) "
+                     "     (if (apply = n 0) false (apply even (apply - n 1)))) "
+                     " (apply even 2001))")
+    assert evaluate(base_env(), prog) is False
+
+
+def test_apply_sites_follow_definitions():
+    # The same apply site, with a different f to find each time it's run
+    site = dsl_parse("(apply f 1)")
+    env1, env2 = base_env(), base_env()
+    evaluate(env1, dsl_parse("(defun f (un val int) ((n (un val int))) n)"))
+    evaluate(env2, dsl_parse("(defun f (un val int) ((n (un val int))) (apply + n 1))"))
+    assert [evaluate(env1, site), evaluate(env2, site), evaluate(env1, site)] == [1, 2, 1]
+
+    # Even if the environments share their other functions
+    env1, env2 = Env(shared_functions=lang.builtin_fn_vals), Env(shared_functions=lang.builtin_fn_vals)
+    evaluate(env1, dsl_parse("(defun f (un val int) ((n (un val int))) n)"))
+    evaluate(env2, dsl_parse("(defun f (un val int) ((n (un val int))) (apply + n 1))"))
+    assert [evaluate(env1, site), evaluate(env2, site), evaluate(env1, site)] == [1, 2, 1]
+
+    # Or if one was made before an environment it's inside of defined the function, and the other is beside that
+    root = base_env()
+    inner = Env(outer=root)
+    innermost = Env(outer=inner)
+    evaluate(inner, dsl_parse("(defun g (un val int) () 1)"))
+    call_g = dsl_parse("(apply g)")
+    assert evaluate(innermost, call_g) == 1
+    with pytest.raises(BindingUndefinedError):
+        evaluate(Env(outer=root), call_g)
+
+    # And one inside a procedure, where the callee is defined differently by the scope each call comes from
+    call_g = dsl_parse("(defun call-g (un val int) () (apply g))")
+    prog = tuple(("scope", dsl_parse(f"(defun g (un val int) () {n})"), call_g, dsl_parse("(apply call-g)"))
+                 for n in (1, 2))
+    assert evaluate(base_env(), prog) == 2
+
+    # Deallocated environments still can't be used to find functions
+    prog = dsl_parse("((defvar x (un val int) 0) (while (apply < x 0) (apply + x 1) x))")
+    with pytest.raises(DeallocatedEnvError):
+        evaluate(base_env(), prog)
+
+
+def test_apply_sites_hit_across_frames(monkeypatch):
+    monkeypatch.setattr(interpreter, "JIT_THRESHOLD", None)
+    resolved = []
+    resolve_fun = interpreter.resolve_fun
+    monkeypatch.setattr(interpreter, "resolve_fun", lambda env, name: resolved.append(name) or resolve_fun(env, name))
+
+    # Every iteration runs its if branch in a new environment, and every call its body in a new frame, but the names
+    # still resolve from the same function tables
+    loop = dsl_parse("((defvar i (un val int) 0) (while (apply < i 1000) 0 ((if true (set i (apply + i 1)) 0))) i)")
+    assert interpreter.eval_form(base_env(), loop) == 1000
+    assert sorted(resolved) == ["+", "<"]
+
+    resolved.clear()
+    recursion = dsl_parse("((defun f (un val int) ((n (un val int))) "
+                          "     (if (apply = n 0) 0 (apply + 1 (apply f (apply - n 1))))) "
+                          " (apply f 50))")
+    assert interpreter.eval_form(base_env(), recursion) == 50
+    assert sorted(resolved) == ["+", "-", "=", "f", "f"]
+
+    # Nothing in the cache keeps environments alive
+    assert not any(isinstance(item, Env) for entry in interpreter._apply_cache.values() for item in entry)
+
+
+def test_nested_functions_see_enclosing_functions():
+    prog = dsl_parse("((defun outer (un val int) ((n (un val int))) "
+                     "     (defun inner (un val int) ((m (un val int))) (apply + m 1)) "
+                     "     (apply inner n)) "
+                     " (apply outer 4))")
+    assert evaluate(base_env(), prog) == 5
+
+
+def test_call_frames_share_functions():
+    n_funs = 300
+    defuns = " ".join(f"(defun f{i} (un val int) ((n (un val int))) (apply + n {i}))" for i in range(n_funs))
+    env = base_env()
+    evaluate(env, dsl_parse(f"({defuns})"))
+    assert evaluate(env, dsl_parse(f"(apply f{n_funs - 1} (apply f1 0))")) == n_funs
+
+    frame = env.get_fun_def("f1").make_frame([0])
+    assert frame.functions.maps[1] is env.functions
+    assert frame.functions.maps[0] == {}
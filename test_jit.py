@@ -0,0 +1,112 @@
+import pytest
+
+import interpreter
+import jit
+import language as lang
+from dsl_parser import dsl_parse
+from env import Env
+from typecheck_errors import BindingRedefinitionError, DeallocatedEnvError
+
+
+def run(src, threshold):
+    env = Env(defaults=lang.builtin_fn_vals)
+    old, interpreter.JIT_THRESHOLD = interpreter.JIT_THRESHOLD, threshold
+    try:
+        return interpreter.evaluate(env, dsl_parse(src)), env
+    finally:
+        interpreter.JIT_THRESHOLD = old
+
+
+def run_both(src):
+    """
+    Run src with every call compiled, and with nothing compiled, checking that both agree (including on errors)
+    """
+    results = []
+    for threshold in (1, None):
+        try:
+            results.append(("ok", run(src, threshold)[0]))
+        except Exception as err:
+            results.append(("error", type(err)))
+    assert results[0] == results[1]
+    return results[0]
+
+
+def test_hot_functions_get_compiled():
+    src = ("((defun fib (un val int) ((n (un val int))) "
+           "     (if (apply < n 2) n (apply + (apply fib (apply - n 1)) (apply fib (apply - n 2))))) "
+           " (apply fib 15))")
+    ret, env = run(src, 50)
+    assert ret == 610
+    fib = env.get_fun_def("fib")
+    assert fib.jit_code is not None
+    assert "def fib(" in jit.source_of(fib) and "(a1 < 2)" in jit.source_of(fib)
+    assert jit.source_of(fib) in jit.dump(env)
+
+    ret, env = run(src, None)
+    assert ret == 610 and jit.source_of(env.get_fun_def("fib")) is None
+
+    # Nothing is compiled unless asked for
+    env = Env(defaults=lang.builtin_fn_vals)
+    assert interpreter.evaluate(env, dsl_parse(src)) == 610
+    assert env.get_fun_def("fib").jit_code is None
+
+
+def test_tail_calls_become_loops():
+    ret, env = run("((defun count (un val int) ((n (un val int)) (acc (un val int))) "
+                   "     (if (apply = n 0) acc (apply count (apply - n 1) (apply + acc 1)))) "
+                   " (apply count 100000 0))", 1)
+    assert ret == 100000
+    assert "continue" in jit.source_of(env.get_fun_def("count"))
+
+    # Tail calls to other procedures still go through the trampoline
+    assert run_both("((defun even (un val bool) ((n (un val int))) (if (apply = n 0) true (apply odd (apply - n 1)))) "
+                    " (defun odd (un val bool) ((n (un val int))) (if (apply = n 0) false (apply even (apply - n 1)))) "
+                    " (apply even 5001))") == ("ok", False)
+
+
+def test_agrees_with_tree_walker():
+    # Variables, scopes, loops, and arguments which have side effects
+    assert run_both("((defun f (un val int) ((n (un val int))) "
+                    "     (defvar acc (un val int) 0) "
+                    "     (while (apply > n 0) 0 ((set acc (apply + acc n)) (set n (apply - n 1)) acc)) "
+                    "     (scope (defvar t (un val int) (apply + acc 1)) (set acc t)) "
+                    "     (apply + acc ((set acc 100) acc))) "
+                    " (apply f 10))") == ("ok", 156)
+
+    # Variables defined in a branch aren't visible outside it
+    assert run_both("((defun f (un val int) () (if true (defvar t (un val int) 1) (defvar u (un val int) 2)) t) "
+                    " (apply f))")[0] == "error"
+
+    # defvars in a loop body fail on the second time round
+    assert run_both("((defun f (un val int) ((n (un val int))) "
+                    "     (while (apply > n 0) 0 ((defvar t (un val int) n) (set n (apply - n 1)) t))) "
+                    " (apply f 2))") == ("error", BindingRedefinitionError)
+
+    # The default clause of a loop is evaluated in a deallocated environment
+    assert run_both("((defun f (un val int) ((n (un val int))) (while (apply > n 0) (apply + n 1) n)) "
+                    " (apply f 0))") == ("error", DeallocatedEnvError)
+    assert run_both("((defun f (un val int) ((n (un val int))) (while (apply > n 0) 7 n)) "
+                    " (apply f 0))") == ("ok", 7)
+
+    assert run_both("((defun f (un val int) ((n (un val int))) n) (apply f 1 2))") == ("error", RuntimeError)
+    # Including when a compiled procedure calls itself with the wrong number of arguments
+    assert run_both("((defun f (un val int) ((n (un val int))) (if (apply > n 0) (apply + 1 (apply f)) 0)) "
+                    " (apply f 1))") == ("error", RuntimeError)
+
+
+def test_unsupported_bodies_stay_interpreted():
+    ret, env = run("((defun f (un val int) ((n (un val int))) (defvar r (un ref (un val int)) (mkref n)) (deref r)) "
+                   " (apply f 3))", 1)
+    assert ret == 3
+    assert env.get_fun_def("f").jit_code is None
+
+
+def test_memo_disables_direct_self_calls():
+    ret, env = run("((defun fib (un val int) ((n (un val int))) "
+                   "     (if (apply < n 2) n (apply + (apply fib (apply - n 1)) (apply fib (apply - n 2))))) "
+                   " (apply fib 10))", 1)
+    fib = env.get_fun_def("fib")
+    memo = fib.enable_memo(100)
+    assert fib.jit_code is None
+    assert fib(30) == 832040
+    assert memo.misses == 31
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import language as lang
+import metrics
+from affine_checker import AffineTypeChecker as ATC
+from dsl_parser import dsl_parse, dsl_parse_stream
+from env import Env, TypeCheckEnv
+from interpreter import evaluate
+
+SRC = ("((defvar x (un val int) 0) "
+       " (if (apply < x 1) (set x 1) (set x 2)) "
+       " x)")
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry():
+    metrics.reset()
+    yield
+    metrics.enabled = True
+    metrics.reset()
+
+
+def test_phases():
+    prog = dsl_parse(SRC)
+    ATC.type_check(TypeCheckEnv(defaults=lang.builtin_fn_types), prog)
+    assert evaluate(Env(defaults=lang.builtin_fn_vals), prog) == 1
+    list(dsl_parse_stream("(1) (2) (3)"))
+
+    timers = metrics.snapshot()["timers"]
+    # Nested calls to type_check aren't timed again
+    assert {name: t["count"] for name, t in timers.items()} == {"parse": 4, "check": 1, "eval": 1}
+    assert all(t["total_seconds"] >= t["max_seconds"] > 0 for t in timers.values())
+
+
+def test_checker_counters():
+    ATC.type_check(TypeCheckEnv(defaults=lang.builtin_fn_types), dsl_parse(SRC))
+    counters = metrics.snapshot()["counters"]
+    assert counters["env_journal"] == 1 and "deepcopy_env" not in counters
+    assert counters["is_subtype"] > 0 and counters["deepcopy_type"] > 0
+
+    # Errors still stop the timer
+    with pytest.raises(Exception):
+        ATC.type_check(TypeCheckEnv(defaults=lang.builtin_fn_types), dsl_parse("(apply + y 1)"))
+    assert metrics.snapshot()["timers"]["check"]["count"] == 2
+
+
+def test_disabled():
+    metrics.enabled = False
+    evaluate(Env(defaults=lang.builtin_fn_vals), dsl_parse(SRC))
+    assert metrics.snapshot() == {"counters": {}, "timers": {}}
+
+
+def test_export(tmp_path):
+    registry = metrics.Metrics()
+    registry.count("deepcopy_env", 3)
+    registry.count("odd-name")
+    with registry.timed("eval"):
+        pass
+    registry.observe("eval", 0.5)
+
+    registry.write(str(tmp_path / "m.json"))
+    data = json.loads((tmp_path / "m.json").read_text())
+    assert data["counters"] == {"deepcopy_env": 3, "odd-name": 1}
+    assert data["timers"]["eval"]["count"] == 2 and data["timers"]["eval"]["max_seconds"] == 0.5
+
+    registry.write(str(tmp_path / "m.prom"), fmt="prometheus")
+    lines = (tmp_path / "m.prom").read_text().splitlines()
+    assert "# TYPE dsl_deepcopy_env_total counter" in lines
+    assert "dsl_deepcopy_env_total 3" in lines
+    assert "dsl_odd_name_total 1" in lines
+    assert 'dsl_seconds_count{name="eval"} 2' in lines
+    assert 'dsl_seconds_max{name="eval"} 0.5' in lines
+    # No temporary files left behind
+    assert sorted(tmp_path.iterdir()) == [tmp_path / "m.json", tmp_path / "m.prom"]
+
+    with pytest.raises(ValueError):
+        registry.write(str(tmp_path / "m.txt"), fmt="xml")
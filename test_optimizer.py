@@ -0,0 +1,80 @@
+import pytest
+
+import language as lang
+from affine_checker import AffineTypeChecker
+from dsl_parser import dsl_parse, Literal
+from env import Env, TypeCheckEnv
+from interpreter import evaluate
+from optimizer import optimize
+from session import Session
+
+
+def check_and_optimize(src):
+    prog = dsl_parse(src)
+    AffineTypeChecker.type_check(TypeCheckEnv(defaults=lang.builtin_fn_types), prog)
+    return prog, optimize(prog)
+
+
+def test_folds_builtin_calls():
+    prog, opt = check_and_optimize("(apply + (apply + 2 3) (apply - 10 3))")
+    assert opt == "12" and opt.__class__ is Literal and opt.value == 12
+
+    prog, opt = check_and_optimize("(apply not (apply = 3 3))")
+    assert opt.value is False
+
+
+def test_folds_inside_loops_but_keeps_them():
+    prog, opt = check_and_optimize("((defvar x (un val int) 0) "
+                                   " (while (apply < x 10) 0 ((set x (apply + x (apply + 3 4))) x)) "
+                                   " x)")
+    assert opt[1][0] == "while"
+    assert opt[1][3][0] == ("set", "x", ("apply", "+", "x", "7"))
+    assert evaluate(Env(defaults=lang.builtin_fn_vals), opt) == 14
+
+
+def test_drops_dead_branches():
+    prog, opt = check_and_optimize("(if (apply < 1 2) (apply + 1 1) (apply + 2 2))")
+    assert opt == "2" and opt.value == 2
+
+    # A bare variable is kept as it is, even one named like a macro
+    prog, opt = check_and_optimize("((defvar set (un val int) 5) (if true set 0))")
+    assert opt[1] == "set"
+    assert evaluate(Env(defaults=lang.builtin_fn_vals), opt) == 5
+
+    # The taken branch still gets its own scope
+    prog, opt = check_and_optimize("((if true (defvar x (un val int) 1) (defvar x (un val int) 2)) "
+                                   " (defvar x (un val int) 3) x)")
+    assert evaluate(Env(defaults=lang.builtin_fn_vals), opt) == 3
+
+
+def test_leaves_effects_and_errors_for_runtime():
+    # Files are never opened ahead of time, and division by zero still raises when the program is run
+    prog = dsl_parse("((defvar f (lin val file) (apply fopen (apply + 1 2))) (apply fclose f))")
+    assert optimize(prog)[0][3] == ("apply", "fopen", "3")
+
+    prog = dsl_parse("(apply / 1 0)")
+    assert optimize(prog) is prog
+
+
+def test_respects_user_definitions():
+    prog = dsl_parse("(scope (defun f (un val int) () (defun + (un val int) ((a (un val int)) (b (un val int))) a) "
+                     "                             (apply + 1 2)) "
+                     "       (apply f))")
+    assert optimize(prog) is prog
+    assert evaluate(Env(defaults=lang.builtin_fn_vals), prog) == 1
+
+
+def test_shares_unchanged_structure():
+    prog = dsl_parse("(defvar x (un val int) (apply + 1 (apply + y 2)))")
+    opt = optimize(prog)
+    assert opt[3] == ("apply", "+", "1", ("apply", "+", "y", "2"))
+    assert opt[3][3] is prog[3][3]
+
+
+def test_session_optimizes_checked_forms():
+    s = Session(optimize=True)
+    s.feed("(defvar x (un val int) (apply + 1 2))")
+    assert s.feed("(if (apply = 1 1) x 0)") == 3
+
+    with pytest.raises(ValueError):
+        Session(typecheck=False, optimize=True)
@@ -0,0 +1,67 @@
+import os
+import time
+
+from dsl_parser import dsl_parse
+from parse_cache import ParseCache, ENTRY_SUFFIX
+
+SRC = "((defvar x (un val int) 3) (while (apply < x 10) 0 (set x (apply + x 1))) x ())"
+
+
+def test_roundtrip(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    assert dsl_parse(SRC, cache=cache) == dsl_parse(SRC)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # A fresh cache over the same directory picks up the stored entry
+    cache = ParseCache(str(tmp_path))
+    assert dsl_parse(SRC, cache=cache) == dsl_parse(SRC)
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_atom_program(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    dsl_parse("x", cache=cache)
+    assert dsl_parse("x", cache=cache) == "x"
+    assert cache.hits == 1
+
+
+def test_keyed_on_content(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    dsl_parse(SRC, cache=cache)
+    assert dsl_parse("(apply + 1 2)", cache=cache) == ('apply', '+', '1', '2')
+    assert cache.misses == 2
+
+
+def test_corrupt_entry_is_invalidated(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    dsl_parse(SRC, cache=cache)
+    with open(cache.entry_path(SRC), 'r+b') as f:
+        f.write(b'JUNK')
+
+    assert dsl_parse(SRC, cache=cache) == dsl_parse(SRC)
+    assert cache.misses == 2
+    # ... and the rewritten entry is usable again
+    assert dsl_parse(SRC, cache=cache) == dsl_parse(SRC)
+    assert cache.hits == 1
+
+
+def test_lru_eviction(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    dsl_parse(SRC, cache=cache)
+    entry_size = os.path.getsize(cache.entry_path(SRC))
+
+    cache.max_bytes = 2 * entry_size + 100
+    srcs = [SRC.replace('10', str(n)) for n in (11, 12)]
+    for src in srcs:
+        dsl_parse(src, cache=cache)
+
+    # Make the first entry the most recently used, then overflow the cache
+    past = time.time() - 100
+    for src in srcs:
+        os.utime(cache.entry_path(src), (past, past))
+    dsl_parse(SRC, cache=cache)
+    dsl_parse(SRC.replace('10', '13'), cache=cache)
+
+    remaining = [n for n in os.listdir(str(tmp_path)) if n.endswith(ENTRY_SUFFIX)]
+    assert len(remaining) == 2
+    assert os.path.exists(cache.entry_path(SRC))
@@ -0,0 +1,78 @@
+import pytest
+
+import interpreter
+import language as lang
+from dsl_parser import dsl_parse
+from env import Env
+from interpreter import Procedure
+from profiler import TOPLEVEL, profile, profiling
+
+FIB = ("((defun fib (un val int) ((n (un val int))) "
+       "    (if (apply < n 2) n (apply + (apply fib (apply - n 1)) (apply fib (apply - n 2))))) "
+       " (defun count (un val int) ((n (un val int))) "
+       "    (defvar i (un val int) 0) "
+       "    (while (apply < i n) 0 ((set i (apply + i 1)))) "
+       "    i) "
+       " (apply + (apply fib 10) (apply count 25)))")
+
+
+def base_env():
+    return Env(defaults=lang.builtin_fn_vals)
+
+
+def test_counts():
+    value, prof = profile(base_env(), dsl_parse(FIB))
+    assert value == 55 + 25
+
+    fib, count = prof.functions["fib"], prof.functions["count"]
+    assert fib.calls == 177
+    assert count.calls == 1 and count.iterations == 25
+    assert list(prof.loops) == ["while#1"]
+    assert prof.loops["while#1"].calls == 1 and prof.loops["while#1"].iterations == 25
+    assert fib.exclusive <= fib.inclusive <= prof.stats[TOPLEVEL].inclusive
+
+
+def test_loops_labelled_in_order():
+    _, prof = profile(base_env(), dsl_parse("((defvar i (un val int) 0)\n"
+                                            " (while (apply < i 3) 0\n"
+                                            "    ((while false 0 1)\n"
+                                            "     (set i (apply + i 1)))))"))
+    assert prof.loops["while#1"].iterations == 3
+    assert prof.loops["while#2"].calls == 3 and prof.loops["while#2"].iterations == 0
+    assert prof.stats[TOPLEVEL].iterations == 3
+
+
+def test_tail_calls_still_constant_space():
+    prog = dsl_parse("((defun count (un val int) ((n (un val int)) (acc (un val int))) "
+                     "     (if (apply = n 0) acc (apply count (apply - n 1) (apply + acc 1)))) "
+                     " (apply count 5000 0))")
+    value, prof = profile(base_env(), prog)
+    assert value == 5000
+    assert prof.functions["count"].calls == 5001
+    # Each tail call replaces its caller
+    assert set(prof.stacks) <= {TOPLEVEL, f"{TOPLEVEL};count"}
+
+
+def test_output():
+    _, prof = profile(base_env(), dsl_parse(FIB))
+    for line in prof.collapsed().splitlines():
+        path, micros = line.rsplit(" ", 1)
+        assert path.startswith(TOPLEVEL) and int(micros) > 0
+    assert f"{TOPLEVEL};fib;fib;fib" in prof.stacks
+    assert f"{TOPLEVEL};count;while#1" in prof.stacks
+
+    table = prof.table(n=2).splitlines()
+    assert len(table) == 3 and table[0].split()[:3] == ["name", "kind", "calls"]
+    assert [label for label, _ in prof.top(1, key="calls")] == ["fib"]
+
+
+def test_hooks_removed_afterwards():
+    eval_form, run, threshold = interpreter.eval_form, Procedure.run, interpreter.JIT_THRESHOLD
+    with pytest.raises(ZeroDivisionError):
+        with profiling() as prof:
+            with pytest.raises(RuntimeError):
+                prof.enable()
+            interpreter.evaluate(base_env(), dsl_parse("(apply / 1 0)"))
+    assert (interpreter.eval_form, Procedure.run, interpreter.JIT_THRESHOLD) == (eval_form, run, threshold)
+    with pytest.raises(RuntimeError):
+        prof.disable()
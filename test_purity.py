@@ -0,0 +1,72 @@
+import pytest
+
+import language as lang
+from dsl_parser import dsl_parse
+from env import Env
+from interpreter import evaluate
+from purity import pure_functions, memoize_pure, is_pure_signature
+
+FIB = ("(defun fib (un val int) ((n (un val int))) "
+       "    (if (apply < n 2) n (apply + (apply fib (apply - n 1)) (apply fib (apply - n 2)))))")
+
+
+def test_pure_functions():
+    prog = dsl_parse("(" + FIB +
+                     " (defun fib-twice (un val int) ((n (un val int))) (apply + (apply fib n) (apply fib n)))"
+                     " (defun uses-ref (un val int) ((n (un val int))) (defvar r (un ref (un val int)) (mkref n)) n)"
+                     " (defun takes-lin (un val int) ((n (lin val int))) n)"
+                     " (defun calls-impure (un val int) ((n (un val int))) (apply uses-ref n))"
+                     " (defun writes (un val int) ((n (un val int))) (defvar f (lin val file) (apply fopen n)) "
+                     "     (apply fclose f) n))")
+    assert pure_functions(prog) == {"fib", "fib-twice"}
+
+
+def test_builtin_signatures():
+    assert is_pure_signature(lang.builtin_fn_types["not"]) is False  # Takes a linear bool
+    assert not any(is_pure_signature(lang.builtin_fn_types[f]) for f in ("fopen", "fwrite", "fclose"))
+
+
+def test_ambiguous_names_are_impure():
+    prog = dsl_parse("((scope (defun f (un val int) () 1)) (scope (defun f (un val int) () 2)))")
+    assert pure_functions(prog) == set()
+
+
+@pytest.mark.parametrize("engine", ["tree", "closure", "vm", "stack"])
+def test_memoization(engine):
+    env = Env(defaults=lang.builtin_fn_vals)
+    prog = dsl_parse(FIB)
+    evaluate(env, prog, engine=engine)
+    memos = memoize_pure(env, prog, max_size=100)
+
+    # Without the memo this would take over a trillion calls
+    assert evaluate(env, dsl_parse("(apply fib 60)"), engine=engine) == 1548008755920
+    memo = memos["fib"]
+    assert memo.misses == 61 and memo.hits == 58
+
+    assert evaluate(env, dsl_parse("(apply fib 60)"), engine=engine) == 1548008755920
+    assert memo.hits == 59
+
+
+def test_memo_evicts_least_recently_used():
+    env = Env(defaults=lang.builtin_fn_vals)
+    prog = dsl_parse("(defun sq (un val int) ((n (un val int))) (apply + n n))")
+    evaluate(env, prog)
+    memo = memoize_pure(env, prog, max_size=2)["sq"]
+
+    for n in (1, 2, 1, 3):
+        evaluate(env, dsl_parse(f"(apply sq {n})"))
+    assert list(memo.entries) == [((int, 1),), ((int, 3),)]
+    assert (memo.hits, memo.misses) == (1, 3)
+
+
+def test_memo_tells_equal_arguments_apart():
+    env = Env(defaults=lang.builtin_fn_vals)
+    prog = dsl_parse("(defun double (un val int) ((n (un val int))) (apply + n n))")
+    evaluate(env, prog)
+    memo = memoize_pure(env, prog)["double"]
+
+    assert evaluate(env, dsl_parse("(apply double 1)")) == 2
+    # Equal to 1, but not the same argument
+    doubled = evaluate(env, dsl_parse("(apply double 1.0)"))
+    assert doubled == 2.0 and type(doubled) is float
+    assert memo.misses == 2
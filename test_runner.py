@@ -0,0 +1,56 @@
+import io
+import json
+
+import pytest
+
+import runner
+
+
+def programs(n):
+    return [(f"p{i}", f"((defvar x (un val int) {i}) (apply + x x))") for i in range(n)]
+
+
+def test_results_in_order():
+    results = list(runner.run_batch(programs(30), workers=2))
+    assert [r["id"] for r in results] == [f"p{i}" for i in range(30)]
+    assert [r["value"] for r in results] == [2 * i for i in range(30)]
+
+
+def test_unordered_results():
+    results = list(runner.run_batch(programs(30), workers=2, ordered=False))
+    assert sorted((r["id"], r["value"]) for r in results) == sorted((f"p{i}", 2 * i) for i in range(30))
+
+
+def test_errors_are_reported():
+    jobs = [("bad-type", "(defvar x (un val int) true)"), ("bad-syntax", "(apply + 1"), ("good", "(apply not true)")]
+    results = list(runner.run_batch(jobs, workers=1))
+    assert results[0]["error"].startswith("TypeMismatchError")
+    assert results[1]["error"].startswith("SyntaxError")
+    assert results[2] == {"id": "good", "value": False}
+
+    # Without type-checking the first one runs
+    results = list(runner.run_batch(jobs[:1], workers=1, typecheck=False, engine="vm"))
+    assert results == [{"id": "bad-type", "value": None}]
+
+    with pytest.raises(ValueError):
+        list(runner.run_batch(jobs, engine="nope"))
+
+
+def test_reading_jobs(tmp_path):
+    (tmp_path / "b.dsl").write_text("(apply + 1 2)")
+    (tmp_path / "a.dsl").write_text("(apply - 1 2)")
+    (tmp_path / "notes.txt").write_text("not a program")
+    assert list(runner.jobs_from_directory(str(tmp_path))) == [("a.dsl", "(apply - 1 2)"), ("b.dsl", "(apply + 1 2)")]
+
+    lines = ['{"id": "x", "source": "(apply + 1 2)"}', '', '"(apply + 3 4)"']
+    assert list(runner.jobs_from_jsonl(lines)) == [("x", "(apply + 1 2)"), ("3", "(apply + 3 4)")]
+
+
+def test_command_line(tmp_path, capsys, monkeypatch):
+    (tmp_path / "a.dsl").write_text("(apply + 1 2)")
+    assert runner.main([str(tmp_path), "--workers", "1"]) == 0
+    assert [json.loads(line) for line in capsys.readouterr().out.splitlines()] == [{"id": "a.dsl", "value": 3}]
+
+    monkeypatch.setattr("sys.stdin", io.StringIO('{"source": "(apply + x 1)"}\n'))
+    assert runner.main(["-", "--workers", "1"]) == 1
+    assert "BindingUndefinedError" in capsys.readouterr().out
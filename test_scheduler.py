@@ -0,0 +1,87 @@
+import pytest
+
+import language as lang
+from dsl_parser import dsl_parse
+from env import Env
+from interpreter import evaluate
+from scheduler import FuelExhausted, Scheduler, Status
+
+
+def base_env():
+    return Env(defaults=lang.builtin_fn_vals)
+
+
+def counter(n):
+    return dsl_parse(f"((defvar i (un val int) 0) (while (apply < i {n}) 0 ((set i (apply + i 1)))) i)")
+
+
+def test_agrees_with_tree_walker():
+    progs = [counter(50),
+             dsl_parse("((defun fib (un val int) ((n (un val int))) "
+                       "    (if (apply < n 2) n (apply + (apply fib (apply - n 1)) (apply fib (apply - n 2))))) "
+                       " (apply fib 12))"),
+             dsl_parse("((defun count (un val int) ((n (un val int)) (acc (un val int))) "
+                       "     (if (apply = n 0) acc (apply count (apply - n 1) (apply + acc 1)))) "
+                       " (apply count 3000 0))")]
+    scheduler = Scheduler(quantum=7)
+    for prog in progs:
+        scheduler.spawn(base_env(), prog)
+    tasks = scheduler.run()
+    assert [t.status for t in tasks] == [Status.done] * len(progs)
+    assert [t.value for t in tasks] == [evaluate(base_env(), prog) for prog in progs]
+
+
+def test_long_loops_dont_starve_others():
+    scheduler = Scheduler(quantum=10)
+    long_task = scheduler.spawn(base_env(), counter(10000))
+    short_tasks = [scheduler.spawn(base_env(), counter(20)) for _ in range(1000)]
+
+    finished = []
+    while True:
+        task = scheduler.step()
+        if task is None:
+            break
+        if task.status != Status.ready:
+            finished.append(task)
+    assert finished[-1] is long_task
+    assert all(t.value == 20 and t.turns < long_task.turns for t in short_tasks)
+    assert long_task.value == 10000
+
+
+def test_budget_aborts_program():
+    scheduler = Scheduler(quantum=5)
+    runaway = scheduler.spawn(base_env(), dsl_parse("(while true 0 (1))"), budget=100)
+    fine = scheduler.spawn(base_env(), counter(30), budget=100)
+    scheduler.run()
+
+    assert runaway.status == Status.aborted
+    assert isinstance(runaway.error, FuelExhausted)
+    assert runaway.fuel_used == 100
+    assert not runaway.machine.todo
+    assert fine.status == Status.done and fine.value == 30
+
+
+def test_priority():
+    scheduler = Scheduler(quantum=10, by_priority=True)
+    low = scheduler.spawn(base_env(), counter(100), priority=0)
+    high = [scheduler.spawn(base_env(), counter(100), priority=5) for _ in range(3)]
+
+    order = []
+    while scheduler.step() is not None:
+        order.extend(t for t in [low] + high if t.status == Status.done and t not in order)
+    assert order[-1] is low
+    # Programs of the same priority take turns
+    assert all(t.turns == high[0].turns for t in high)
+
+
+def test_errors_dont_stop_others():
+    scheduler = Scheduler()
+    bad = scheduler.spawn(base_env(), dsl_parse("(apply + x 1)"), task_id="bad")
+    good = scheduler.spawn(base_env(), counter(5), task_id="good")
+    scheduler.run()
+
+    assert bad.status == Status.failed and "x is undefined" in str(bad.error)
+    assert good.status == Status.done and good.value == 5
+
+    with pytest.raises(ValueError):
+        Scheduler(quantum=0)
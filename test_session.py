@@ -0,0 +1,62 @@
+import pytest
+
+import metrics
+import typecheck_errors as tc_err
+from session import Session
+
+
+def test_feed_accumulates_state():
+    s = Session()
+    assert s.feed("(defvar x (un val int) 3)") is None
+    assert s.feed("(defun add-3 (un val int) ((y (un val int))) (apply + y 3))") is None
+    assert s.feed("(apply add-3 x)") == 6
+    assert s.feed("(set x (apply add-3 x)) x") == 6
+    s.close()
+
+
+def test_failed_check_rolls_back():
+    s = Session()
+    s.feed("(defvar x (aff val int) 3)")
+    with pytest.raises(tc_err.LinAffineVariableReuseError):
+        s.feed("((apply + x 1) (apply + x 1))")
+
+    # The failed cell used up x in the checker, but that has been undone
+    assert s.feed("(apply + x 1)") == 4
+
+
+def test_failed_check_forgets_definitions():
+    s = Session()
+    with pytest.raises(tc_err.TypeMismatchError):
+        s.feed("((defvar y (un val int) 1) (defvar z (un val bool) y))")
+    assert s.feed("(defvar y (un val int) 2) y") == 2
+
+
+def test_check_cost_doesnt_grow_with_history():
+    def copies_per_cell(history):
+        s = Session()
+        for i in range(history):
+            s.feed(f"(defvar x{i} (un val int) {i})")
+        metrics.reset()
+        with pytest.raises(tc_err.LinAffineVariableReuseError):
+            s.feed("((defvar a (aff val int) 1) (apply + a 1) (apply + a 1))")
+        s.feed("(set x0 (apply + x0 1))")
+        return metrics.snapshot()["counters"]
+
+    # Neither checking a cell nor rolling one back copies the environment left by the cells before it
+    few, many = copies_per_cell(5), copies_per_cell(500)
+    assert "deepcopy_env" not in many
+    assert few == many
+
+
+def test_close_checks_linear_judgements():
+    s = Session()
+    s.feed("(defvar x (lin val int) 3)")
+    with pytest.raises(tc_err.UnusedLinVariableError):
+        s.close()
+
+
+def test_untyped_session():
+    s = Session(typecheck=False)
+    s.feed("(defvar x _ 0)")
+    s.feed("(while (apply < x 50) 0 (set x (apply + x 1)))")
+    assert s.feed("x") == 50
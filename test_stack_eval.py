@@ -0,0 +1,68 @@
+import sys
+
+import pytest
+
+import language as lang
+import stack_eval
+from dsl_parser import atom, dsl_parse
+from env import Env
+
+
+def base_env():
+    return Env(defaults=lang.builtin_fn_vals)
+
+
+def test_deeply_nested_expressions():
+    depth = sys.getrecursionlimit() * 10
+    prog = atom("0")
+    for _ in range(depth):
+        prog = ("apply", atom("+"), atom("1"), prog)
+    assert stack_eval.evaluate(base_env(), prog) == depth
+
+    prog = atom("7")
+    for _ in range(depth):
+        prog = ("scope", prog)
+    assert stack_eval.evaluate(base_env(), prog) == 7
+
+
+def test_deeply_nested_program():
+    # Parsed, and each scope gets an environment of its own, so both reading the program and looking x up from the
+    # innermost scope have to cope with nesting deeper than Python's recursion limit
+    depth = sys.getrecursionlimit() * 3
+    source = "((defvar x (un val int) 7) " + "(scope (if true " * depth + "(apply + x 1)" + " 0))" * depth + ")"
+    prog = dsl_parse(source)
+    assert stack_eval.evaluate(base_env(), prog) == 8
+
+
+def test_deep_recursion():
+    # Not a tail call, so every level keeps a continuation around
+    prog = dsl_parse("((defun count (un val int) ((n (un val int))) "
+                     "     (if (apply = n 0) 0 (apply + 1 (apply count (apply - n 1))))) "
+                     " (apply count 20000))")
+    assert stack_eval.evaluate(base_env(), prog) == 20000
+
+
+def test_tail_calls_run_in_constant_space():
+    prog = dsl_parse("((defun count (un val int) ((n (un val int))) "
+                     "     (if (apply = n 0) 0 (apply count (apply - n 1)))) "
+                     " (apply count 1000))")
+    machine = stack_eval.Machine(base_env(), prog)
+    deepest = 0
+    while not machine.run(max_steps=1):
+        deepest = max(deepest, len(machine.todo))
+    assert machine.result == 0
+    assert deepest < 10
+
+
+def test_machine_is_resumable():
+    prog = dsl_parse("((defvar x (un val int) 0) "
+                     " (while (apply < x 50) 0 (set x (apply + x 1))) "
+                     " x)")
+    machine = stack_eval.Machine(base_env(), prog)
+    with pytest.raises(RuntimeError):
+        machine.result
+    runs = 1
+    while not machine.run(max_steps=7):
+        runs += 1
+    assert machine.result == 50
+    assert runs == -(-machine.steps // 7)
@@ -0,0 +1,45 @@
+import pytest
+
+import language as lang
+import vm
+from dsl_parser import dsl_parse
+from env import Env
+from typecheck_errors import BindingUndefinedError
+
+
+def base_env():
+    return Env(defaults=lang.builtin_fn_vals)
+
+
+def test_builtin_calls_are_fused():
+    code = vm.compile_program(dsl_parse("(apply + (apply not true) (apply fopen 3))"))
+    ops = code.ops[::2].tolist()
+    assert ops.count(vm.CALL_BUILTIN2) == 1
+    assert ops.count(vm.CALL_BUILTIN1) == 1
+    assert ops.count(vm.CALL) == 1
+    assert 'CALL_BUILTIN2' in code.disassemble()
+
+
+def test_fused_builtins_respect_environment():
+    # The builtins aren't visible in an empty environment, so the fused instruction can't just go ahead and add
+    prog = dsl_parse("(apply + 1 2)")
+    with pytest.raises(BindingUndefinedError):
+        vm.evaluate(Env(), prog)
+    assert vm.evaluate(base_env(), prog) == 3
+
+
+def test_deep_recursion():
+    # DSL calls don't use up Python stack frames, so this recursion is much deeper than the interpreter could manage
+    prog = dsl_parse("((defun count (un val int) ((n (un val int))) "
+                     "     (defvar ret (un val int) 0) "
+                     "     (if (apply = n 0) (set ret 0) (set ret (apply + 1 (apply count (apply - n 1))))) "
+                     "     ret) "
+                     " (apply count 5000))")
+    assert vm.evaluate(base_env(), prog) == 5000
+
+
+def test_malformed_form_only_fails_when_run():
+    prog = dsl_parse("(if false (set x) 3)")
+    assert vm.evaluate(base_env(), prog) == 3
+    with pytest.raises(TypeError):
+        vm.evaluate(base_env(), dsl_parse("(if true (set x) 3)"))
@@ -0,0 +1,385 @@
+"""
+A bytecode compiler and stack-based virtual machine for DSL programs: an alternative to interpreter.eval_form.
+
+Programs are compiled to a CodeObject: a flat instruction stream of (opcode, argument) pairs together with a constant
+pool, a table of the names which the code refers to, and tables for the operands of calls and defuns. Calls to the
+arithmetic / comparison / logical builtins are compiled to fused instructions which skip the function lookup
+altogether. Calls to other DSL functions compiled for the VM don't recurse in Python: the VM keeps its own call stack.
+"""
+
+from array import array
+from typing import List
+
+import language as lang
+from dsl_parser import Literal, atom
+from env import Env
+from interpreter import Procedure
+
+#############
+# Opcodes   #
+#############
+
+CONST = 0           # push consts[arg]
+LOAD = 1            # push the value bound to names[arg]
+POP = 2             # discard the top of the stack
+DEFVAR = 3          # bind names[arg] to the popped value, push nil
+SET = 4             # set names[arg] to the popped value, push nil
+CALL = 5            # calls[arg] = (name, argc): call the named function on the top argc values
+CALL_BUILTIN1 = 6   # builtins[arg] = (name, fn): apply a unary builtin to the top of the stack
+CALL_BUILTIN2 = 7   # builtins[arg] = (name, fn): apply a binary builtin to the top two values
+JUMP = 8            # jump to arg
+JUMP_IF_FALSE = 9   # pop the top of the stack, and jump to arg if it is falsy
+ENTER_SCOPE = 10    # make a new Env (enclosed by the current one) current
+EXIT_SCOPE = 11     # make the Env which enclosed the current one current again
+DEALLOCATE = 12     # deallocate the current Env
+JUMP_IF_SET = 13    # jump to arg unless the top of the stack is the NOT_RUN marker, which is popped
+DEFUN = 14          # defuns[arg] = (fname, argspec_ls, fn_body, code): define the function, push nil
+MKREF = 15          # push a reference to names[arg]
+SETREF = 16         # set names[arg] to the popped value, push nil
+DEREF = 17          # push the value referred to by the reference names[arg]
+SETREFVAL = 18      # set the value referred to by the reference names[arg] to the popped value, push nil
+RAISE = 19          # raise consts[arg]
+RETURN = 20         # return the top of the stack to the caller
+
+# Builtins which the compiler turns into fused instructions, and how many arguments they take
+fusable_builtins = {name: 2 for name in ('+', '-', '*', '/', '>', '<', '>=', '<=', '=', 'or', 'and')}
+fusable_builtins['not'] = 1
+
+
+class _NotRun:
+    def __repr__(self):
+        return 'NOT_RUN'
+
+
+# Marks that the body of a while loop never ran, so the default clause should be evaluated
+NOT_RUN = _NotRun()
+
+
+class CodeObject:
+    def __init__(self):
+        self.ops = array('i')
+        self.consts = []
+        self.names = []
+        self.calls = []
+        self.builtins = []
+        self.defuns = []
+        self._index = {}
+
+    def emit(self, op: int, arg: int = 0) -> int:
+        """
+        Append an instruction, returning its position so that jumps to be patched later can refer to it
+        """
+        self.ops.append(op)
+        self.ops.append(arg)
+        return len(self.ops) - 2
+
+    def here(self) -> int:
+        return len(self.ops)
+
+    def patch(self, pos: int, target: int) -> None:
+        self.ops[pos + 1] = target
+
+    def add(self, table: List, key, *value) -> int:
+        """
+        Add value (or key, if no value is given) to one of the operand tables unless an entry for key is already
+        there, returning its index
+        """
+        k = (id(table), key)
+        if k not in self._index:
+            self._index[k] = len(table)
+            table.append(value[0] if value else key)
+        return self._index[k]
+
+    def const(self, value) -> int:
+        # Constants are keyed by type as well, so that (say) 1 and True don't get merged. Anything that isn't a plain
+        # value (like T_NIL, which isn't hashable) is only merged with itself.
+        if isinstance(value, (int, float, str, type(None))):
+            return self.add(self.consts, (type(value), value), value)
+        return self.add(self.consts, ('object', id(value)), value)
+
+    def disassemble(self) -> str:
+        opnames = {v: k for k, v in globals().items() if isinstance(v, int) and k.isupper() and not k.startswith('_')}
+        lines = []
+        for pc in range(0, len(self.ops), 2):
+            op, arg = self.ops[pc], self.ops[pc + 1]
+            lines.append(f'{pc:5} {opnames[op]:14} {arg}')
+        return '\n'.join(lines)
+
+
+class VMProcedure(Procedure):
+    def __init__(self, defaults, argspec_ls, fn_body, code: CodeObject):
+        super().__init__(defaults, argspec_ls, fn_body)
+        self.code = code
+        self._fused_ok = None
+
+    def run(self, argvals):
+        frame = self.make_frame(argvals)
+        return run(self.code, frame, self.fused_ok(frame))
+
+    def fused_ok(self, frame: Env) -> bool:
+        """
+        Whether the fused builtin instructions in the body are valid in the call frames of this procedure. Functions
+        can't be redefined, so the answer never changes.
+        """
+        if self._fused_ok is None:
+            self._fused_ok = _builtins_visible(self.code, frame)
+        return self._fused_ok
+
+
+###############
+# Compilation #
+###############
+
+def compile_program(prog) -> CodeObject:
+    code = CodeObject()
+    compile_form(code, prog)
+    code.emit(RETURN)
+    return code
+
+
+def compile_form(code: CodeObject, prog) -> None:
+    if isinstance(prog, str):
+        # Programs built by hand rather than parsed may spell constants as plain strs
+        prog = atom(prog)
+        if prog.__class__ is Literal:
+            code.emit(CONST, code.const(prog.value))
+        else:
+            code.emit(LOAD, code.add(code.names, prog))
+    elif len(prog) == 0:
+        code.emit(CONST, code.const(lang.T_NIL))
+    elif prog[0] in macro_compilers:
+        start = code.here()
+        try:
+            macro_compilers[prog[0]](code, *prog[1:])
+        except TypeError as err:
+            # A malformed form is only an error if it's actually evaluated, so defer raising it
+            del code.ops[start:]
+            code.emit(RAISE, code.const(err))
+    else:
+        compile_sequence(code, prog)
+
+
+def compile_sequence(code: CodeObject, prog_ls) -> None:
+    for i, p in enumerate(prog_ls):
+        if i > 0:
+            code.emit(POP)
+        compile_form(code, p)
+
+
+def compile_defvar(code: CodeObject, name, declared_tprog, init_prog) -> None:
+    compile_form(code, init_prog)
+    code.emit(DEFVAR, code.add(code.names, name))
+
+
+def compile_defun(code: CodeObject, fname, fun_ret_t, argspec_list, *fn_body) -> None:
+    body = compile_program(fn_body)
+    code.defuns.append((fname, argspec_list, fn_body, body))
+    code.emit(DEFUN, len(code.defuns) - 1)
+
+
+def compile_set(code: CodeObject, var_name, val_prog) -> None:
+    compile_form(code, val_prog)
+    code.emit(SET, code.add(code.names, var_name))
+
+
+def compile_apply(code: CodeObject, fun_name, *arg_list) -> None:
+    for arg in arg_list:
+        compile_form(code, arg)
+    if fusable_builtins.get(fun_name) == len(arg_list):
+        op = CALL_BUILTIN2 if len(arg_list) == 2 else CALL_BUILTIN1
+        code.emit(op, code.add(code.builtins, fun_name, (fun_name, lang.builtin_fn_vals[fun_name])))
+    else:
+        code.emit(CALL, code.add(code.calls, (fun_name, len(arg_list))))
+
+
+def compile_scope(code: CodeObject, *prog) -> None:
+    code.emit(ENTER_SCOPE)
+    compile_form(code, prog)
+    code.emit(EXIT_SCOPE)
+
+
+def compile_if(code: CodeObject, test, then_c, else_c) -> None:
+    compile_form(code, test)
+    code.emit(ENTER_SCOPE)
+    to_else = code.emit(JUMP_IF_FALSE)
+    compile_form(code, then_c)
+    to_end = code.emit(JUMP)
+    code.patch(to_else, code.here())
+    compile_form(code, else_c)
+    code.patch(to_end, code.here())
+    code.emit(DEALLOCATE)
+    code.emit(EXIT_SCOPE)
+
+
+def compile_while(code: CodeObject, test_c, default_c, body_c) -> None:
+    code.emit(ENTER_SCOPE)
+    code.emit(CONST, code.const(NOT_RUN))
+    loop = code.here()
+    compile_form(code, test_c)
+    to_end = code.emit(JUMP_IF_FALSE)
+    # Discard the value of the previous iteration (or the NOT_RUN marker)
+    code.emit(POP)
+    compile_form(code, body_c)
+    code.emit(JUMP, loop)
+    code.patch(to_end, code.here())
+    code.emit(DEALLOCATE)
+    # Same as the tree-walker: the default clause is run in the (deallocated) loop environment
+    to_exit = code.emit(JUMP_IF_SET)
+    compile_form(code, default_c)
+    code.patch(to_exit, code.here())
+    code.emit(EXIT_SCOPE)
+
+
+def compile_mkref(code: CodeObject, var) -> None:
+    code.emit(MKREF, code.add(code.names, var))
+
+
+def compile_setref(code: CodeObject, ref_name, new_def) -> None:
+    compile_form(code, new_def)
+    code.emit(SETREF, code.add(code.names, ref_name))
+
+
+def compile_deref(code: CodeObject, ref) -> None:
+    code.emit(DEREF, code.add(code.names, ref))
+
+
+def compile_setrefval(code: CodeObject, ref, new_val) -> None:
+    compile_form(code, new_val)
+    code.emit(SETREFVAL, code.add(code.names, ref))
+
+
+macro_compilers = {
+    "defun": compile_defun,
+    "defvar": compile_defvar,
+    "scope": compile_scope,
+    "set": compile_set,
+    "apply": compile_apply,
+    "if": compile_if,
+    "while": compile_while,
+    "mkref": compile_mkref,
+    "setref": compile_setref,
+    "deref": compile_deref,
+    "setrefval": compile_setrefval
+}
+
+
+#############
+# Execution #
+#############
+
+def evaluate(env: Env, prog):
+    return run(compile_program(prog), env)
+
+
+def _builtins_visible(code: CodeObject, env: Env) -> bool:
+    """
+    The fused builtin instructions are only valid if the builtins they stand for are what the names actually resolve
+    to in env. (Since functions can't be redefined, the answer is the same in any Env enclosed by env.)
+    """
+    for name, fn in code.builtins:
+        if not (env.contains_fun(name) and env.get_fun_def(name) is fn):
+            return False
+    return True
+
+
+def run(code: CodeObject, env: Env, fused_ok: bool = None):
+    ops, consts, names = code.ops, code.consts, code.names
+    if fused_ok is None:
+        fused_ok = _builtins_visible(code, env)
+    stack = []
+    scopes = []
+    frames = []
+    pc = 0
+
+    while True:
+        op = ops[pc]
+        arg = ops[pc + 1]
+        pc += 2
+
+        if op == LOAD:
+            stack.append(env.get_bind_val(names[arg]))
+        elif op == CONST:
+            stack.append(consts[arg])
+        elif op == CALL_BUILTIN2:
+            name, fn = code.builtins[arg]
+            if not fused_ok:
+                fn = env.get_fun_def(name)
+            b = stack.pop()
+            stack[-1] = fn(stack[-1], b)
+        elif op == POP:
+            stack.pop()
+        elif op == JUMP_IF_FALSE:
+            if not stack.pop():
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == SET:
+            env.set_bind_val(names[arg], stack[-1])
+            stack[-1] = None
+        elif op == CALL:
+            name, argc = code.calls[arg]
+            if argc:
+                args = stack[-argc:]
+                del stack[-argc:]
+            else:
+                args = ()
+            fn = env.get_fun_def(name)
+            if fn.__class__ is VMProcedure and fn.memo is None:
+                # Run the callee's code in this loop, rather than recursing in Python
+                frames.append((code, pc, env, stack, scopes, fused_ok))
+                env = fn.make_frame(args)
+                code = fn.code
+                ops, consts, names = code.ops, code.consts, code.names
+                fused_ok = fn.fused_ok(env)
+                stack, scopes, pc = [], [], 0
+            else:
+                stack.append(fn(*args))
+        elif op == ENTER_SCOPE:
+            scopes.append(env)
+            env = Env(outer=env)
+        elif op == EXIT_SCOPE:
+            env = scopes.pop()
+        elif op == DEALLOCATE:
+            env.deallocate()
+        elif op == JUMP_IF_SET:
+            if stack[-1] is NOT_RUN:
+                stack.pop()
+            else:
+                pc = arg
+        elif op == DEFVAR:
+            env.define_bind(names[arg], stack[-1])
+            stack[-1] = None
+        elif op == CALL_BUILTIN1:
+            name, fn = code.builtins[arg]
+            if not fused_ok:
+                fn = env.get_fun_def(name)
+            stack[-1] = fn(stack[-1])
+        elif op == DEFUN:
+            fname, argspec_ls, fn_body, fn_code = code.defuns[arg]
+            env.define_fun(fname, VMProcedure(env.functions, argspec_ls, fn_body, fn_code))
+            stack.append(None)
+        elif op == MKREF:
+            stack.append((names[arg], env.get_bind(names[arg])))
+        elif op == SETREF:
+            env.set_bind_val(names[arg], stack[-1])
+            stack[-1] = None
+        elif op == DEREF:
+            var, referenced_binding = env.get_bind_val(names[arg])
+            val, defining_env = referenced_binding
+            stack.append(val)
+        elif op == SETREFVAL:
+            var, referenced_binding = env.get_bind_val(names[arg])
+            val, defining_env = referenced_binding
+            defining_env.set_bind_val(var, stack[-1])
+            stack[-1] = None
+        elif op == RETURN:
+            ret = stack.pop()
+            if not frames:
+                return ret
+            code, pc, env, stack, scopes, fused_ok = frames.pop()
+            ops, consts, names = code.ops, code.consts, code.names
+            stack.append(ret)
+        elif op == RAISE:
+            raise consts[arg]
+        else:
+            raise RuntimeError(f"Unknown opcode {op}")